@@ -133,4 +133,118 @@ STATICFILES_DIRS = [
 # Default primary key field type
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
-CORS_ALLOW_ALL_ORIGINS = True 
\ No newline at end of file
+CORS_ALLOW_ALL_ORIGINS = True
+
+# RAG vector store
+# Directory holding faiss_index.bin and its metadata, shared by all workers
+RAG_INDEX_DIR = BASE_DIR
+# Each ingestion appends a segment file and each deletion adds tombstones;
+# they are compacted into faiss_index.bin in the background once any
+# threshold is reached (or run compact_index)
+RAG_COMPACT_SEGMENTS = 16
+RAG_COMPACT_VECTORS = 50000
+RAG_COMPACT_TOMBSTONES = 10000  # Deleted vectors waiting to be removed
+# Keep a process-local LRU vector_id -> chunk text map so searches skip the
+# database; it is dropped whenever the index generation changes
+RAG_CHUNK_CACHE = True
+RAG_CHUNK_CACHE_SIZE = 10000  # Chunks kept per process
+# Per-process LRU caches for query embeddings and (query, k) search results;
+# results are dropped whenever the index generation changes
+RAG_QUERY_CACHE_SIZE = 1024
+RAG_QUERY_CACHE_TTL = 3600  # seconds, None to keep entries until evicted
+
+# FAISS index type for new indexes: "flat" (exact), "ivf" or "hnsw", or a
+# compressed one: "sq8" (4x smaller), "pq" or "ivfpq" (for large corpora).
+# Run `python manage.py rebuild_index` to convert an existing index.
+RAG_INDEX_TYPE = "flat"
+RAG_IVF_NLIST = 1024  # IVF lists (capped by corpus size at build time)
+RAG_IVF_NPROBE = 16  # IVF lists scanned per query
+RAG_HNSW_M = 32  # HNSW graph degree
+RAG_HNSW_EF_CONSTRUCTION = 200
+RAG_HNSW_EF_SEARCH = 64  # HNSW search breadth
+RAG_PQ_M = 96  # PQ sub-quantizers, must divide the embedding dimension (96 -> 16x smaller)
+RAG_PQ_NBITS = 8  # Bits per PQ sub-quantizer code
+
+# Embeddings: "local" (feature hashing, no API calls), "openai" (any
+# OpenAI-compatible /embeddings endpoint, e.g. a self-hosted model server at
+# RAG_EMBEDDING_BASE_URL) or the dotted path of an EmbeddingProvider subclass.
+# Remote calls send RAG_EMBEDDING_BATCH_SIZE texts per request,
+# RAG_EMBEDDING_CONCURRENCY requests at a time, within RAG_EMBEDDING_RPM
+# requests and RAG_EMBEDDING_TPM tokens per minute, retrying throttled or
+# failed requests RAG_EMBEDDING_MAX_RETRIES times
+RAG_EMBEDDING_PROVIDER = "local"
+RAG_EMBEDDING_MODEL = None  # Provider default
+RAG_EMBEDDING_DIM = None  # Model default (required for models the provider doesn't know)
+RAG_EMBEDDING_BASE_URL = "https://api.openai.com/v1"
+RAG_EMBEDDING_API_KEY = OPENAI_API_KEY
+RAG_EMBEDDING_BATCH_SIZE = 128
+RAG_EMBEDDING_CONCURRENCY = 4
+RAG_EMBEDDING_RPM = 3000
+RAG_EMBEDDING_TPM = 1000000
+RAG_EMBEDDING_MAX_RETRIES = 5
+RAG_EMBEDDING_TIMEOUT = 30  # seconds per request
+# Indexes are stamped with the embedding that produced them. When the
+# configured one differs, the stamped one keeps serving until every chunk is
+# re-embedded by `python manage.py reembed_index`, then the new index replaces
+# the old one atomically. RAG_REEMBED_ON_MISMATCH starts that job in the
+# background as soon as a worker sees the mismatch: with a paid API, a
+# settings change then re-embeds the whole corpus at its cost
+RAG_REEMBED_ON_MISMATCH = False
+
+# Hybrid retrieval: FAISS hits are fused with BM25 keyword hits by
+# reciprocal-rank fusion, each list weighted by RAG_*_WEIGHT / (RAG_RRF_K + rank).
+# Run `python manage.py rebuild_lexical_index` once for chunks indexed before.
+RAG_HYBRID_SEARCH = True
+RAG_RRF_K = 60
+RAG_VECTOR_WEIGHT = 1.0
+RAG_LEXICAL_WEIGHT = 1.0
+# Keyword hits scoring below this fraction of the best one are not fused
+# (e.g. chunks sharing only the "err" of the "ERR-3005" searched for)
+RAG_LEXICAL_MIN_SCORE = 0.2
+RAG_BM25_K1 = 1.2  # Term frequency saturation
+RAG_BM25_B = 0.75  # Chunk length normalization
+
+# Reranking: with RAG_MMR, MMR_OVERFETCH candidates per result are reranked by
+# maximal marginal relevance (RAG_MMR_LAMBDA = 1 keeps the plain ranking,
+# lower values favour diversity). RAG_MERGE_ADJACENT joins neighbouring
+# chunks of a document into one span without their repeated overlap
+RAG_MMR = True
+RAG_MMR_LAMBDA = 0.7
+RAG_MERGE_ADJACENT = True
+
+# Chat history: the agent sees the last RAG_HISTORY_EXCHANGES (user, assistant)
+# pairs. With RAG_HISTORY_SUMMARY, older messages are folded into a rolling
+# summary on the session, RAG_HISTORY_SUMMARY_BATCH messages per LLM call;
+# until then they are sent along with the recent pairs
+RAG_HISTORY_EXCHANGES = 5
+RAG_HISTORY_SUMMARY = False
+RAG_HISTORY_SUMMARY_BATCH = 10
+
+# Prompt assembly: tokens allowed for the question, history and retrieved
+# chunks of one LLM call (counted with tiktoken, ~4 characters per token
+# without it). History may use RAG_CONTEXT_HISTORY_SHARE of what the question
+# leaves; chunks whose word-shingle Jaccard similarity with a better ranked
+# chunk reaches RAG_CONTEXT_DEDUP_THRESHOLD are dropped
+RAG_CONTEXT_TOKEN_BUDGET = 3000
+RAG_CONTEXT_HISTORY_SHARE = 0.3
+RAG_CONTEXT_DEDUP_THRESHOLD = 0.8
+
+# LLM response cache (database): replies are reused for the same prompt,
+# normalized question and retrieved chunks (agent replies: the same
+# conversation and index generation, checked before the first LLM call).
+# Set RAG_RESPONSE_CACHE_SIMILARITY (cosine, e.g. 0.95) to also match
+# reworded questions over the same context
+RAG_RESPONSE_CACHE = True
+RAG_RESPONSE_CACHE_TTL = 7 * 24 * 3600  # seconds, None to keep until evicted
+RAG_RESPONSE_CACHE_MAX_ENTRIES = 10000  # Least recently used entries are evicted
+RAG_RESPONSE_CACHE_SIMILARITY = None
+
+# Background ingestion: uploads are copied to RAG_UPLOAD_DIR and indexed by a
+# pool of RAG_INGEST_WORKERS threads per process (see /api/jobs/<id>/)
+RAG_UPLOAD_DIR = BASE_DIR / "uploads"
+RAG_INGEST_WORKERS = 2
+
+# Tracing and metrics: request and stage latencies, token counts and cache
+# events are collected per process and served at /api/metrics/ (Prometheus
+# text format). RAG_TRACE = False silences the per-step trace lines
+RAG_TRACE = True
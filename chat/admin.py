@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import ChatSession, Message, Document, DocumentChunk
+from .models import CachedResponse, ChatSession, ChunkEmbedding, IngestionJob, Message, Document, DocumentChunk
+from .rag_service import delete_chunks
 
 @admin.register(ChatSession)
 class ChatSessionAdmin(admin.ModelAdmin):
@@ -16,5 +17,27 @@ class DocumentAdmin(admin.ModelAdmin):
 
 @admin.register(DocumentChunk)
 class DocumentChunkAdmin(admin.ModelAdmin):
-    list_display = ('id', 'document', 'vector_id', 'created_at')
-    list_filter = ('document', 'created_at')
\ No newline at end of file
+    list_display = ('id', 'document', 'position', 'vector_id', 'content_hash', 'created_at')
+    list_filter = ('document', 'created_at')
+
+    # Route deletes through the RAG service so the vectors go too
+    def delete_model(self, request, obj):
+        delete_chunks(DocumentChunk.objects.filter(pk=obj.pk))
+
+    def delete_queryset(self, request, queryset):
+        delete_chunks(queryset)
+
+@admin.register(ChunkEmbedding)
+class ChunkEmbeddingAdmin(admin.ModelAdmin):
+    list_display = ('id', 'content_hash', 'vector_id', 'created_at')
+    search_fields = ('content_hash',)
+
+@admin.register(IngestionJob)
+class IngestionJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'file_name', 'status', 'processed_chunks', 'total_chunks', 'created_at')
+    list_filter = ('status',)
+
+@admin.register(CachedResponse)
+class CachedResponseAdmin(admin.ModelAdmin):
+    list_display = ('id', 'question', 'hits', 'created_at', 'last_used_at')
+    search_fields = ('question',)
@@ -1,31 +1,103 @@
 # chat/agent_service.py
 import os
 import json
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Annotated, List, Optional, Tuple
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
 from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
+from langchain_core.tools import InjectedToolArg, StructuredTool
 
 # Import RAG service
-from .rag_service import search_docs
+from .rag_service import asearch_chunks, retrieved_ids, search_chunks
+from .index_service import current_generation
+from . import response_cache_service as response_cache
+from .context_service import assemble_context, context_budget, count_tokens
+from .metrics_service import count_event, observe_llm_usage, span, trace
 
 # -------------------------------------------------------------------
 # 1. RAG Tool Function
 # -------------------------------------------------------------------
 
-def search_documents_tool(query: str) -> str:
+DEFAULT_SEARCH_K = 4
+MAX_SEARCH_K = 10
+# Share of RAG_CONTEXT_TOKEN_BUDGET the search results of one request may
+# use together; the rest is for the system prompt, summary, history and question
+TOOL_RESULT_SHARE = 0.6
+
+
+def tool_budget() -> int:
+    return int(context_budget() * TOOL_RESULT_SHARE)
+
+
+def search_documents_tool(query: str, k: int = DEFAULT_SEARCH_K,
+                          budget: Optional[int] = None) -> Tuple[str, List[int]]:
     """
     Wrapper for searching indexed documents.
-    Calls search_docs() from rag_service and returns plain text.
+    Calls search_chunks() from rag_service and returns plain text of at most
+    budget tokens (the whole tool share by default), with the vector ids of
+    the chunks in it.
     """
-    print(f"[TOOL] search_documents called with query: {query}")
-    results = search_docs(query, k=4)
-    
+    k = max(1, min(int(k), MAX_SEARCH_K))
+    trace(f"[TOOL] search_documents called with query: {query} (k={k})")
+    return _tool_result(query, search_chunks(query, k=k), budget)
+
+
+async def asearch_documents_tool(query: str, k: int = DEFAULT_SEARCH_K,
+                                 budget: Optional[int] = None) -> Tuple[str, List[int]]:
+    """Async version of search_documents_tool"""
+    k = max(1, min(int(k), MAX_SEARCH_K))
+    trace(f"[TOOL] search_documents called with query: {query} (k={k}, async)")
+    return _tool_result(query, await asearch_chunks(query, k=k), budget)
+
+
+def _tool_result(query: str, results, budget: Optional[int]) -> Tuple[str, List[int]]:
     if not results:
-        return "No relevant document chunks found in the database."
-    
-    # Join results into readable text
-    formatted_results = "\n\n---\n\n".join(results)
-    print(f"[TOOL] Found {len(results)} document chunks")
-    return formatted_results
+        return "No relevant document chunks found in the database.", []
+
+    # De-duplicate and join the results within the tool's token budget
+    prompt_context = assemble_context(
+        query, [chunk.text for chunk in results], budget=tool_budget() if budget is None else budget
+    )
+    trace(f"[TOOL] Found {len(results)} document chunks, returning {len(prompt_context.chunks)} "
+          f"({prompt_context.tokens['chunks']} tokens)")
+    if not prompt_context.chunks:
+        return "The context budget for search results is used up; answer from the results you already have.", []
+    kept = set(prompt_context.chunks)
+    return prompt_context.context, retrieved_ids([chunk for chunk in results if chunk.text in kept])
+
+
+def _search_documents(query: str, k: int = DEFAULT_SEARCH_K,
+                      budget: Annotated[Optional[int], InjectedToolArg] = None) -> Tuple[str, List[int]]:
+    """Search the indexed documents for passages relevant to the query.
+
+    Args:
+        query: What to search for, phrased as a short search query.
+        k: Number of passages to return (1-10). Use more for broad questions.
+    """
+    # budget is set by the agent (_run_tools), never by the model; the chunk
+    # ids come back as the ToolMessage artifact, for the response cache
+    return search_documents_tool(query, k, budget)
+
+
+async def _asearch_documents(query: str, k: int = DEFAULT_SEARCH_K,
+                             budget: Annotated[Optional[int], InjectedToolArg] = None) -> Tuple[str, List[int]]:
+    return await asearch_documents_tool(query, k, budget)
+
+
+# With a coroutine, ainvoke searches without running the whole tool (and its
+# database access) in a worker thread
+search_documents = StructuredTool.from_function(
+    func=_search_documents,
+    coroutine=_asearch_documents,
+    name="search_documents",
+    response_format="content_and_artifact",
+)
+
+
+TOOLS = {search_documents.name: search_documents}
 
 
 # -------------------------------------------------------------------
@@ -40,111 +112,333 @@ llm = ChatOpenAI(
 
 
 # -------------------------------------------------------------------
-# 3. Simple ReAct Agent Implementation
+# 3. Tool-Calling Agent Implementation
 # -------------------------------------------------------------------
 
-def run_agent(message: str, chat_history):
+SYSTEM_PROMPT = """You are an AI assistant with access to a document search tool.
+
+Instructions:
+1. If the user asks about documents or specific information, call search_documents
+2. Independent searches can be requested together in a single turn
+3. Base your answer on the document content found
+4. If no relevant documents are found, state this clearly
+5. Be concise and accurate
+"""
+
+# LLM turns per request; the last one is not allowed to call tools
+MAX_ITERATIONS = 3
+MAX_TOOL_WORKERS = 4
+
+# Searches from one model turn run in parallel
+_tool_executor = ThreadPoolExecutor(max_workers=MAX_TOOL_WORKERS, thread_name_prefix="agent-tool")
+
+
+def _bind_tools(iteration: int):
+    """The LLM with the search tool bound; tools are disabled on the last turn to force an answer"""
+    tool_choice = "none" if iteration == MAX_ITERATIONS - 1 else "auto"
+    return llm.bind_tools(list(TOOLS.values()), tool_choice=tool_choice)
+
+
+def _build_messages(message: str, chat_history, summary: str = ""):
+    """System prompt, summary, the recent exchanges that fit the token budget and the new message"""
+    # Keep as many recent exchanges as the budget left over for search results allows
+    prompt_context = assemble_context(
+        message,
+        chat_history=chat_history,
+        summary=summary,
+        reserved=SYSTEM_PROMPT,
+        budget=int(context_budget() * (1 - TOOL_RESULT_SHARE)),
+    )
+    trace(f"[AGENT] Prompt tokens: {prompt_context.tokens['total']} "
+          f"({len(prompt_context.chat_history)} exchanges of history)")
+
+    messages = [SystemMessage(content=SYSTEM_PROMPT)]
+    if summary:
+        messages.append(SystemMessage(content=f"Summary of the earlier conversation:\n{summary}"))
+    for user_msg, assistant_msg in prompt_context.chat_history:
+        messages.append(HumanMessage(content=user_msg))
+        messages.append(AIMessage(content=assistant_msg))
+    messages.append(HumanMessage(content=message))
+    return messages
+
+
+def _select_tool(tool_call):
+    trace(f"[AGENT] Tool call: {tool_call['name']}({json.dumps(tool_call['args'])})")
+    count_event("tool_call")
+    selected = TOOLS.get(tool_call["name"])
+    if selected is None:
+        raise ValueError(f"Unknown tool: {tool_call['name']}")
+    return selected
+
+
+def _tool_error(tool_call, error: Exception) -> ToolMessage:
+    trace(f"[TOOL] Error: {str(error)}")
+    count_event("tool_error")
+    return ToolMessage(content=f"Tool error: {str(error)}", tool_call_id=tool_call["id"], name=tool_call["name"])
+
+
+def _invoke_tool(tool_call) -> ToolMessage:
+    """Run one tool call; errors are reported back to the model instead of raised"""
+    try:
+        selected = _select_tool(tool_call)
+        with span("tool_call"):
+            # Invoked with the whole call, the tool returns a ToolMessage with its artifact
+            return selected.invoke({**tool_call, "type": "tool_call"})
+    except Exception as e:
+        return _tool_error(tool_call, e)
+
+
+def _invoke_pooled_tool(tool_call) -> ToolMessage:
+    """_invoke_tool in a _tool_executor thread, which must not keep a database connection open"""
+    try:
+        return _invoke_tool(tool_call)
+    finally:
+        close_old_connections()
+
+
+def _with_budgets(tool_calls, budget: int):
+    """Tool calls of one turn, splitting the tokens left for tool results evenly between them"""
+    share = max(budget, 0) // len(tool_calls)
+    return [{**tool_call, "args": {**tool_call["args"], "budget": share}} for tool_call in tool_calls]
+
+
+def _tool_tokens(tool_messages) -> int:
+    return sum(count_tokens(tool_message.content) for tool_message in tool_messages)
+
+
+def _run_tools(tool_calls, budget: int):
+    """
+    Run all tool calls of one model turn concurrently, keeping their order;
+    their results share budget tokens
     """
-    Simple ReAct-style agent that uses the search_documents tool.
-    
+    tool_calls = _with_budgets(tool_calls, budget)
+    if len(tool_calls) == 1:
+        return [_invoke_tool(tool_calls[0])]
+    return list(_tool_executor.map(_invoke_pooled_tool, tool_calls))
+
+
+# Agent answers are cached under the question, the conversation and the
+# index generation, so the cache is looked up before the first LLM call and
+# a hit costs none. Any index change bumps the generation; the chunks the
+# searches returned are stored too, so invalidate_chunks frees the entries
+# built on changed chunks right away. Answers given without searching don't
+# depend on the documents and are not cached.
+
+def _conversation_key(chat_history, summary: str) -> str:
+    return json.dumps([summary, chat_history, current_generation()])
+
+
+def _tool_chunk_ids(tool_messages) -> set:
+    """Vector ids of the chunks returned by the tool calls of one turn"""
+    return {vector_id for tool_message in tool_messages for vector_id in (tool_message.artifact or ())}
+
+
+def _lookup_reply(message: str, conversation: str):
+    """Cached answer to the question in this conversation over the current index, or None"""
+    with span("response_cache_lookup"):
+        return response_cache.lookup(SYSTEM_PROMPT, message, (), conversation)
+
+
+def _store_reply(message: str, chunk_ids, conversation: str, response: str):
+    if chunk_ids:
+        response_cache.store(SYSTEM_PROMPT, message, chunk_ids, response, conversation, keyed_on_chunks=False)
+
+
+class _AgentRun:
+    """
+    One request to the agent: the prompt built so far, the tokens left for
+    search results and the chunks found. Each turn the model either answers
+    or calls tools whose results join the prompt. The agent functions below
+    only differ in how they call the model, the tools and the cache.
+    """
+
+    def __init__(self, label: str, message: str, chat_history, summary: str = ""):
+        trace(f"\n{'='*60}")
+        trace(f"[AGENT] {label}: {message}")
+        trace(f"[AGENT] Chat history length: {len(chat_history)}")
+        self.message = message
+        self.messages = _build_messages(message, chat_history, summary)
+        self.budget = tool_budget()  # Tokens left for search results
+        self.conversation = _conversation_key(chat_history, summary)
+        self.chunk_ids = set()
+        self.last_turn = False
+
+    @property
+    def cache_key(self):
+        """Arguments of _lookup_reply"""
+        return self.message, self.conversation
+
+    def turns(self):
+        """The model of each turn (tools are disabled on the last one)"""
+        for iteration in range(MAX_ITERATIONS):
+            trace(f"[AGENT] Iteration {iteration + 1}/{MAX_ITERATIONS}")
+            self.last_turn = iteration == MAX_ITERATIONS - 1
+            yield _bind_tools(iteration)
+
+    def answered(self, response) -> bool:
+        """
+        Whether the model's response is the answer; otherwise it joins the
+        prompt and its tool calls are to be run. The last turn always
+        answers, even if the model still asked for tools.
+        """
+        observe_llm_usage(response)
+        if response is None or not response.tool_calls or self.last_turn:
+            trace("[AGENT] Final answer generated")
+            trace(f"{'='*60}\n")
+            return True
+        self.messages.append(response)
+        return False
+
+    def add_tool_results(self, tool_messages):
+        self.budget -= _tool_tokens(tool_messages)
+        self.messages.extend(tool_messages)
+        self.chunk_ids |= _tool_chunk_ids(tool_messages)
+
+    def reply(self, response):
+        """Arguments of _store_reply for the answer"""
+        return self.message, self.chunk_ids, self.conversation, response.content
+
+    def failed(self, error: Exception) -> str:
+        count_event("agent_error")
+        trace(f"[ERROR] Agent error: {str(error)}")
+        trace(f"{'='*60}\n")
+        return f"I encountered an error while processing your request: {str(error)}"
+
+
+def run_agent(message: str, chat_history, summary: str = ""):
+    """
+    Tool-calling agent that uses the search_documents tool.
+
     Args:
         message: The user's current message/question
         chat_history: List of tuples [(user_msg, assistant_msg), ...]
-    
+        summary: Rolling summary of the exchanges older than chat_history
+
     Returns:
         str: The agent's response
     """
-    print(f"\n{'='*60}")
-    print(f"[AGENT] Processing message: {message}")
-    print(f"[AGENT] Chat history length: {len(chat_history)}")
-    
-    # Format chat history
-    formatted_history = ""
-    if chat_history:
-        for i, (user_msg, assistant_msg) in enumerate(chat_history[-5:], 1):
-            formatted_history += f"User: {user_msg}\nAssistant: {assistant_msg}\n\n"
-    else:
-        formatted_history = "No previous conversation.\n\n"
-    
-    # System prompt with tool description
-    system_prompt = """You are an AI assistant with access to a document search tool.
-
-You can use the following tool:
-- search_documents(query): Searches indexed documents for relevant information
-
-When you need to search documents, respond in this EXACT format:
-TOOL_CALL: search_documents
-QUERY: <your search query here>
-
-After receiving tool results, provide your final answer normally without any special formatting.
+    run = _AgentRun("Processing message", message, chat_history, summary)
+    try:
+        cached = _lookup_reply(*run.cache_key)
+        if cached is not None:
+            return cached
 
-Instructions:
-1. If the user asks about documents or specific information, use the search_documents tool
-2. Base your answer on the document content found
-3. If no relevant documents are found, state this clearly
-4. Be concise and accurate
-"""
-    
-    max_iterations = 3
-    conversation = formatted_history
-    
+        for model in run.turns():
+            with span("llm_call"):
+                response = model.invoke(run.messages)
+            if run.answered(response):
+                _store_reply(*run.reply(response))
+                return response.content
+            run.add_tool_results(_run_tools(response.tool_calls, run.budget))
+
+    except Exception as e:
+        return run.failed(e)
+
+
+def stream_agent(message: str, chat_history, summary: str = ""):
+    """
+    Streaming version of run_agent: yields the final answer token by token.
+
+    Text content is forwarded as it arrives until the model starts a tool
+    call; tool-call turns are accumulated and executed.
+    """
+    run = _AgentRun("Streaming message", message, chat_history, summary)
+    try:
+        cached = _lookup_reply(*run.cache_key)
+        if cached is not None:
+            yield cached
+            return
+
+        for model in run.turns():
+            response = None
+            with span("llm_stream"):
+                for chunk in model.stream(run.messages):
+                    response = chunk if response is None else response + chunk
+                    if chunk.content and not response.tool_call_chunks:
+                        yield chunk.content
+            if run.answered(response):
+                if response is not None:
+                    _store_reply(*run.reply(response))
+                return
+            run.add_tool_results(_run_tools(response.tool_calls, run.budget))
+
+    except Exception as e:
+        yield run.failed(e)
+
+
+# -------------------------------------------------------------------
+# 4. Async Agent (ASGI)
+# -------------------------------------------------------------------
+
+# Database access runs on the thread Django keeps for sync code; searches
+# send only their FAISS and BM25 work to a thread pool (asearch_chunks)
+_alookup_reply = sync_to_async(_lookup_reply)
+_astore_reply = sync_to_async(_store_reply)
+
+
+async def _ainvoke_tool(tool_call) -> ToolMessage:
+    """Async version of _invoke_tool"""
+    try:
+        selected = _select_tool(tool_call)
+        with span("tool_call"):
+            return await selected.ainvoke({**tool_call, "type": "tool_call"})
+    except Exception as e:
+        return _tool_error(tool_call, e)
+
+
+async def _arun_tools(tool_calls, budget: int):
+    """Async version of _run_tools"""
+    tool_calls = _with_budgets(tool_calls, budget)
+    return list(await asyncio.gather(*(_ainvoke_tool(tool_call) for tool_call in tool_calls)))
+
+
+async def arun_agent(message: str, chat_history, summary: str = ""):
+    """
+    Async version of run_agent: awaits the LLM with ainvoke so the event
+    loop can serve other conversations during the round-trip.
+    """
+    run = _AgentRun("Processing message (async)", message, chat_history, summary)
+    try:
+        cached = await _alookup_reply(*run.cache_key)
+        if cached is not None:
+            return cached
+
+        for model in run.turns():
+            with span("llm_call"):
+                response = await model.ainvoke(run.messages)
+            if run.answered(response):
+                await _astore_reply(*run.reply(response))
+                return response.content
+            run.add_tool_results(await _arun_tools(response.tool_calls, run.budget))
+
+    except Exception as e:
+        return run.failed(e)
+
+
+async def astream_agent(message: str, chat_history, summary: str = ""):
+    """
+    Async version of stream_agent: an async generator over the final
+    answer's tokens, fed by astream.
+    """
+    run = _AgentRun("Streaming message (async)", message, chat_history, summary)
     try:
-        for iteration in range(max_iterations):
-            print(f"[AGENT] Iteration {iteration + 1}/{max_iterations}")
-            
-            # Build the prompt
-            messages = [
-                SystemMessage(content=system_prompt),
-                HumanMessage(content=f"{conversation}User: {message}")
-            ]
-            
-            # Get LLM response
-            response = llm.invoke(messages)
-            agent_response = response.content
-            
-            print(f"[AGENT] Response: {agent_response[:200]}...")
-            
-            # Check if agent wants to use a tool
-            if "TOOL_CALL:" in agent_response and "search_documents" in agent_response:
-                # Extract query
-                lines = agent_response.split('\n')
-                query = None
-                for line in lines:
-                    if line.startswith("QUERY:"):
-                        query = line.replace("QUERY:", "").strip()
-                        break
-                
-                if query:
-                    print(f"[AGENT] Tool call detected: search_documents('{query}')")
-                    
-                    # Execute tool
-                    tool_result = search_documents_tool(query)
-                    
-                    # Add to conversation
-                    conversation += f"User: {message}\n"
-                    conversation += f"Assistant (thinking): I'll search for: {query}\n"
-                    conversation += f"Tool Result:\n{tool_result}\n\n"
-                    
-                    # Update message to ask for final answer
-                    message = "Based on the search results above, please provide your final answer to the user's question."
-                    
-                else:
-                    # Malformed tool call, return what we have
-                    print("[AGENT] Malformed tool call, returning response")
-                    return agent_response
-            else:
-                # No tool call, this is the final answer
-                print("[AGENT] Final answer generated")
-                print(f"{'='*60}\n")
-                return agent_response
-        
-        # Max iterations reached
-        print("[AGENT] Max iterations reached")
-        print(f"{'='*60}\n")
-        return agent_response
-    
+        cached = await _alookup_reply(*run.cache_key)
+        if cached is not None:
+            yield cached
+            return
+
+        for model in run.turns():
+            response = None
+            with span("llm_stream"):
+                async for chunk in model.astream(run.messages):
+                    response = chunk if response is None else response + chunk
+                    if chunk.content and not response.tool_call_chunks:
+                        yield chunk.content
+            if run.answered(response):
+                if response is not None:
+                    await _astore_reply(*run.reply(response))
+                return
+            run.add_tool_results(await _arun_tools(response.tool_calls, run.budget))
+
     except Exception as e:
-        error_msg = f"Agent error: {str(e)}"
-        print(f"[ERROR] {error_msg}")
-        print(f"{'='*60}\n")
-        return f"I encountered an error while processing your request: {str(e)}"
\ No newline at end of file
+        yield run.failed(e)
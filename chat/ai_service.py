@@ -1,7 +1,11 @@
+from asgiref.sync import sync_to_async
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from .rag_service import search_docs
+from .rag_service import asearch_chunks, retrieved_ids, search_chunks
+from . import response_cache_service as response_cache
+from .context_service import assemble_context, count_tokens
+from .metrics_service import observe_tokens, span, trace
 
 # Prepare model once (not on every request)
 model = ChatOpenAI(model="gpt-4o-mini", temperature=0)
@@ -31,31 +35,129 @@ parser = StrOutputParser()
 
 chain = prompt | model | parser
 
-def generate_ai_reply(user_message: str) -> str:
+def _build_context(user_message: str):
     """
-    Enhanced with RAG - searches documents before generating response
+    Search for relevant document chunks and fit them into the prompt's token
+    budget. Returns the context text and the ids of the retrieved chunks.
     """
-    print(f"🔍 USER QUESTION: '{user_message}'")
-    
-    # Search for relevant document chunks
-    relevant_chunks = search_docs(user_message, k=3)
+    return _fit_context(user_message, search_chunks(user_message, k=3))
+
+def _fit_context(user_message: str, relevant_chunks):
+    prompt_context = assemble_context(
+        user_message, [chunk.text for chunk in relevant_chunks], reserved=prompt_template
+    )
     
-    # Build context from chunks
-    if relevant_chunks:
-        context_text = "\n\n".join(relevant_chunks)
-        print("🎯 RAG CONTEXT FOUND!")
-        print(f"📊 Chunks retrieved: {len(relevant_chunks)}")
-        print(f"📝 First chunk preview: {relevant_chunks[0][:200]}...")
+    if prompt_context.chunks:
+        context_text = prompt_context.context
+        trace("🎯 RAG CONTEXT FOUND!")
+        trace(f"📊 Chunks retrieved: {len(relevant_chunks)}, used: {len(prompt_context.chunks)}")
+        trace(f"📝 First chunk preview: {prompt_context.chunks[0][:200]}...")
     else:
         context_text = "No specific context available."
-        print("❌ NO RAG CONTEXT FOUND")
+        trace("❌ NO RAG CONTEXT FOUND")
+    trace(f"🧮 Prompt tokens: {prompt_context.tokens['total']}/{prompt_context.tokens['budget']}")
+    observe_tokens("prompt", prompt_context.tokens['total'])
+    return context_text, retrieved_ids(relevant_chunks)
+
+def _prepare_reply(user_message: str):
+    """Prompt context, the chunk ids it came from and the cached reply for them (or None)"""
+    context_text, chunk_ids = _build_context(user_message)
+    with span("response_cache_lookup"):
+        cached = response_cache.lookup(prompt_template, user_message, chunk_ids)
+    return context_text, chunk_ids, cached
+
+def _store_reply(user_message: str, chunk_ids, response: str):
+    observe_tokens("completion", count_tokens(response))
+    response_cache.store(prompt_template, user_message, chunk_ids, response)
+
+def generate_ai_reply(user_message: str) -> str:
+    """
+    Enhanced with RAG - searches documents before generating response
+    """
+    trace(f"🔍 USER QUESTION: '{user_message}'")
+    
+    context_text, chunk_ids, cached = _prepare_reply(user_message)
+    if cached is not None:
+        return cached
     
     # Generate response with context
-    response = chain.invoke({
-        "context": context_text, 
-        "message": user_message
-    })
-    
-    print(f"🤖 AI RESPONSE: {response[:200]}...")
-    print("---" * 20)
-    return response
\ No newline at end of file
+    with span("llm_call"):
+        response = chain.invoke({
+            "context": context_text, 
+            "message": user_message
+        })
+    _store_reply(user_message, chunk_ids, response)
+    
+    trace(f"🤖 AI RESPONSE: {response[:200]}...")
+    trace("---" * 20)
+    return response
+
+def stream_ai_reply(user_message: str):
+    """
+    Streaming version of generate_ai_reply: yields response tokens as the
+    model produces them
+    """
+    trace(f"🔍 USER QUESTION (streaming): '{user_message}'")
+    
+    context_text, chunk_ids, cached = _prepare_reply(user_message)
+    if cached is not None:
+        yield cached
+        return
+    
+    parts = []
+    with span("llm_stream"):
+        for token in chain.stream({"context": context_text, "message": user_message}):
+            parts.append(token)
+            yield token
+    _store_reply(user_message, chunk_ids, "".join(parts))
+
+# Only the FAISS and BM25 search leaves for a thread pool (asearch_chunks);
+# the database is used from the thread Django keeps for sync code
+_alookup_reply = sync_to_async(response_cache.lookup)
+_astore_reply = sync_to_async(_store_reply)
+
+async def _aprepare_reply(user_message: str):
+    """Async version of _prepare_reply"""
+    context_text, chunk_ids = _fit_context(user_message, await asearch_chunks(user_message, k=3))
+    with span("response_cache_lookup"):
+        cached = await _alookup_reply(prompt_template, user_message, chunk_ids)
+    return context_text, chunk_ids, cached
+
+async def agenerate_ai_reply(user_message: str) -> str:
+    """
+    Async version of generate_ai_reply for ASGI views
+    """
+    trace(f"🔍 USER QUESTION (async): '{user_message}'")
+    
+    context_text, chunk_ids, cached = await _aprepare_reply(user_message)
+    if cached is not None:
+        return cached
+    
+    with span("llm_call"):
+        response = await chain.ainvoke({
+            "context": context_text,
+            "message": user_message
+        })
+    await _astore_reply(user_message, chunk_ids, response)
+    
+    trace(f"🤖 AI RESPONSE: {response[:200]}...")
+    trace("---" * 20)
+    return response
+
+async def astream_ai_reply(user_message: str):
+    """
+    Async version of stream_ai_reply: an async generator over response tokens
+    """
+    trace(f"🔍 USER QUESTION (async streaming): '{user_message}'")
+    
+    context_text, chunk_ids, cached = await _aprepare_reply(user_message)
+    if cached is not None:
+        yield cached
+        return
+    
+    parts = []
+    with span("llm_stream"):
+        async for token in chain.astream({"context": context_text, "message": user_message}):
+            parts.append(token)
+            yield token
+    await _astore_reply(user_message, chunk_ids, "".join(parts))
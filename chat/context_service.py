@@ -0,0 +1,190 @@
+# chat/context_service.py
+import re
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+from django.conf import settings
+
+from .metrics_service import trace
+
+TOKENIZER_MODEL = "gpt-4o-mini"
+CHUNK_SEPARATOR = "\n\n---\n\n"
+SHINGLE_SIZE = 5  # Words per shingle for near-duplicate detection
+MIN_OVERLAP_CHARS = 50  # Shorter shared edges between chunks are left alone
+
+_WORD_RE = re.compile(r"\w+")
+
+_encoding = None
+_encoding_failed = False
+
+
+def _get_encoding():
+    """tiktoken encoding of the chat model, or None when tiktoken (or its data) is unavailable"""
+    global _encoding, _encoding_failed
+    if _encoding is None and not _encoding_failed:
+        try:
+            import tiktoken
+            _encoding = tiktoken.encoding_for_model(TOKENIZER_MODEL)
+        except Exception as e:
+            trace(f"⚠️ tiktoken unavailable ({e}), estimating 4 characters per token")
+            _encoding_failed = True
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    """Number of tokens text costs in a prompt (estimated as len/4 without tiktoken)"""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut text down to at most max_tokens"""
+    if max_tokens <= 0:
+        return ""
+    encoding = _get_encoding()
+    if encoding is None:
+        return text[:max_tokens * 4]
+    tokens = encoding.encode(text, disallowed_special=())
+    return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+
+
+# -------------------------------------------------------------------
+# Near-duplicate removal
+# -------------------------------------------------------------------
+
+def _shingles(text: str) -> frozenset:
+    words = _WORD_RE.findall(text.lower())
+    if len(words) <= SHINGLE_SIZE:
+        return frozenset([" ".join(words)])
+    return frozenset(" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1))
+
+
+def _jaccard(a: frozenset, b: frozenset) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def edge_overlap(a: str, b: str) -> int:
+    """Length of the longest suffix of a that is also a prefix of b"""
+    probe = b[:MIN_OVERLAP_CHARS]
+    if len(probe) < MIN_OVERLAP_CHARS:
+        return 0
+    start = a.find(probe)
+    while start != -1:
+        if b.startswith(a[start:]):
+            return len(a) - start
+        start = a.find(probe, start + 1)
+    return 0
+
+
+def dedupe_chunks(texts: Sequence[str], threshold: Optional[float] = None) -> List[str]:
+    """
+    Drop chunks whose word-shingle Jaccard similarity with an earlier
+    (better ranked) chunk reaches threshold, and trim the text neighbouring
+    chunks share through the splitter's chunk_overlap. Order is kept.
+    """
+    if threshold is None:
+        threshold = getattr(settings, "RAG_CONTEXT_DEDUP_THRESHOLD", 0.8)
+    kept, kept_shingles = [], []
+    for text in texts:
+        for other in kept:
+            # The splitter repeats up to chunk_overlap characters between neighbours
+            text = text[edge_overlap(other, text):]
+            overlap = edge_overlap(text, other)
+            if overlap:
+                text = text[:len(text) - overlap]
+        text = text.strip()
+        if not text:
+            continue
+        shingles = _shingles(text)
+        if any(_jaccard(shingles, other) >= threshold for other in kept_shingles):
+            continue
+        kept.append(text)
+        kept_shingles.append(shingles)
+    return kept
+
+
+# -------------------------------------------------------------------
+# Budgeted assembly
+# -------------------------------------------------------------------
+
+class PromptContext(NamedTuple):
+    """What fit in the token budget"""
+    context: str  # Retrieved chunks, joined
+    chunks: List[str]
+    chat_history: List[Tuple[str, str]]
+    tokens: dict  # Tokens used per part and in total, plus the budget
+
+
+def context_budget() -> int:
+    return getattr(settings, "RAG_CONTEXT_TOKEN_BUDGET", 3000)
+
+
+def fit_chunks(texts: Sequence[str], budget: int) -> Tuple[List[str], int]:
+    """Best-ranked chunks that fit in budget; the first one is truncated rather than dropped"""
+    kept, used = [], 0
+    separator_tokens = count_tokens(CHUNK_SEPARATOR)
+    for text in texts:
+        cost = count_tokens(text) + (separator_tokens if kept else 0)
+        if used + cost > budget:
+            if not kept and budget > 0:
+                text = truncate_to_tokens(text, budget)
+                kept.append(text)
+                used = count_tokens(text)
+            break
+        kept.append(text)
+        used += cost
+    return kept, used
+
+
+def fit_history(chat_history: Sequence[Tuple[str, str]], budget: int) -> Tuple[List[Tuple[str, str]], int]:
+    """Most recent (user, assistant) exchanges that fit in budget, oldest first"""
+    kept, used = [], 0
+    for user_msg, assistant_msg in reversed(chat_history):
+        cost = count_tokens(user_msg) + count_tokens(assistant_msg)
+        if used + cost > budget:
+            break
+        kept.append((user_msg, assistant_msg))
+        used += cost
+    kept.reverse()
+    return kept, used
+
+
+def assemble_context(
+    question: str,
+    chunks: Sequence[str] = (),
+    chat_history: Sequence[Tuple[str, str]] = (),
+    summary: str = "",
+    reserved: str = "",
+    budget: Optional[int] = None,
+) -> PromptContext:
+    """
+    Fit the question, the history and the retrieved chunks into a token
+    budget (RAG_CONTEXT_TOKEN_BUDGET). The question, the summary and the
+    reserved text (prompt template or system prompt) are always included;
+    recent history may take up to RAG_CONTEXT_HISTORY_SHARE of what is left,
+    and de-duplicated chunks fill the rest in rank order.
+    """
+    if budget is None:
+        budget = context_budget()
+    fixed = count_tokens(question) + count_tokens(summary) + count_tokens(reserved)
+    remaining = max(budget - fixed, 0)
+
+    history_share = getattr(settings, "RAG_CONTEXT_HISTORY_SHARE", 0.3)
+    history, history_tokens = fit_history(chat_history, int(remaining * history_share) if chunks else remaining)
+    remaining -= history_tokens
+
+    kept, chunk_tokens = fit_chunks(dedupe_chunks(chunks), remaining)
+    tokens = {
+        "question": count_tokens(question),
+        "summary": count_tokens(summary),
+        "reserved": count_tokens(reserved),
+        "history": history_tokens,
+        "chunks": chunk_tokens,
+        "total": fixed + history_tokens + chunk_tokens,
+        "budget": budget,
+    }
+    return PromptContext(CHUNK_SEPARATOR.join(kept), kept, history, tokens)
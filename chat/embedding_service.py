@@ -0,0 +1,360 @@
+# chat/embedding_service.py
+import re
+import time
+import random
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+import httpx
+import numpy as np
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .context_service import count_tokens
+from .metrics_service import count_event, span, trace
+
+
+class EmbeddingError(Exception):
+    """An embedding backend failed or returned something unusable"""
+
+
+class EmbeddingProvider:
+    """
+    Turns texts into a (len(texts), dim) float32 matrix of L2-normalized
+    rows. Backends subclass it, set name, and implement embed(); they are
+    selected by RAG_EMBEDDING_PROVIDER (a PROVIDERS key or a dotted path).
+    Bump version when a backend changes the vectors it returns for the same
+    model: indexes stamped with another version get re-embedded.
+    """
+    name = "base"
+    default_model = None
+    default_dim = None
+    version = "1"
+
+    def __init__(self, model: Optional[str] = None, dim: Optional[int] = None):
+        self.model = model or self.default_model
+        self.dim = int(dim or self.default_dim or 0)
+        if not self.dim:
+            raise ValueError(f"Unknown dimension for embedding model '{self.model}', set RAG_EMBEDDING_DIM")
+
+    @classmethod
+    def from_settings(cls, model: Optional[str] = None, dim: Optional[int] = None) -> "EmbeddingProvider":
+        return cls(model, dim)
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        raise NotImplementedError
+
+    def describe(self) -> dict:
+        """What produced the vectors, stamped on the index metadata"""
+        return {"provider": self.name, "model": self.model, "dim": self.dim, "version": self.version}
+
+    @property
+    def key(self) -> str:
+        return f"{self.name}:{self.model}:{self.dim}:{self.version}"
+
+
+def embedding_matches(stamp: dict, provider: EmbeddingProvider) -> bool:
+    """Whether provider produces the vectors described by an index stamp (keys the stamp lacks are not compared)"""
+    description = provider.describe()
+    return all(description.get(name) == value for name, value in stamp.items())
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    matrix /= norms
+    return matrix
+
+
+# -------------------------------------------------------------------
+# 1. Local feature hashing (no API calls)
+# -------------------------------------------------------------------
+
+# Semantic keywords and the embedding dimension each one feeds
+KEYWORD_POSITIONS = {
+    'django': 49, 'python': 50, 'framework': 51, 'web': 52,
+    'development': 53, 'database': 54, 'admin': 55, 'interface': 56,
+    'component': 57, 'reusable': 58, 'pluggability': 59, 'rapid': 60
+}
+_WORD_RE = re.compile(r'\b\w+\b')
+
+
+class LocalHashEmbedding(EmbeddingProvider):
+    """
+    Deterministic local embedding from word, character, keyword and hash
+    features. Free and fast, but only matches texts that look alike.
+    """
+    name = "local"
+    default_model = "hash-v1"
+    default_dim = 384
+    # Fixed text whose embedding fingerprints the hashing code
+    PROBE = "Django is a Python web framework: reusable components, rapid development. 0123456789"
+
+    def __init__(self, model: Optional[str] = None, dim: Optional[int] = None):
+        super().__init__(model, dim)
+        if self.dim <= 100:
+            raise ValueError("The local embedding needs more than 100 dimensions")
+        # Dimensions 100+ repeat the 16 MD5 digest bytes
+        self._hash_columns = np.arange(self.dim - 100) % 16
+        # Any change to the features changes the version, so stale indexes are detected
+        probe = np.round(self.embed([self.PROBE])[0], 5)
+        self.version = hashlib.sha256(probe.tobytes()).hexdigest()[:12]
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """
+        Features are extracted for the whole batch at once and rows are
+        L2-normalized in a single pass.
+        """
+        texts = [text.lower().strip() for text in texts]
+        n = len(texts)
+        matrix = np.zeros((n, self.dim), dtype='float32')
+        if n == 0:
+            return matrix
+
+        lengths = np.fromiter((len(text) for text in texts), dtype=np.int64, count=n)
+
+        # 1. Word frequency features (first 20 dimensions) and
+        # 3. text length and structure features (dimensions 46-48)
+        for row, text in enumerate(texts):
+            words = _WORD_RE.findall(text)
+            word_freq = {}
+            for word in words[:50]:  # First 50 words only
+                if len(word) > 2:  # Ignore very short words
+                    word_freq[word] = word_freq.get(word, 0) + 1
+            for i, freq in enumerate(list(word_freq.values())[:20]):
+                matrix[row, i] = min(freq / 10.0, 1.0)
+
+            if text:
+                matrix[row, 46] = min(len(text) / 1000.0, 1.0)  # Normalized length
+                matrix[row, 47] = len(words) / 100.0  # Word count
+                matrix[row, 48] = len(set(words)) / max(len(words), 1)  # Vocabulary diversity
+
+        # 2. Character distribution (dimensions 20-45), counted for every text
+        # at once from the concatenated code points of the batch
+        codes = np.frombuffer(
+            "".join(texts).encode("utf-32-le", "surrogatepass"), dtype=np.uint32
+        )
+        rows = np.repeat(np.arange(n), lengths)
+        letters = codes - ord('a')
+        is_letter = letters < 26  # unsigned wrap-around drops everything below 'a'
+        char_counts = np.bincount(
+            rows[is_letter] * 26 + letters[is_letter], minlength=n * 26
+        ).reshape(n, 26)
+        matrix[:, 20:46] = char_counts / np.maximum(lengths, 1)[:, None]
+
+        # 4. Semantic keywords (dimensions 49-60)
+        for keyword, position in KEYWORD_POSITIONS.items():
+            matrix[:, position] = [text.count(keyword) / 10.0 for text in texts]
+
+        # 5. Hash-based deterministic component (remainder)
+        digests = np.frombuffer(
+            b"".join(hashlib.md5(text.encode()).digest() for text in texts),
+            dtype=np.uint8
+        ).reshape(n, 16)
+        matrix[:, 100:] = digests[:, self._hash_columns] * (0.5 / 255.0)  # Scale down
+
+        return _normalize(matrix)
+
+
+# -------------------------------------------------------------------
+# 2. OpenAI-compatible HTTP backend
+# -------------------------------------------------------------------
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: rate tokens per second, bursts up to
+    capacity. acquire() blocks until the tokens are available.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float = 1.0):
+        # A request larger than the bucket waits for a full bucket instead of forever
+        amount = min(float(amount), self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return
+                wait = (amount - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+# Output dimension of well-known models (others need RAG_EMBEDDING_DIM)
+MODEL_DIMENSIONS = {
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+    "text-embedding-ada-002": 1536,
+}
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class OpenAICompatibleEmbedding(EmbeddingProvider):
+    """
+    Any server speaking the OpenAI embeddings API (POST {base_url}/embeddings):
+    OpenAI itself, or a self-hosted / fake model server. Texts are sent in
+    batches, several batches at a time, through request and token rate
+    limits, retrying throttled and failed requests with exponential backoff.
+    """
+    name = "openai"
+    default_model = "text-embedding-3-small"
+
+    def __init__(self, model: Optional[str] = None, dim: Optional[int] = None,
+                 base_url: str = "https://api.openai.com/v1", api_key: Optional[str] = None,
+                 batch_size: int = 128, concurrency: int = 4, requests_per_minute: float = 3000,
+                 tokens_per_minute: float = 1000000, max_retries: int = 5, timeout: float = 30.0,
+                 send_dimensions: bool = False, transport: Optional[httpx.BaseTransport] = None):
+        model = model or self.default_model
+        super().__init__(model, dim or MODEL_DIMENSIONS.get(model))
+        self.batch_size = max(1, int(batch_size))
+        self.concurrency = max(1, int(concurrency))
+        self.max_retries = int(max_retries)
+        # Ask for shortened vectors (text-embedding-3 models) instead of the model's native size
+        self.send_dimensions = send_dimensions
+        self.requests = TokenBucket(requests_per_minute / 60.0, max(requests_per_minute / 60.0, 1.0))
+        self.tokens = TokenBucket(tokens_per_minute / 60.0, tokens_per_minute / 60.0)
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        self.client = httpx.Client(
+            base_url=base_url.rstrip("/") + "/", headers=headers, timeout=timeout, transport=transport
+        )
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, model=None, dim=None):
+        return cls(
+            model=model,
+            dim=dim,
+            base_url=getattr(settings, "RAG_EMBEDDING_BASE_URL", "https://api.openai.com/v1"),
+            api_key=getattr(settings, "RAG_EMBEDDING_API_KEY", None) or getattr(settings, "OPENAI_API_KEY", None),
+            batch_size=getattr(settings, "RAG_EMBEDDING_BATCH_SIZE", 128),
+            concurrency=getattr(settings, "RAG_EMBEDDING_CONCURRENCY", 4),
+            requests_per_minute=getattr(settings, "RAG_EMBEDDING_RPM", 3000),
+            tokens_per_minute=getattr(settings, "RAG_EMBEDDING_TPM", 1000000),
+            max_retries=getattr(settings, "RAG_EMBEDDING_MAX_RETRIES", 5),
+            timeout=getattr(settings, "RAG_EMBEDDING_TIMEOUT", 30.0),
+            send_dimensions=dim is not None and dim != MODEL_DIMENSIONS.get(model or cls.default_model),
+        )
+
+    def _pool(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.concurrency, thread_name_prefix="embedding")
+            return self._executor
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, self.dim), dtype='float32')
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        if len(batches) == 1:
+            return self._embed_batch(batches[0])
+        return np.vstack(list(self._pool().map(self._embed_batch, batches)))
+
+    def _embed_batch(self, texts: List[str]) -> np.ndarray:
+        payload = {
+            "model": self.model,
+            # The API rejects empty inputs
+            "input": [text if text.strip() else " " for text in texts],
+            "encoding_format": "float",
+        }
+        if self.send_dimensions:
+            payload["dimensions"] = self.dim
+        tokens = sum(count_tokens(text) for text in texts)
+
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            # Every attempt goes through the rate limits, retries included
+            self.requests.acquire()
+            self.tokens.acquire(tokens)
+            try:
+                with span("embedding_request"):
+                    response = self.client.post("embeddings", json=payload)
+            except httpx.TransportError as e:
+                error = f"{type(e).__name__}: {e}"
+            else:
+                if response.status_code == 200:
+                    return self._parse(response, len(texts))
+                if response.status_code not in RETRY_STATUSES:
+                    raise EmbeddingError(
+                        f"Embedding request failed ({response.status_code}): {response.text[:200]}"
+                    )
+                error = f"HTTP {response.status_code}"
+                retry_after = response.headers.get("retry-after")
+            if attempt == self.max_retries:
+                break
+            delay = min(2 ** attempt, 60) * (0.5 + random.random() / 2)  # Backoff with jitter
+            try:
+                delay = max(delay, float(retry_after)) if retry_after else delay
+            except ValueError:
+                pass  # HTTP-date form: keep the backoff
+            count_event("embedding_retry")
+            trace(f"⏳ Embedding request failed ({error}), retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+            time.sleep(delay)
+        raise EmbeddingError(f"Embedding request failed after {self.max_retries + 1} attempts: {error}")
+
+    def _parse(self, response: httpx.Response, count: int) -> np.ndarray:
+        try:
+            data = sorted(response.json()["data"], key=lambda item: item["index"])
+            matrix = np.array([item["embedding"] for item in data], dtype='float32')
+        except (ValueError, KeyError, TypeError) as e:
+            raise EmbeddingError(f"Malformed embedding response: {e}")
+        if matrix.shape != (count, self.dim):
+            raise EmbeddingError(f"Expected {count} embeddings of dimension {self.dim}, got shape {matrix.shape}")
+        return _normalize(matrix)
+
+
+# -------------------------------------------------------------------
+# 3. Provider selection
+# -------------------------------------------------------------------
+
+# RAG_EMBEDDING_PROVIDER -> backend class
+PROVIDERS = {
+    "local": LocalHashEmbedding,
+    "openai": OpenAICompatibleEmbedding,
+}
+
+_provider = None
+_provider_key = None
+_provider_lock = threading.Lock()
+
+
+def create_provider(name: Optional[str] = None, model: Optional[str] = None,
+                    dim: Optional[int] = None) -> EmbeddingProvider:
+    """Build a provider by PROVIDERS name or dotted class path (defaults from settings)"""
+    name = name or getattr(settings, "RAG_EMBEDDING_PROVIDER", "local")
+    try:
+        provider_class = PROVIDERS.get(name) or import_string(name)
+    except ImportError:
+        raise ValueError(
+            f"Unknown embedding provider '{name}'. "
+            f"Choose one of: {', '.join(sorted(PROVIDERS))}, or a dotted path to an EmbeddingProvider"
+        )
+    return provider_class.from_settings(model, dim)
+
+
+def get_provider() -> EmbeddingProvider:
+    """The configured provider, shared by the process (rebuilt when its settings change)"""
+    global _provider, _provider_key
+    key = tuple(
+        getattr(settings, name, None) for name in (
+            "RAG_EMBEDDING_PROVIDER", "RAG_EMBEDDING_MODEL", "RAG_EMBEDDING_DIM", "RAG_EMBEDDING_BASE_URL"
+        )
+    )
+    with _provider_lock:
+        if _provider is None or key != _provider_key:
+            _provider = create_provider(
+                key[0], getattr(settings, "RAG_EMBEDDING_MODEL", None), getattr(settings, "RAG_EMBEDDING_DIM", None)
+            )
+            _provider_key = key
+            trace(f"🧬 Embedding provider: {_provider.describe()}")
+        return _provider
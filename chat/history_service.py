@@ -0,0 +1,166 @@
+# chat/history_service.py
+import threading
+from django.conf import settings
+from django.db import connection
+from langchain_core.messages import HumanMessage, SystemMessage
+
+from .models import ChatSession, Message
+from .metrics_service import trace
+
+# (user, assistant) exchanges sent to the model with each message
+HISTORY_EXCHANGES = getattr(settings, "RAG_HISTORY_EXCHANGES", 5)
+# Enough messages for the window plus an assistant reply cut off from its question
+_WINDOW_MESSAGES = 2 * HISTORY_EXCHANGES + 1
+# Most messages folded into the summary by one LLM call
+SUMMARY_MAX_FOLD = 50
+
+# Sessions with a summary update running in this process
+_summarizing = set()
+_summary_lock = threading.Lock()
+
+SUMMARY_PROMPT = """You maintain a running summary of a conversation between a user and an AI assistant.
+
+Current summary:
+{summary}
+
+New messages:
+{messages}
+
+Rewrite the summary so it also covers the new messages. Keep names, facts, decisions and open questions; drop small talk. Answer with the summary only, at most 200 words."""
+
+
+def pair_exchanges(messages):
+    """Turn an ordered list of messages into [(user_msg, assistant_msg), ...]"""
+    chat_history = []
+    temp_user_msg = None
+
+    for msg in messages:
+        if msg.role == "user":
+            temp_user_msg = msg.content
+        elif msg.role == "assistant" and temp_user_msg:
+            chat_history.append((temp_user_msg, msg.content))
+            temp_user_msg = None
+    return chat_history
+
+
+def _recent_messages(session, exclude_id=None):
+    """
+    Newest messages first, bounded: served by the (session, created_at)
+    index. With summaries on, messages not summarized yet are included even
+    beyond the window, up to SUMMARY_MAX_FOLD of them, so nothing falls
+    between the summary and the window while a batch builds up.
+    """
+    messages = Message.objects.filter(session=session).only("role", "content", "created_at")
+    if exclude_id is not None:
+        messages = messages.exclude(id=exclude_id)
+    if not summary_enabled():
+        return messages.order_by("-created_at", "-id")[:_WINDOW_MESSAGES]
+    if session.summary_until is not None:
+        messages = messages.filter(created_at__gt=session.summary_until)
+    return messages.order_by("-created_at", "-id")[:_WINDOW_MESSAGES + SUMMARY_MAX_FOLD]
+
+
+def _history(session, messages):
+    """(exchanges, messages waiting to be summarized) from newest-first messages"""
+    chat_history = pair_exchanges(reversed(messages))
+    if not summary_enabled():
+        return chat_history[-HISTORY_EXCHANGES:], 0
+    # The current message (excluded here) is part of the window too
+    return chat_history, max(len(messages) + 1 - _WINDOW_MESSAGES, 0)
+
+
+def load_recent_history(session, exclude_id=None):
+    """
+    The last HISTORY_EXCHANGES (user, assistant) pairs of a session, read
+    with one bounded query however long the session is, plus the older
+    pairs not covered by the summary yet. Returns (chat_history, number of
+    messages waiting to be folded into the summary).
+    """
+    return _history(session, list(_recent_messages(session, exclude_id)))
+
+
+async def aload_recent_history(session, exclude_id=None):
+    """Async version of load_recent_history"""
+    return _history(session, [msg async for msg in _recent_messages(session, exclude_id)])
+
+
+# -------------------------------------------------------------------
+# Rolling summary of the messages that left the window
+# -------------------------------------------------------------------
+
+def summary_enabled() -> bool:
+    return getattr(settings, "RAG_HISTORY_SUMMARY", False)
+
+
+def update_summary(session_id: int, llm=None) -> bool:
+    """
+    Fold messages that fell out of the history window into
+    ChatSession.summary, oldest first. Only runs once at least
+    RAG_HISTORY_SUMMARY_BATCH messages are pending, so most requests
+    cost no LLM call. Returns True when the summary was updated.
+    """
+    session = ChatSession.objects.only("summary", "summary_until").get(id=session_id)
+
+    # Newest message outside the window, None while the session is short
+    window_edge = (
+        Message.objects.filter(session_id=session_id)
+        .order_by("-created_at", "-id")
+        .values_list("created_at", flat=True)[_WINDOW_MESSAGES:_WINDOW_MESSAGES + 1]
+        .first()
+    )
+    if window_edge is None:
+        return False
+
+    pending = Message.objects.filter(session_id=session_id, created_at__lte=window_edge)
+    if session.summary_until is not None:
+        pending = pending.filter(created_at__gt=session.summary_until)
+    pending = list(pending.order_by("created_at", "id")[:SUMMARY_MAX_FOLD])
+    if len(pending) < getattr(settings, "RAG_HISTORY_SUMMARY_BATCH", 10):
+        return False
+    if pending[-1].role == "user":
+        pending.pop()  # Folded with its answer next time, so the pair stays whole
+    if not pending:
+        return False
+
+    if llm is None:
+        from .agent_service import llm
+    transcript = "\n".join(f"{msg.role.capitalize()}: {msg.content}" for msg in pending)
+    response = llm.invoke([
+        SystemMessage(content="You summarize conversations."),
+        HumanMessage(content=SUMMARY_PROMPT.format(
+            summary=session.summary or "(empty)", messages=transcript
+        )),
+    ])
+
+    # Only apply if no concurrent update moved the marker meanwhile
+    updated = ChatSession.objects.filter(
+        id=session_id, summary_until=session.summary_until
+    ).update(summary=response.content.strip(), summary_until=pending[-1].created_at)
+    if updated:
+        trace(f"📝 Folded {len(pending)} messages into the summary of session {session_id}")
+    return bool(updated)
+
+
+def update_summary_in_background(session_id: int, pending: int):
+    """
+    Run update_summary in a daemon thread when summaries are enabled and a
+    batch of messages is waiting, unless one already runs for the session
+    """
+    if not summary_enabled() or pending < getattr(settings, "RAG_HISTORY_SUMMARY_BATCH", 10):
+        return
+    with _summary_lock:
+        if session_id in _summarizing:
+            return
+        _summarizing.add(session_id)
+
+    def run():
+        try:
+            update_summary(session_id)
+        except Exception as e:
+            trace(f"❌ Summary update failed for session {session_id}: {e}")
+        finally:
+            with _summary_lock:
+                _summarizing.discard(session_id)
+            connection.close()  # This thread's own connection
+
+    threading.Thread(target=run, name=f"history-summary-{session_id}", daemon=True).start()
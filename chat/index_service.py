@@ -0,0 +1,809 @@
+# chat/index_service.py
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+import faiss
+import numpy as np
+from typing import List, Optional, Tuple
+from django.conf import settings
+
+from .lexical_service import LexicalIndex, Postings
+from .metrics_service import trace
+
+try:
+    import fcntl
+except ImportError:  # Windows: only in-process locking is available
+    fcntl = None
+
+# -------------------------------------------------------------------
+# 1. Index types
+# -------------------------------------------------------------------
+
+# RAG_INDEX_TYPE -> FAISS index factory string
+INDEX_FACTORIES = {
+    "flat": "Flat",
+    "ivf": "IVF{nlist},Flat",
+    "hnsw": "HNSW{hnsw_m},Flat",
+    # Compressed storage
+    "sq8": "SQ8",
+    "pq": "PQ{pq_m}x{pq_nbits}",
+    "ivfpq": "IVF{nlist},PQ{pq_m}x{pq_nbits}",
+}
+
+# Index types that must be trained before vectors can be added
+TRAINED_TYPES = {"ivf", "sq8", "pq", "ivfpq"}
+
+
+def get_index_type(index_type: Optional[str] = None) -> str:
+    """Return the requested index type, defaulting to settings.RAG_INDEX_TYPE"""
+    index_type = (index_type or getattr(settings, "RAG_INDEX_TYPE", "flat")).lower()
+    if index_type not in INDEX_FACTORIES:
+        raise ValueError(
+            f"Unknown index type '{index_type}'. "
+            f"Choose one of: {', '.join(sorted(INDEX_FACTORIES))}"
+        )
+    return index_type
+
+
+def _ivf_nlist(n_vectors: int) -> int:
+    """Number of IVF lists, capped so every list gets enough training points"""
+    nlist = getattr(settings, "RAG_IVF_NLIST", 1024)
+    return max(1, min(nlist, n_vectors // 39))
+
+
+def _pq_nbits(n_vectors: int) -> int:
+    """Bits per PQ code, capped so every centroid gets enough training points"""
+    nbits = getattr(settings, "RAG_PQ_NBITS", 8)
+    return max(1, min(nbits, int(np.log2(max(n_vectors // 39, 2)))))
+
+
+def create_index(dim: int, index_type: Optional[str] = None, n_vectors: int = 0):
+    """
+    Create an empty FAISS index of the configured type.
+    n_vectors is the size of the training set (used to size IVF lists
+    and PQ codebooks).
+    """
+    index_type = get_index_type(index_type)
+    pq_m = getattr(settings, "RAG_PQ_M", 96)
+    if "PQ" in INDEX_FACTORIES[index_type] and dim % pq_m:
+        raise ValueError(f"RAG_PQ_M={pq_m} must divide the embedding dimension {dim}")
+    factory = INDEX_FACTORIES[index_type].format(
+        nlist=_ivf_nlist(n_vectors),
+        hnsw_m=getattr(settings, "RAG_HNSW_M", 32),
+        pq_m=pq_m,
+        pq_nbits=_pq_nbits(n_vectors),
+    )
+    index = faiss.index_factory(dim, factory)
+    if index_type == "hnsw":
+        faiss.downcast_index(index).hnsw.efConstruction = getattr(
+            settings, "RAG_HNSW_EF_CONSTRUCTION", 200
+        )
+    apply_search_params(index)
+    return index
+
+
+def apply_search_params(index):
+    """Apply the nprobe / efSearch knobs from settings to a loaded index"""
+    params = faiss.ParameterSpace()
+    for name, setting, default in (
+        ("nprobe", "RAG_IVF_NPROBE", 16),
+        ("efSearch", "RAG_HNSW_EF_SEARCH", 64),
+    ):
+        try:
+            params.set_index_parameter(index, name, getattr(settings, setting, default))
+        except RuntimeError:
+            pass  # Parameter does not apply to this index type
+    return index
+
+
+# -------------------------------------------------------------------
+# 2. Building and evaluating
+# -------------------------------------------------------------------
+
+def export_vectors(index) -> Tuple[np.ndarray, np.ndarray]:
+    """Return (ids, vectors) for every vector stored in an index"""
+    if isinstance(index, SegmentedIndex):
+        return index.export()
+    if index.ntotal == 0:
+        return np.zeros(0, dtype='int64'), np.zeros((0, index.d), dtype='float32')
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.make_direct_map()
+    index = faiss.downcast_index(index)
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        ids = faiss.vector_to_array(index.id_map).astype('int64')
+        return ids, index.index.reconstruct_n(0, index.ntotal)
+    # Plain index: ids are positions
+    return np.arange(index.ntotal, dtype='int64'), index.reconstruct_n(0, index.ntotal)
+
+
+def _refill(template, ids: np.ndarray, vectors: np.ndarray):
+    """Id-mapped index of the same (already trained) type holding only ids/vectors"""
+    if isinstance(faiss.downcast_index(template), (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        template = faiss.downcast_index(template).index
+    inner = faiss.clone_index(template)
+    inner.reset()
+    index = faiss.IndexIDMap2(inner)
+    if len(ids):
+        index.add_with_ids(vectors, ids)
+    return apply_search_params(index)
+
+
+def as_id_mapped(index):
+    """Convert a positional index into an id-mapped one (ids = positions)"""
+    if isinstance(faiss.downcast_index(index), (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return index
+    return _refill(index, *export_vectors(index))
+
+
+def remove_vectors(index, ids: np.ndarray):
+    """Remove ids from an id-mapped index, rebuilding it when the type can't remove"""
+    if not len(ids):
+        return index
+    try:
+        index.remove_ids(faiss.IDSelectorBatch(np.asarray(ids, dtype='int64')))
+        return index
+    except RuntimeError:
+        pass  # e.g. HNSW graphs do not support removal
+    live_ids, vectors = export_vectors(index)
+    keep = ~np.isin(live_ids, ids)
+    return _refill(index, live_ids[keep], vectors[keep])
+
+
+def build_index(vectors: np.ndarray, index_type: Optional[str] = None,
+                ids: Optional[np.ndarray] = None, seed: int = 1234):
+    """
+    Create, train (if needed) and fill an id-mapped index of the given type.
+    ids default to positions.
+    """
+    index_type = get_index_type(index_type)
+    inner = create_index(vectors.shape[1], index_type, n_vectors=len(vectors))
+    if not inner.is_trained:
+        rng = np.random.default_rng(seed)
+        max_train = max(256 * _ivf_nlist(len(vectors)), 65536)
+        sample = vectors
+        if len(vectors) > max_train:
+            sample = vectors[rng.choice(len(vectors), max_train, replace=False)]
+        inner.train(sample)
+    if ids is None:
+        ids = np.arange(len(vectors), dtype='int64')
+    return _refill(inner, ids, vectors)
+
+
+# FAISS index class -> index type (subclasses first)
+INDEX_CLASSES = (
+    (faiss.IndexIVFPQ, "ivfpq"),
+    (faiss.IndexIVFFlat, "ivf"),
+    (faiss.IndexHNSWFlat, "hnsw"),
+    (faiss.IndexScalarQuantizer, "sq8"),
+    (faiss.IndexPQ, "pq"),
+    (faiss.IndexFlat, "flat"),
+)
+
+
+def index_type_of(index) -> Optional[str]:
+    """Index type (INDEX_FACTORIES key) of a built index, None when it is none of them"""
+    outer = faiss.downcast_index(index)
+    # outer stays referenced: it owns the inner index
+    inner = faiss.downcast_index(outer.index) if isinstance(outer, (faiss.IndexIDMap, faiss.IndexIDMap2)) else outer
+    for index_class, index_type in INDEX_CLASSES:
+        if isinstance(inner, index_class):
+            return index_type
+    return None
+
+
+def storage_stats(index) -> dict:
+    """Serialized size of an index and its compression against raw float32"""
+    if isinstance(index, SegmentedIndex):
+        # Segments are stored as raw float32
+        size = len(faiss.serialize_index(index.base)) + index.delta.ntotal * index.d * 4
+    else:
+        size = len(faiss.serialize_index(index))
+    raw = index.ntotal * index.d * 4
+    return {
+        "bytes": size,
+        "bytes_per_vector": size / max(index.ntotal, 1),
+        "compression": raw / size if size else 0.0,
+    }
+
+
+def measure_recall(index, vectors: np.ndarray, k: int = 10, n_queries: int = 100,
+                   ids: Optional[np.ndarray] = None, seed: int = 1234) -> dict:
+    """
+    Measure recall@k of an index against an exact flat index over the same
+    vectors (stored under ids, default positions), using a sample of the
+    stored vectors as queries.
+    """
+    n = len(vectors)
+    if n == 0:
+        return {"recall": 1.0, "k": k, "queries": 0, "exact_ms": 0.0, "approx_ms": 0.0}
+    k = min(k, n)
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.choice(n, min(n_queries, n), replace=False)]
+
+    exact = faiss.IndexIDMap(faiss.IndexFlatL2(vectors.shape[1]))
+    exact.add_with_ids(vectors, ids if ids is not None else np.arange(n, dtype='int64'))
+    start = time.perf_counter()
+    _, truth = exact.search(queries, k)
+    exact_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    _, found = index.search(queries, k)
+    approx_ms = (time.perf_counter() - start) * 1000
+
+    hits = sum(
+        len(set(expected) & set(got[got != -1]))
+        for expected, got in zip(truth, found)
+    )
+    return {
+        "recall": hits / float(truth.size),
+        "k": k,
+        "queries": len(queries),
+        "exact_ms": exact_ms / len(queries),
+        "approx_ms": approx_ms / len(queries),
+    }
+
+
+# -------------------------------------------------------------------
+# 3. Shared persistence (one writer, many memory-mapping readers)
+# -------------------------------------------------------------------
+#
+# On disk the store is a base snapshot (faiss_index.bin) plus append-only
+# segment files holding the vectors ingested since that snapshot, all
+# listed in faiss_index.meta.json. Ingesting a document writes one segment
+# and a new metadata file, so it costs O(document) rather than O(corpus).
+# Compaction folds the segments back into a new base snapshot.
+#
+# Every file is written to a temporary sibling and renamed into place, and
+# every publish bumps the generation in the metadata. Readers memory-map
+# the base read-only, keep the segments in a small in-memory index, and
+# reload when the generation changes; old mappings stay valid until they
+# are dropped.
+#
+# The BM25 postings of the chunk texts follow the same layout: a base file
+# (faiss_index.bm25.npz) plus one postings file per segment, keyed by
+# vector id so tombstones hide deleted chunks from both searches, and
+# folded into the base by the same compaction.
+
+# mmap flat codes and IVF lists where this FAISS build supports it
+MMAP_FLAGS = (
+    getattr(faiss, "IO_FLAG_MMAP", 0)
+    | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+    | faiss.IO_FLAG_READ_ONLY
+)
+
+# Results fetched per requested one while tombstones are pending; searches
+# widen by this factor until enough live results survive
+SEARCH_OVERFETCH = 2
+
+_process_lock = threading.RLock()
+
+
+def index_dir() -> str:
+    return str(getattr(settings, "RAG_INDEX_DIR", settings.BASE_DIR))
+
+
+def index_path() -> str:
+    return os.path.join(index_dir(), "faiss_index.bin")
+
+
+def meta_path() -> str:
+    return os.path.join(index_dir(), "faiss_index.meta.json")
+
+
+def postings_path() -> str:
+    return os.path.join(index_dir(), "faiss_index.bm25.npz")
+
+
+def _lock_path() -> str:
+    return os.path.join(index_dir(), "faiss_index.lock")
+
+
+def _segment_path(name: str) -> str:
+    return os.path.join(index_dir(), name)
+
+
+def read_meta() -> dict:
+    """Read the index metadata (generation 0 when nothing was published yet)"""
+    try:
+        with open(meta_path(), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {"generation": 0}
+
+
+_meta_cache = {"stat": None, "meta": {"generation": 0}}
+
+
+def current_generation() -> int:
+    """
+    Generation of the published index. Costs one stat() per call; the
+    metadata file is only re-read when it changed.
+    """
+    try:
+        st = os.stat(meta_path())
+        stat_key = (st.st_mtime_ns, st.st_size, st.st_ino)
+    except FileNotFoundError:
+        _meta_cache.update(stat=None, meta={"generation": 0})
+        return 0
+    if stat_key != _meta_cache["stat"]:
+        _meta_cache["meta"] = read_meta()
+        _meta_cache["stat"] = stat_key
+    return _meta_cache["meta"].get("generation", 0)
+
+
+def current_meta() -> dict:
+    """The published metadata, re-read only when it changed (do not modify)"""
+    current_generation()
+    return _meta_cache["meta"]
+
+
+def _atomic_write(path: str, write):
+    """Write a file through a temporary sibling, fsync it, then rename it in place"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        write(tmp_path)
+        with open(tmp_path, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def write_meta(meta: dict):
+    def write(tmp_path):
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+    _atomic_write(meta_path(), write)
+
+
+def _bump(meta: dict) -> dict:
+    meta["generation"] = meta.get("generation", 0) + 1
+    write_meta(meta)
+    return meta
+
+
+_lock_state = threading.local()
+
+
+@contextmanager
+def writer_lock():
+    """
+    Exclusive writer lock, held across threads (RLock) and processes
+    (flock on faiss_index.lock) for every read-modify-publish cycle.
+    Re-entrant within a thread.
+    """
+    with _process_lock:
+        depth = getattr(_lock_state, "depth", 0)
+        if fcntl is None or depth:
+            _lock_state.depth = depth + 1
+            try:
+                yield
+            finally:
+                _lock_state.depth = depth
+            return
+        os.makedirs(index_dir(), exist_ok=True)
+        with open(_lock_path(), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            _lock_state.depth = 1
+            try:
+                yield
+            finally:
+                _lock_state.depth = 0
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def open_index(path: Optional[str] = None, writable: bool = False):
+    """Read an index from disk, memory-mapped read-only unless writable"""
+    path = path or index_path()
+    if not writable:
+        try:
+            return apply_search_params(faiss.read_index(path, MMAP_FLAGS))
+        except RuntimeError:
+            pass  # Index type without mmap support: fall back to a private copy
+    return apply_search_params(faiss.read_index(path))
+
+
+def new_index(dim: int):
+    """Create an empty, id-mapped index of the configured type"""
+    trace("🆕 Creating new FAISS index...")
+    index_type = get_index_type()
+    if index_type in TRAINED_TYPES:
+        # Nothing to train on yet: start flat, rebuild_index converts it later
+        trace(f"   '{index_type}' needs training data, starting with a flat index")
+        index_type = "flat"
+    return apply_search_params(faiss.IndexIDMap2(create_index(dim, index_type)))
+
+
+def next_vector_id(meta: dict) -> int:
+    """First unused vector id according to the metadata"""
+    if "next_id" in meta:
+        return meta["next_id"]
+    if "ntotal" in meta:  # Written before segments existed
+        return meta["ntotal"]
+    if os.path.exists(index_path()):  # Snapshot without metadata
+        return int(open_index().ntotal)
+    return 0
+
+
+def _load_segment(name: str):
+    with np.load(_segment_path(name)) as data:
+        return data["ids"], data["vectors"]
+
+
+def _write_postings(path: str, postings: Postings):
+    def write(tmp_path):
+        with open(tmp_path, "wb") as f:
+            postings.save(f)
+    _atomic_write(path, write)
+
+
+def _remove_files(names):
+    for name in names:
+        try:
+            os.remove(_segment_path(name))
+        except FileNotFoundError:
+            pass
+
+
+def append_segment(first_id: int, vectors: np.ndarray, texts: Optional[List[str]] = None,
+                   embedding: Optional[dict] = None) -> int:
+    """
+    Persist vectors (ids first_id, first_id + 1, ...) as a new segment file
+    and publish it, with the BM25 postings of their texts when given.
+    embedding describes what produced the vectors (provider, model, dim).
+    Must be called with writer_lock() held. Returns the new generation.
+    """
+    os.makedirs(index_dir(), exist_ok=True)
+    meta = read_meta()
+    if first_id != next_vector_id(meta):
+        raise ValueError(f"Segment starts at {first_id}, expected {next_vector_id(meta)}")
+    ids = np.arange(first_id, first_id + len(vectors), dtype='int64')
+    name = f"faiss_index.seg-{meta.get('generation', 0) + 1:08d}.npz"
+
+    def write(tmp_path):
+        with open(tmp_path, "wb") as f:
+            np.savez(f, ids=ids, vectors=np.ascontiguousarray(vectors, dtype='float32'))
+    _atomic_write(_segment_path(name), write)
+    segment = {"file": name, "first_id": first_id, "count": len(vectors)}
+    if texts is not None:
+        segment["postings"] = name.replace(".npz", ".bm25.npz")
+        _write_postings(_segment_path(segment["postings"]), Postings.from_texts(ids, texts))
+
+    meta.setdefault("base_generation", 0)
+    meta.setdefault("base_ntotal", next_vector_id(meta))
+    meta["segments"] = meta.get("segments", []) + [segment]
+    meta["next_id"] = first_id + len(vectors)
+    if embedding is not None:
+        meta["embedding"] = embedding
+    return _bump(meta)["generation"]
+
+
+def _fold_postings(meta: dict, drop_ids) -> bool:
+    """
+    Merge the base postings and those of every segment into a new base
+    postings file, without the tombstoned ids and drop_ids.
+    Returns False when there are no postings at all.
+    """
+    names = [s["postings"] for s in meta.get("segments", []) if "postings" in s]
+    if not names and not os.path.exists(postings_path()):
+        return False
+    parts = [Postings.load(_segment_path(name)) for name in names]
+    if os.path.exists(postings_path()):
+        parts.insert(0, Postings.load(postings_path()))
+    dead = set(meta.get("tombstones", [])) | {int(i) for i in drop_ids}
+    _write_postings(postings_path(), Postings.merge(parts, dead))
+    return True
+
+
+def publish_index(index, drop_ids=(), embedding: Optional[dict] = None) -> int:
+    """
+    Atomically replace the base snapshot with a full index and drop all
+    segments and tombstones, folding the BM25 postings the same way
+    (without drop_ids). embedding, when given, replaces the recorded
+    description of the vectors. Must be called with writer_lock() held.
+    Returns the new generation.
+    """
+    os.makedirs(index_dir(), exist_ok=True)
+    meta = read_meta()
+    next_id = max(next_vector_id(meta), int(index.ntotal))
+    _atomic_write(index_path(), lambda tmp_path: faiss.write_index(index, tmp_path))
+    if _fold_postings(meta, drop_ids):
+        meta["lexical_generation"] = meta.get("generation", 0) + 1
+    old_segments = meta.get("segments", [])
+    meta.pop("ntotal", None)
+    meta["base_generation"] = meta.get("generation", 0) + 1
+    meta["base_ntotal"] = int(index.ntotal)
+    meta["next_id"] = next_id
+    meta["segments"] = []
+    meta["tombstones"] = []
+    if embedding is not None:
+        meta["embedding"] = embedding
+    generation = _bump(meta)["generation"]
+    _remove_files(name for segment in old_segments for name in (segment["file"], segment.get("postings")) if name)
+    return generation
+
+
+def publish_postings(postings: Postings) -> int:
+    """
+    Replace every BM25 postings file with postings covering the whole index
+    (used to build them for chunks indexed before they existed).
+    Must be called with writer_lock() held. Returns the new generation.
+    """
+    os.makedirs(index_dir(), exist_ok=True)
+    meta = read_meta()
+    _write_postings(postings_path(), postings)
+    old_postings = [segment.pop("postings") for segment in meta.get("segments", []) if "postings" in segment]
+    meta["lexical_generation"] = meta.get("generation", 0) + 1
+    generation = _bump(meta)["generation"]
+    _remove_files(old_postings)
+    return generation
+
+
+def add_tombstones(ids) -> Optional[int]:
+    """
+    Mark vector ids as deleted. Searches skip them right away and the next
+    compaction removes them from the index. Returns the new generation.
+    """
+    ids = {int(vector_id) for vector_id in ids}
+    if not ids:
+        return None
+    with writer_lock():
+        meta = read_meta()
+        meta["tombstones"] = sorted(ids | set(meta.get("tombstones", [])))
+        return _bump(meta)["generation"]
+
+
+def bump_generation() -> int:
+    """
+    Publish a new generation without changing the index, so every worker
+    drops what it cached for the previous one. Must be called with
+    writer_lock() held. Returns the new generation.
+    """
+    return _bump(read_meta())["generation"]
+
+
+def compact(dim: int, orphan_ids=()) -> Optional[int]:
+    """
+    Fold every segment into a new base snapshot and drop tombstoned vectors
+    (plus orphan_ids, vectors known to have no chunk row).
+    Returns the new generation, or None when there was nothing to compact.
+    """
+    with writer_lock():
+        meta = read_meta()
+        segments = meta.get("segments", [])
+        dead = np.array(
+            sorted(set(meta.get("tombstones", [])) | {int(i) for i in orphan_ids}),
+            dtype='int64'
+        )
+        if not segments and not len(dead):
+            return None
+        if os.path.exists(index_path()):
+            base = as_id_mapped(open_index(writable=True))
+        else:
+            base = new_index(dim)
+        base = remove_vectors(base, dead)
+        for segment in segments:
+            ids, vectors = _load_segment(segment["file"])
+            keep = ~np.isin(ids, dead)
+            if keep.any():
+                base.add_with_ids(vectors[keep], ids[keep])
+        trace(f"🗜️ Compacted {len(segments)} segments and {len(dead)} deleted vectors into the base index")
+        return publish_index(base, drop_ids=dead)
+
+
+_compaction_thread = None
+
+
+def maybe_compact_in_background(dim: int):
+    """Start a background compaction once enough segments or tombstones have piled up"""
+    global _compaction_thread
+    meta = read_meta()
+    segments = meta.get("segments", [])
+    pending = sum(segment["count"] for segment in segments)
+    if (len(segments) < getattr(settings, "RAG_COMPACT_SEGMENTS", 16)
+            and pending < getattr(settings, "RAG_COMPACT_VECTORS", 50000)
+            and len(meta.get("tombstones", [])) < getattr(settings, "RAG_COMPACT_TOMBSTONES", 10000)):
+        return
+    if _compaction_thread is not None and _compaction_thread.is_alive():
+        return
+
+    def run():
+        try:
+            compact(dim)
+        except Exception as e:
+            trace(f"❌ Background compaction failed: {e}")
+
+    _compaction_thread = threading.Thread(target=run, name="faiss-compaction", daemon=True)
+    _compaction_thread.start()
+
+
+def _search_live(index, x: np.ndarray, k: int, tombstones: np.ndarray):
+    """
+    Best k hits of one index that are not tombstoned (dead slots: label -1,
+    distance inf). Over-fetches SEARCH_OVERFETCH times k, widening only for
+    the queries where fewer than k live hits survive, rather than fetching
+    k + len(tombstones) for every query.
+    """
+    max_k = min(k + len(tombstones), max(index.ntotal, 1))
+    fetch_k = min(k * SEARCH_OVERFETCH if len(tombstones) else k, max_k)
+    rows = np.arange(len(x))
+    distances = np.full((len(x), k), np.inf, dtype='float32')
+    labels = np.full((len(x), k), -1, dtype='int64')
+    while True:
+        found_d, found_l = index.search(x[rows], fetch_k)
+        dead = found_l == -1
+        if len(tombstones):
+            dead |= np.isin(found_l, tombstones)
+        found_d = np.where(dead, np.inf, found_d)
+        order = np.argsort(found_d, axis=1, kind="stable")[:, :k]
+        found_d = np.take_along_axis(found_d, order, axis=1)
+        found_l = np.take_along_axis(np.where(dead, -1, found_l), order, axis=1)
+        width = found_l.shape[1]
+        distances[rows, :width], labels[rows, :width] = found_d, found_l
+        if fetch_k >= max_k:
+            return distances, labels
+        rows = rows[(found_l != -1).sum(axis=1) < k]
+        if not len(rows):
+            return distances, labels
+        fetch_k = min(fetch_k * SEARCH_OVERFETCH, max_k)
+
+
+# -------------------------------------------------------------------
+# 4. Reader view: base snapshot + in-memory segments
+# -------------------------------------------------------------------
+
+class SegmentedIndex:
+    """
+    Read-only view over the memory-mapped base index and the published
+    segments, with tombstoned ids filtered out. Exposes the parts of the
+    FAISS index API the RAG code uses (ntotal, d, search), plus BM25
+    search over the postings of the same chunks (search_lexical).
+    """
+
+    def __init__(self, dim: int):
+        self.d = dim
+        self.base = None
+        self.generation = None
+        self.base_generation = None
+        self.tombstones = np.zeros(0, dtype='int64')
+        self.delta = self._empty_delta()
+        self.segments = frozenset()
+        self.lexical = LexicalIndex()
+        self.lexical_generation = None
+        self.postings = frozenset()
+        self._lock = threading.Lock()
+
+    def _empty_delta(self):
+        return faiss.IndexIDMap2(faiss.IndexFlatL2(self.d))
+
+    @property
+    def ntotal(self) -> int:
+        """Number of live vectors"""
+        base_total = self.base.ntotal if self.base is not None else 0
+        return max(base_total + self.delta.ntotal - len(self.tombstones), 0)
+
+    def refresh(self):
+        """Pick up a newer published generation, loading only what changed"""
+        if current_generation() == self.generation:
+            return self
+        # One thread loads, concurrent callers wait for it instead of loading twice
+        with self._lock:
+            for attempt in range(5):
+                if current_generation() == self.generation:
+                    return self
+                try:
+                    if self._load(read_meta()):
+                        return self
+                except FileNotFoundError:
+                    pass  # A compaction replaced the files under us
+                time.sleep(0.05 * attempt)  # Let a publish in progress finish, then retry
+        raise RuntimeError("FAISS index kept changing while loading")
+
+    def _load(self, meta: dict) -> bool:
+        """
+        Build the new state aside and swap it in, so searches running in
+        other threads never see a half-updated delta (copy-on-write).
+        Returns False, leaving the state as it was, when a compaction
+        published meanwhile: the base opened may already hold the segment
+        vectors just loaded.
+        """
+        base, delta, segments = self.base, self.delta, self.segments
+        base_generation = meta.get("base_generation", 0)
+        opened = False
+        if base is None or base_generation != self.base_generation:
+            path = index_path()
+            if os.path.exists(path):
+                trace(f"📁 Loading FAISS index from disk (generation {meta.get('generation', 0)})...")
+                base = open_index(path)
+                opened = True
+            else:
+                base = new_index(self.d)
+            delta, segments = self._empty_delta(), frozenset()
+        new_segments = [s["file"] for s in meta.get("segments", []) if s["file"] not in segments]
+        if new_segments:
+            delta = faiss.clone_index(delta) if delta is self.delta else delta
+            for segment in new_segments:
+                ids, vectors = _load_segment(segment)
+                delta.add_with_ids(vectors, ids)
+            segments = segments | set(new_segments)
+        lexical, lexical_generation, postings = self._load_postings(meta)
+        tombstones = np.array(meta.get("tombstones", []), dtype='int64')
+
+        # The base file is replaced before the metadata, so also check that
+        # the base opened is the one the metadata describes
+        latest = read_meta()
+        if (latest.get("base_generation", 0) != base_generation
+                or latest.get("lexical_generation", 0) != lexical_generation
+                or (opened and base.ntotal != meta.get("base_ntotal", base.ntotal))):
+            return False
+
+        self.base, self.delta, self.segments, self.tombstones = base, delta, segments, tombstones
+        self.lexical, self.lexical_generation, self.postings = lexical, lexical_generation, postings
+        self.base_generation = base_generation
+        self.generation = meta.get("generation", 0)
+        return True
+
+    def _load_postings(self, meta: dict):
+        """New (lexical index, lexical generation, loaded postings files), same rules as the vectors"""
+        lexical, postings = self.lexical, self.postings
+        lexical_generation = meta.get("lexical_generation", 0)
+        if lexical_generation != self.lexical_generation:
+            path = postings_path()
+            lexical = LexicalIndex([Postings.load(path)] if os.path.exists(path) else [])
+            postings = frozenset()
+        for segment in meta.get("segments", []):
+            name = segment.get("postings")
+            if name and name not in postings:
+                lexical = lexical.with_part(Postings.load(_segment_path(name)))
+                postings = postings | {name}
+        return lexical, lexical_generation, postings
+
+    def search_lexical(self, query: str, k: int) -> List[Tuple[int, float]]:
+        """Best k (vector_id, BM25 score) pairs, tombstoned ids excluded"""
+        lexical, tombstones = self.lexical, self.tombstones
+        return lexical.search(query, k, exclude=tombstones)
+
+    def search(self, x: np.ndarray, k: int):
+        """Search base and segments, drop tombstoned ids and merge by distance"""
+        base, delta, tombstones = self.base, self.delta, self.tombstones
+        results = [_search_live(base, x, k, tombstones)]
+        if delta.ntotal:
+            results.append(_search_live(delta, x, k, tombstones))
+        distances = np.hstack([distances for distances, _ in results])
+        labels = np.hstack([labels for _, labels in results])
+
+        order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+        distances = np.take_along_axis(distances, order, axis=1)
+        labels = np.take_along_axis(labels, order, axis=1)
+        # Empty slots look like FAISS's own: label -1, largest distance
+        distances[labels == -1] = np.finfo('float32').max
+        return distances.astype('float32'), labels
+
+    def reconstruct(self, ids) -> np.ndarray:
+        """
+        Stored vectors of live ids, one row per id. Raises RuntimeError when
+        the base index type cannot return its vectors (e.g. IVF, PQ).
+        """
+        base, delta = self.base, self.delta
+        vectors = np.zeros((len(ids), self.d), dtype='float32')
+        for row, vector_id in enumerate(ids):
+            try:
+                vectors[row] = delta.reconstruct(int(vector_id))
+            except RuntimeError:  # Not in a segment
+                vectors[row] = base.reconstruct(int(vector_id))
+        return vectors
+
+    def export(self) -> Tuple[np.ndarray, np.ndarray]:
+        """(ids, vectors) of every live vector, sorted by id"""
+        ids, vectors = export_vectors(self.base)
+        if self.delta.ntotal:
+            ids = np.concatenate([ids, faiss.vector_to_array(self.delta.id_map)])
+            vectors = np.vstack([vectors, self.delta.index.reconstruct_n(0, self.delta.ntotal)])
+        keep = ~np.isin(ids, self.tombstones)
+        ids, vectors = ids[keep], vectors[keep]
+        order = np.argsort(ids, kind="stable")
+        return ids[order], vectors[order]
@@ -0,0 +1,251 @@
+# chat/ingest_service.py
+import os
+import time
+import uuid
+import socket
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .metrics_service import trace
+from .models import Document, IngestionJob
+from .pipeline_service import EXTRACTORS, PipelineStage, extract_text, iter_batches, iter_chunks
+from .rag_service import delete_document, embed_chunks, index_document_batches
+
+# File types the ingestion pipeline can extract text from (.pdf needs pypdf)
+SUPPORTED_EXTENSIONS = set(EXTRACTORS)
+HASH_BLOCK_SIZE = 1024 * 1024
+
+_executor = None
+_executor_lock = threading.Lock()
+_submitted = set()  # Ids of the jobs handed to this process's pool
+_recovered = False
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """Process-local worker pool, started on first use"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, "RAG_INGEST_WORKERS", 2),
+                thread_name_prefix="ingest"
+            )
+    return _executor
+
+
+def worker_id() -> str:
+    """Identifies this process on the jobs it runs (read per call: servers fork after import)"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _submit(job_id: int):
+    _submitted.add(job_id)
+    _get_executor().submit(run_job, job_id)
+
+
+def upload_dir() -> str:
+    return str(getattr(settings, "RAG_UPLOAD_DIR", os.path.join(settings.BASE_DIR, "uploads")))
+
+
+def is_supported(file_name: str) -> bool:
+    return os.path.splitext(file_name)[1].lower() in SUPPORTED_EXTENSIONS
+
+
+def save_upload(uploaded_file) -> str:
+    """Copy an upload to RAG_UPLOAD_DIR piece by piece (never whole in memory)"""
+    os.makedirs(upload_dir(), exist_ok=True)
+    extension = os.path.splitext(uploaded_file.name)[1].lower()
+    path = os.path.join(upload_dir(), f"{uuid.uuid4().hex}{extension}")
+    with open(path, "wb") as f:
+        for piece in uploaded_file.chunks():
+            f.write(piece)
+    return path
+
+
+def enqueue_upload(uploaded_file) -> IngestionJob:
+    """Save an uploaded file and queue it for indexing; returns at once"""
+    job = IngestionJob.objects.create(
+        file_name=uploaded_file.name,
+        file_path=save_upload(uploaded_file),
+        worker=worker_id(),
+    )
+    # Workers must not pick up a job row the request may still roll back
+    transaction.on_commit(lambda: _submit(job.id))
+    trace(f"📥 Queued ingestion job {job.id} for {uploaded_file.name}")
+    return job
+
+
+# -------------------------------------------------------------------
+# Jobs left behind by a stopped process
+# -------------------------------------------------------------------
+
+def _orphaned(job: IngestionJob) -> bool:
+    """
+    Whether the process a queued or running job belongs to is gone. Jobs of
+    other machines count as alive: their own restart recovers them.
+    """
+    host, _, pid = job.worker.rpartition(":")
+    if not pid.isdigit():
+        return True  # Queued before jobs recorded their process
+    if host != socket.gethostname():
+        return False
+    if int(pid) == os.getpid():
+        return job.id not in _submitted  # A previous process had the same pid
+    if os.name == "nt":
+        return False  # os.kill would terminate the process instead of probing it
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        pass  # Exists, owned by another user
+    return False
+
+
+def recover_jobs() -> int:
+    """
+    Take over the queued and running jobs whose process stopped: requeue
+    them here from their saved upload, after dropping any half-indexed
+    document, or mark them failed when the upload is gone. Returns the
+    number of jobs recovered.
+    """
+    recovered = 0
+    for job in IngestionJob.objects.filter(status__in=("queued", "running")):
+        if not _orphaned(job):
+            continue
+        # Only one process takes over a job
+        claimed = IngestionJob.objects.filter(id=job.id, status=job.status, worker=job.worker).update(
+            status="queued", worker=worker_id(), document=None, total_chunks=None, processed_chunks=0,
+            started_at=None,
+        )
+        if not claimed:
+            continue
+        recovered += 1
+        if job.document_id is not None:
+            document = Document.objects.filter(id=job.document_id).first()
+            if document is not None:
+                delete_document(document)
+        if os.path.exists(job.file_path):
+            trace(f"♻️ Requeued ingestion job {job.id} ({job.file_name}) left {job.status} by a stopped process")
+            _submit(job.id)
+        else:
+            trace(f"❌ Ingestion job {job.id} lost its upload when its process stopped")
+            IngestionJob.objects.filter(id=job.id).update(
+                status="failed", error="The upload was lost when the worker process stopped; upload it again",
+                finished_at=timezone.now(),
+            )
+    return recovered
+
+
+def recover_jobs_once():
+    """recover_jobs on the first call in this process (i.e. after a restart)"""
+    global _recovered
+    with _executor_lock:
+        if _recovered:
+            return
+        _recovered = True
+    try:
+        recover_jobs()
+    except Exception as e:
+        trace(f"❌ Recovering ingestion jobs failed: {e}")
+
+
+def build_pipeline(path: str):
+    """
+    extract + chunk -> embed stages for a file, each in its own thread with
+    a bounded queue in between; the caller consumes (texts, embeddings)
+    batches and is the index stage. Memory stays bounded by the queue sizes
+    whatever the file size.
+    """
+    extract = PipelineStage("extract", iter_batches(iter_chunks(extract_text(path))))
+    embed = PipelineStage(
+        "embed", extract, fn=lambda batch: (batch, embed_chunks(batch)), size=lambda item: len(item[0])
+    )
+    return extract, embed
+
+
+def file_hash(path: str) -> str:
+    """sha256 of a file's bytes, read block by block"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def prepare_file(path: str, skip_hashes=frozenset()):
+    """
+    Hash, extract, chunk and embed one file without writing anything, so it
+    can run in a worker process. Returns (content_hash, chunks,
+    embed_chunks(chunks)), with chunks None when the hash is in skip_hashes.
+    """
+    content_hash = file_hash(path)
+    if content_hash in skip_hashes:
+        return content_hash, None, None
+    chunks = list(iter_chunks(extract_text(path)))
+    return content_hash, chunks, embed_chunks(chunks)
+
+
+def pipeline_stats(extract, embed, index_seconds: float, total_seconds: float) -> dict:
+    """Per-stage throughput in chunks per second of busy time"""
+    index = {
+        "items": embed.items,
+        "units": embed.units,
+        "busy_seconds": round(index_seconds, 3),
+        "units_per_second": round(embed.units / index_seconds, 1) if index_seconds else None,
+    }
+    return {
+        "extract": extract.stats(),
+        "embed": embed.stats(),
+        "index": index,
+        "total_seconds": round(total_seconds, 3),
+    }
+
+
+def run_job(job_id: int):
+    """Stream one uploaded file into the index, updating the job's progress after every batch"""
+    job = IngestionJob.objects.get(id=job_id)
+    IngestionJob.objects.filter(id=job_id).update(status="running", started_at=timezone.now())
+    trace(f"⚙️ Ingestion job {job_id} started: {job.file_name}")
+    document = None
+    started = time.perf_counter()
+    extract = embed = None
+
+    def on_batch(chunks_done, batch_document):
+        nonlocal document
+        document = batch_document
+        progress = {"processed_chunks": chunks_done, "document": batch_document}
+        if extract.finished:
+            progress["total_chunks"] = extract.units
+        IngestionJob.objects.filter(id=job_id).update(**progress)
+
+    try:
+        extract, embed = build_pipeline(job.file_path)
+        document = index_document_batches(job.file_name, embed, on_batch)
+        total_seconds = time.perf_counter() - started
+        stats = pipeline_stats(extract, embed, total_seconds - embed.consumer_wait_seconds, total_seconds)
+        IngestionJob.objects.filter(id=job_id).update(
+            status="done", document=document, total_chunks=embed.units, processed_chunks=embed.units,
+            stats=stats, finished_at=timezone.now()
+        )
+        trace(f"✅ Ingestion job {job_id} done: "
+              + ", ".join(f"{name} {stage['units_per_second']} chunks/s"
+                          for name, stage in stats.items() if isinstance(stage, dict)))
+    except Exception as e:
+        trace(f"❌ Ingestion job {job_id} failed: {e}")
+        # Don't leave a half-indexed document searchable
+        if document is not None and document.pk is not None:
+            delete_document(document)
+        IngestionJob.objects.filter(id=job_id).update(
+            status="failed", error=str(e), finished_at=timezone.now()
+        )
+    finally:
+        try:
+            os.remove(job.file_path)
+        except OSError:
+            pass
+        connection.close()  # This worker thread's own connection
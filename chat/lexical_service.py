@@ -0,0 +1,224 @@
+# chat/lexical_service.py
+import re
+import math
+from collections import Counter, defaultdict
+from typing import Iterable, List, Optional, Sequence, Tuple
+import numpy as np
+from django.conf import settings
+
+MAX_TERM_LENGTH = 64  # Longer tokens (hashes, base64 blobs) are not indexed
+
+# Words, keeping codes, versions and paths ("ab-1234", "v2.1.0", "err_conn_reset") whole
+_TOKEN_RE = re.compile(r"\w+(?:[-./:]\w+)*")
+_PART_RE = re.compile(r"[^\W_]+")
+
+STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have if in into is it its no not of on or "
+    "so such that the their then there these they this to was were will with".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lowercased BM25 terms of a text. Compound tokens are indexed whole and
+    also split into their parts, so "E-1234" matches both "e-1234" and "1234".
+    """
+    terms = []
+    for token in _TOKEN_RE.findall(text.lower()):
+        if len(token) > MAX_TERM_LENGTH:
+            continue
+        parts = _PART_RE.findall(token)
+        if len(parts) > 1:
+            terms.append(token)
+        terms.extend(part for part in parts if part not in STOPWORDS)
+    return terms
+
+
+class Postings:
+    """
+    Inverted index of a set of chunks in CSR layout: the chunks containing
+    terms[i] are ids[offsets[i]:offsets[i + 1]], with their term
+    frequencies in tfs; doc_ids (sorted) and doc_lengths hold each chunk's
+    length in terms. Ids are FAISS vector ids, so the tombstones of the
+    vector index apply to the postings as well.
+    """
+
+    def __init__(self, terms: Sequence[str], offsets: np.ndarray, ids: np.ndarray, tfs: np.ndarray,
+                 doc_ids: np.ndarray, doc_lengths: np.ndarray):
+        self.terms = list(terms)
+        self.term_index = {term: i for i, term in enumerate(self.terms)}
+        self.offsets = offsets
+        self.ids = ids
+        self.tfs = tfs
+        self.doc_ids = doc_ids
+        self.doc_lengths = doc_lengths
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    @classmethod
+    def empty(cls) -> "Postings":
+        return cls([], np.zeros(1, dtype='int64'), np.zeros(0, dtype='int64'), np.zeros(0, dtype='uint16'),
+                   np.zeros(0, dtype='int64'), np.zeros(0, dtype='int32'))
+
+    @classmethod
+    def from_texts(cls, ids: Iterable[int], texts: Iterable[str]) -> "Postings":
+        postings = defaultdict(list)
+        doc_ids, doc_lengths = [], []
+        for vector_id, text in zip(ids, texts):
+            terms = tokenize(text)
+            doc_ids.append(int(vector_id))
+            doc_lengths.append(len(terms))
+            for term, tf in Counter(terms).items():
+                postings[term].append((int(vector_id), tf))
+
+        terms = sorted(postings)
+        lists = [sorted(postings[term]) for term in terms]
+        offsets = np.zeros(len(terms) + 1, dtype='int64')
+        offsets[1:] = np.cumsum([len(entries) for entries in lists])
+        flat = [entry for entries in lists for entry in entries]
+        order = np.argsort(np.array(doc_ids, dtype='int64'), kind="stable")
+        return cls(
+            terms,
+            offsets,
+            np.array([vector_id for vector_id, _ in flat], dtype='int64'),
+            np.minimum([tf for _, tf in flat], np.iinfo('uint16').max).astype('uint16'),
+            np.array(doc_ids, dtype='int64')[order],
+            np.array(doc_lengths, dtype='int32')[order],
+        )
+
+    @classmethod
+    def merge(cls, parts: Sequence["Postings"], drop_ids: Iterable[int] = ()) -> "Postings":
+        """One Postings holding every part, without the chunks in drop_ids"""
+        parts = [part for part in parts if len(part)]
+        if not parts:
+            return cls.empty()
+        drop = np.array(sorted({int(i) for i in drop_ids}), dtype='int64')
+
+        vocabulary, inverse = np.unique(
+            np.array([term for part in parts for term in part.terms], dtype=object), return_inverse=True
+        )
+        term_ids, ids, tfs = [], [], []
+        start = 0
+        for part in parts:
+            part_terms = inverse[start:start + len(part.terms)]
+            start += len(part.terms)
+            term_ids.append(np.repeat(part_terms, np.diff(part.offsets)))
+            ids.append(part.ids)
+            tfs.append(part.tfs)
+        term_ids, ids, tfs = np.concatenate(term_ids), np.concatenate(ids), np.concatenate(tfs)
+        doc_ids = np.concatenate([part.doc_ids for part in parts])
+        doc_lengths = np.concatenate([part.doc_lengths for part in parts])
+
+        if len(drop):
+            keep = ~np.isin(ids, drop)
+            term_ids, ids, tfs = term_ids[keep], ids[keep], tfs[keep]
+            keep = ~np.isin(doc_ids, drop)
+            doc_ids, doc_lengths = doc_ids[keep], doc_lengths[keep]
+
+        order = np.lexsort((ids, term_ids))
+        term_ids, ids, tfs = term_ids[order], ids[order], tfs[order]
+        # Terms whose every posting was dropped disappear
+        used = np.unique(term_ids)
+        counts = np.bincount(np.searchsorted(used, term_ids), minlength=len(used))
+        offsets = np.zeros(len(used) + 1, dtype='int64')
+        offsets[1:] = np.cumsum(counts)
+        order = np.argsort(doc_ids, kind="stable")
+        return cls(vocabulary[used].tolist(), offsets, ids, tfs, doc_ids[order], doc_lengths[order])
+
+    def save(self, f):
+        """Write to an open binary file (np.savez_compressed)"""
+        np.savez_compressed(
+            f,
+            terms=np.frombuffer("\n".join(self.terms).encode("utf-8"), dtype='uint8'),
+            offsets=self.offsets,
+            ids=self.ids,
+            tfs=self.tfs,
+            doc_ids=self.doc_ids,
+            doc_lengths=self.doc_lengths,
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "Postings":
+        with np.load(path) as data:
+            blob = data["terms"].tobytes().decode("utf-8")
+            return cls(
+                blob.split("\n") if blob else [],
+                data["offsets"], data["ids"], data["tfs"], data["doc_ids"], data["doc_lengths"],
+            )
+
+
+class LexicalIndex:
+    """
+    Read-only BM25 search over several Postings (a base snapshot and the
+    segments appended since). Deleted chunks still count in the corpus
+    statistics until compaction drops them from the postings.
+    """
+
+    def __init__(self, parts: Sequence[Postings] = ()):
+        self.parts = tuple(parts)
+        self.n_docs = sum(len(part) for part in self.parts)
+        self.total_length = sum(int(part.doc_lengths.sum()) for part in self.parts)
+
+    def with_part(self, part: Postings) -> "LexicalIndex":
+        return LexicalIndex(self.parts + (part,))
+
+    def stats(self) -> dict:
+        return {"chunks": self.n_docs, "parts": len(self.parts)}
+
+    def search(self, query: str, k: int, exclude: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """Best k (vector_id, BM25 score) pairs for the query, best first"""
+        terms = set(tokenize(query))
+        if not terms or not self.n_docs or k <= 0:
+            return []
+        k1 = getattr(settings, "RAG_BM25_K1", 1.2)
+        b = getattr(settings, "RAG_BM25_B", 0.75)
+        avgdl = self.total_length / self.n_docs or 1.0
+
+        matches = []  # (term, part, start, end)
+        df = Counter()
+        for term in terms:
+            for part in self.parts:
+                i = part.term_index.get(term)
+                if i is not None:
+                    start, end = int(part.offsets[i]), int(part.offsets[i + 1])
+                    matches.append((term, part, start, end))
+                    df[term] += end - start
+        if not matches:
+            return []
+
+        ids, scores = [], []
+        for term, part, start, end in matches:
+            idf = math.log(1 + (self.n_docs - df[term] + 0.5) / (df[term] + 0.5))
+            term_ids = part.ids[start:end]
+            tf = part.tfs[start:end].astype('float32')
+            dl = part.doc_lengths[np.searchsorted(part.doc_ids, term_ids)]
+            ids.append(term_ids)
+            scores.append(idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * dl / avgdl)))
+        unique_ids, inverse = np.unique(np.concatenate(ids), return_inverse=True)
+        totals = np.bincount(inverse, weights=np.concatenate(scores))
+
+        if exclude is not None and len(exclude):
+            keep = ~np.isin(unique_ids, exclude)
+            unique_ids, totals = unique_ids[keep], totals[keep]
+        if len(totals) > k:
+            top = np.argpartition(-totals, k)[:k]
+            unique_ids, totals = unique_ids[top], totals[top]
+        order = np.argsort(-totals, kind="stable")
+        return [(int(unique_ids[i]), float(totals[i])) for i in order]
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Tuple[float, Sequence[int]]], k: Optional[int] = None
+                           ) -> List[Tuple[int, float]]:
+    """
+    Fuse ranked id lists given as (weight, ids) pairs: each id scores
+    sum(weight / (k + rank)) over the lists it appears in (rank from 1).
+    Returns (id, score) pairs, best first.
+    """
+    if k is None:
+        k = getattr(settings, "RAG_RRF_K", 60)
+    scores = {}
+    for weight, ids in rankings:
+        for rank, vector_id in enumerate(ids, start=1):
+            scores[vector_id] = scores.get(vector_id, 0.0) + weight / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
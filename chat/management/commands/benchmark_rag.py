@@ -0,0 +1,335 @@
+import os
+import sys
+import json
+import time
+import random
+import platform
+import tempfile
+import subprocess
+from contextlib import redirect_stdout
+
+import faiss
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Max
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from chat import rag_service
+from chat.embedding_service import get_provider
+from chat.index_service import (
+    INDEX_FACTORIES, build_index, compact, export_vectors, measure_recall, next_vector_id, read_meta,
+    storage_stats, write_meta
+)
+from chat.models import ChunkEmbedding, Document, DocumentChunk
+
+try:
+    import resource  # Unix only
+except ImportError:
+    resource = None
+
+# Gap between the real vector ids and those of the benchmark chunks
+BENCHMARK_ID_OFFSET = 1 << 30
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, or None where unknown"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def percentiles(samples_ms):
+    samples = np.asarray(samples_ms)
+    return {
+        "mean_ms": round(float(samples.mean()), 3),
+        "p50_ms": round(float(np.percentile(samples, 50)), 3),
+        "p99_ms": round(float(np.percentile(samples, 99)), 3),
+    }
+
+
+def make_corpus(n_docs, n_words, seed):
+    """
+    Deterministic synthetic documents: made-up words drawn with a Zipf-like
+    distribution, grouped into sentences and paragraphs
+    """
+    rng = random.Random(seed)
+    syllables = ["ka", "lo", "mi", "ne", "ru", "sa", "ti", "vo", "ze", "pa", "qu", "xi", "do", "fe", "gu"]
+    vocabulary = sorted({
+        "".join(rng.choice(syllables) for _ in range(rng.randint(2, 4))) for _ in range(5000)
+    })
+    rng.shuffle(vocabulary)
+    weights = [1.0 / (rank + 1) for rank in range(len(vocabulary))]
+
+    documents = []
+    for _ in range(n_docs):
+        words = rng.choices(vocabulary, weights, k=n_words)
+        paragraphs, sentence, paragraph = [], [], []
+        for word in words:
+            sentence.append(word)
+            if len(sentence) >= rng.randint(8, 20):
+                paragraph.append(" ".join(sentence).capitalize() + ".")
+                sentence = []
+                if len(paragraph) >= rng.randint(3, 8):
+                    paragraphs.append(" ".join(paragraph))
+                    paragraph = []
+        paragraph.append(" ".join(sentence))
+        paragraphs.append(" ".join(paragraph))
+        documents.append("\n\n".join(paragraphs))
+    return documents
+
+
+def make_queries(documents, n_queries, seed):
+    """(query, index of the source document): short word windows taken from the corpus"""
+    rng = random.Random(seed + 1)
+    queries = []
+    for _ in range(n_queries):
+        doc = rng.randrange(len(documents))
+        words = documents[doc].split()
+        start = rng.randrange(max(len(words) - 8, 1))
+        queries.append((" ".join(words[start:start + 8]), doc))
+    return queries
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark embedding, ingestion, search latency and recall@k per index type '
+        'on a synthetic corpus, and print (or save) the results as JSON. Runs on a '
+        'temporary index; the rows it writes are deleted at the end, real data is not touched.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--docs', type=int, default=200, help='Synthetic documents to ingest')
+        parser.add_argument('--words', type=int, default=800, help='Words per document')
+        parser.add_argument('--queries', type=int, default=200, help='Search queries to time')
+        parser.add_argument('--k', type=int, default=4, help='Results per search (k of recall@k)')
+        parser.add_argument(
+            '--index-types',
+            nargs='*',
+            choices=sorted(INDEX_FACTORIES),
+            default=sorted(INDEX_FACTORIES),
+            help='Index types to compare (default: all)'
+        )
+        parser.add_argument('--seed', type=int, default=42, help='Seed of the synthetic corpus')
+        parser.add_argument('--output', type=str, help='Write the JSON results to this file')
+
+    def handle(self, *args, **options):
+        if options['docs'] < 1 or options['queries'] < 1:
+            raise CommandError("--docs and --queries must be at least 1")
+
+        documents = make_corpus(options['docs'], options['words'], options['seed'])
+        queries = make_queries(documents, options['queries'], options['seed'])
+        results = {"meta": self.meta(options), "peak_rss_mb": {"start": peak_rss_mb()}}
+
+        real_next_id = next_vector_id(read_meta())
+        # A throwaway index, no background compaction, no cached answers
+        with tempfile.TemporaryDirectory() as index_dir, override_settings(
+            RAG_INDEX_DIR=index_dir,
+            RAG_COMPACT_SEGMENTS=sys.maxsize,
+            RAG_COMPACT_VECTORS=sys.maxsize,
+            RAG_COMPACT_TOMBSTONES=sys.maxsize,
+            RAG_RESPONSE_CACHE=False,
+        ):
+            # Each write commits on its own (no long transaction holding the
+            # database write lock from the app), so the rows are deleted after
+            first_id = self.first_vector_id(real_next_id)
+            write_meta({"generation": 0, "next_id": first_id})
+            self.reset_state()
+            self.document_ids = []
+            try:
+                self.run(documents, queries, options, results)
+            finally:
+                self.cleanup(first_id)
+                self.reset_state()
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], "w", encoding="utf-8") as f:
+                f.write(output + "\n")
+            self.summarize(results)
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+        else:
+            self.stdout.write(output)
+
+    def first_vector_id(self, real_next_id):
+        """
+        First vector id of the benchmark chunks: far above the ids of the
+        real index and chunk rows, so the app can keep indexing meanwhile
+        without the two colliding
+        """
+        last_ids = [
+            model.objects.aggregate(last=Max("vector_id"))["last"]
+            for model in (DocumentChunk, ChunkEmbedding)
+        ]
+        last_id = max([real_next_id - 1] + [last for last in last_ids if last is not None])
+        return last_id + 1 + BENCHMARK_ID_OFFSET
+
+    def cleanup(self, first_id):
+        """Delete the rows the benchmark wrote, in one short transaction"""
+        with transaction.atomic():
+            # Chunks first, so deleting the documents has no vectors left to tombstone
+            DocumentChunk.objects.filter(vector_id__gte=first_id).delete()
+            ChunkEmbedding.objects.filter(vector_id__gte=first_id).delete()
+            Document.objects.filter(id__in=self.document_ids).delete()
+
+    def reset_state(self):
+        """Forget the loaded index and cached lookups (the benchmark swaps the index dir)"""
+        rag_service._index = None
+        rag_service._chunk_store.clear()
+        rag_service._chunk_store_generation = None
+        rag_service._embedding_cache.clear()
+        rag_service._result_cache.clear()
+        rag_service._result_cache_generation = None
+        rag_service._index_providers.clear()
+
+    def run(self, documents, queries, options, results):
+        with open(os.devnull, "w") as quiet:  # The services print a line per step
+            self.measure(documents, queries, options, results, quiet)
+
+    def measure(self, documents, queries, options, results, quiet):
+
+        # 1. Embedding throughput
+        texts = [chunk for document in documents for chunk in rag_service.split_text(document)][:2000]
+        start = time.perf_counter()
+        for text in texts[:500]:
+            rag_service.simple_text_embedding(text)
+        single_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        rag_service.embed_texts(texts)
+        batch_seconds = time.perf_counter() - start
+        results["embedding"] = {
+            "single_texts_per_second": round(min(len(texts), 500) / single_seconds, 1),
+            "batch_texts_per_second": round(len(texts) / batch_seconds, 1),
+        }
+        results["peak_rss_mb"]["embedding"] = peak_rss_mb()
+
+        # 2. Ingestion rate
+        latencies, document_ids = [], self.document_ids
+        with redirect_stdout(quiet):
+            start = time.perf_counter()
+            for i, text in enumerate(documents):
+                doc_start = time.perf_counter()
+                document_ids.append(rag_service.index_document(f"benchmark {i}", text).id)
+                latencies.append((time.perf_counter() - doc_start) * 1000)
+            ingest_seconds = time.perf_counter() - start
+            n_chunks = DocumentChunk.objects.filter(document_id__in=document_ids).count()
+            start = time.perf_counter()
+            compact(rag_service.embedding_dim())
+            compact_seconds = time.perf_counter() - start
+        results["ingestion"] = {
+            "documents": len(documents),
+            "chunks": n_chunks,
+            "docs_per_second": round(len(documents) / ingest_seconds, 1),
+            "chunks_per_second": round(n_chunks / ingest_seconds, 1),
+            "mb_per_second": round(sum(map(len, documents)) / 1e6 / ingest_seconds, 3),
+            "per_document": percentiles(latencies),
+            "compact_seconds": round(compact_seconds, 3),
+        }
+        results["peak_rss_mb"]["ingestion"] = peak_rss_mb()
+
+        # 3. End-to-end search latency, and how often the source document is found
+        latencies, found = [], 0
+        with redirect_stdout(quiet):
+            for query, doc in queries:
+                start = time.perf_counter()
+                hits = rag_service.search_chunks(query, options['k'])
+                latencies.append((time.perf_counter() - start) * 1000)
+                found += any(hit.document_id == document_ids[doc] for hit in hits)
+            # Repeated queries are answered from the result cache
+            start = time.perf_counter()
+            for query, _ in queries:
+                rag_service.search_docs(query, options['k'])
+            cached_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        results["search"] = {
+            "queries": len(queries),
+            "k": options['k'],
+            **percentiles(latencies),
+            "cached_mean_ms": round(cached_ms, 3),
+            "source_hit_rate": round(found / len(queries), 4),
+        }
+        results["peak_rss_mb"]["search"] = peak_rss_mb()
+
+        # 4. Recall@k, size and raw search latency per index type
+        with redirect_stdout(quiet):
+            ids, vectors = export_vectors(rag_service.load_index())
+        query_vectors = rag_service.embed_texts([query for query, _ in queries])
+        results["index_types"] = {}
+        for index_type in options['index_types']:
+            results["index_types"][index_type] = self.evaluate(
+                index_type, ids, vectors, query_vectors, options
+            )
+        results["peak_rss_mb"]["end"] = peak_rss_mb()
+
+    def evaluate(self, index_type, ids, vectors, query_vectors, options):
+        start = time.perf_counter()
+        try:
+            index = build_index(vectors, index_type, ids=ids)
+        except (ValueError, RuntimeError) as e:
+            return {"error": str(e)}
+        build_seconds = time.perf_counter() - start
+
+        latencies = []
+        for query_vector in query_vectors:
+            start = time.perf_counter()
+            index.search(query_vector.reshape(1, -1), options['k'])
+            latencies.append((time.perf_counter() - start) * 1000)
+        recall = measure_recall(index, vectors, options['k'], options['queries'], ids=ids)
+        storage = storage_stats(index)
+        return {
+            "build_seconds": round(build_seconds, 3),
+            f"recall_at_{recall['k']}": round(recall['recall'], 4),
+            **percentiles(latencies),
+            "bytes_per_vector": round(storage['bytes_per_vector'], 1),
+            "compression": round(storage['compression'], 2),
+        }
+
+    def meta(self, options):
+        try:
+            commit = subprocess.run(
+                ["git", "rev-parse", "HEAD"], capture_output=True, text=True, timeout=5,
+                cwd=os.path.dirname(os.path.abspath(__file__))
+            ).stdout.strip() or None
+        except (OSError, subprocess.SubprocessError):
+            commit = None
+        return {
+            "timestamp": timezone.now().isoformat(),
+            "commit": commit,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "faiss": getattr(faiss, "__version__", None),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "embedding": get_provider().describe(),
+            "params": {
+                name: options[name]
+                for name in ("docs", "words", "queries", "k", "seed", "index_types")
+            },
+        }
+
+    def summarize(self, results):
+        embedding, ingestion, search = results["embedding"], results["ingestion"], results["search"]
+        self.stdout.write(
+            f"Embedding: {embedding['single_texts_per_second']} texts/s one by one, "
+            f"{embedding['batch_texts_per_second']} texts/s batched"
+        )
+        self.stdout.write(
+            f"Ingestion: {ingestion['docs_per_second']} docs/s, {ingestion['chunks_per_second']} chunks/s, "
+            f"compaction {ingestion['compact_seconds']}s"
+        )
+        self.stdout.write(
+            f"Search: p50 {search['p50_ms']} ms, p99 {search['p99_ms']} ms, "
+            f"cached {search['cached_mean_ms']} ms, source hit rate {search['source_hit_rate']}"
+        )
+        for index_type, stats in results["index_types"].items():
+            if "error" in stats:
+                self.stdout.write(f"  {index_type}: {stats['error']}")
+                continue
+            recall = next(value for key, value in stats.items() if key.startswith("recall_at_"))
+            self.stdout.write(
+                f"  {index_type}: recall {recall}, p50 {stats['p50_ms']} ms, p99 {stats['p99_ms']} ms, "
+                f"{stats['bytes_per_vector']} bytes/vector"
+            )
+        self.stdout.write(f"Peak RSS: {results['peak_rss_mb']} MB")
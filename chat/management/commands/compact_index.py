@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from chat.index_service import compact, read_meta, writer_lock
+from chat.rag_service import embedding_dim, find_orphan_vectors
+
+class Command(BaseCommand):
+    help = (
+        'Fold the appended FAISS index segments into a new base snapshot and '
+        'reclaim the space of deleted vectors'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--prune-orphans',
+            action='store_true',
+            help='Also remove vectors that no DocumentChunk row points to'
+        )
+
+    def handle(self, *args, **options):
+        # Hold the writer lock so no ingestion runs between the orphan scan
+        # and the compaction
+        with writer_lock():
+            meta = read_meta()
+            segments = meta.get("segments", [])
+            self.stdout.write(
+                f"Pending: {len(segments)} segments, "
+                f"{sum(segment['count'] for segment in segments)} vectors, "
+                f"{len(meta.get('tombstones', []))} deleted vectors"
+            )
+
+            orphans = []
+            if options['prune_orphans']:
+                orphans = find_orphan_vectors()
+                self.stdout.write(f"Found {len(orphans)} orphan vectors")
+
+            generation = compact(embedding_dim(), orphans)
+
+        if generation is None:
+            self.stdout.write("Nothing to compact")
+            return
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Index compacted (generation {generation})")
+        )
@@ -0,0 +1,142 @@
+import os
+import glob
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from chat.models import Document
+from chat.ingest_service import is_supported, prepare_file
+from chat.rag_service import BULK_BATCH_SIZE, get_index_stats, index_prepared_documents
+
+# Hashes already in the database, set in each worker by _init_worker
+_skip_hashes = frozenset()
+
+
+def _init_worker(skip_hashes):
+    global _skip_hashes
+    django.setup()
+    _skip_hashes = skip_hashes
+
+
+def _prepare(path):
+    return prepare_file(path, _skip_hashes)
+
+
+def find_files(sources):
+    """(path, title) of every supported file under the given directories, files or glob patterns"""
+    files = []
+    for source in sources:
+        if os.path.isdir(source):
+            for root, dirs, names in os.walk(source):
+                dirs.sort()
+                for name in sorted(names):
+                    path = os.path.join(root, name)
+                    files.append((path, os.path.relpath(path, source)))
+        else:
+            for path in sorted(glob.glob(source, recursive=True)):
+                if os.path.isfile(path):
+                    files.append((path, os.path.basename(path)))
+    return [(path, title[:255]) for path, title in files if is_supported(path)]
+
+
+class Command(BaseCommand):
+    help = (
+        'Index every supported file of directories or glob patterns: parsing and '
+        'embedding run in a process pool, one writer stores the results in batches. '
+        'Files whose content is already indexed are skipped, so an interrupted run '
+        'can simply be started again.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'sources',
+            nargs='+',
+            help='Directories (walked recursively), files or glob patterns ("docs/**/*.pdf")'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Worker processes for parsing and embedding (default: one per CPU)'
+        )
+        parser.add_argument(
+            '--flush-chunks',
+            type=int,
+            default=BULK_BATCH_SIZE * 4,
+            help='Chunks buffered by the writer before one batched write'
+        )
+
+    def handle(self, *args, **options):
+        files = find_files(options['sources'])
+        if not files:
+            raise CommandError("No supported files found")
+        workers = max(options['workers'], 1)
+
+        known = frozenset(Document.objects.exclude(content_hash="").values_list("content_hash", flat=True))
+        self.stdout.write(f"Found {len(files)} files, {len(known)} documents already indexed, {workers} workers")
+
+        self.started = time.perf_counter()
+        self.indexed = self.chunks = self.skipped = self.failed = 0
+        seen = set(known)  # Also catches identical files within this run
+        pending_writes, pending_chunks = [], 0
+
+        # Workers open their own connections: don't hand them ours
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(known,)) as pool:
+            queued = iter(files)
+            running = {}
+            while True:
+                # Keep a couple of files per worker in flight, not the whole corpus
+                while len(running) < workers * 2:
+                    item = next(queued, None)
+                    if item is None:
+                        break
+                    running[pool.submit(_prepare, item[0])] = item
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, title = running.pop(future)
+                    try:
+                        content_hash, chunks, chunk_embeddings = future.result()
+                    except Exception as e:
+                        self.failed += 1
+                        self.stdout.write(self.style.ERROR(f"Failed {path}: {e}"))
+                        continue
+                    if chunks is None or content_hash in seen:
+                        self.skipped += 1
+                        continue
+                    seen.add(content_hash)
+                    pending_writes.append((title, content_hash, chunks, chunk_embeddings))
+                    pending_chunks += len(chunks)
+
+                if pending_chunks >= options['flush_chunks']:
+                    self.flush(pending_writes, pending_chunks)
+                    pending_writes, pending_chunks = [], 0
+
+        if pending_writes:
+            self.flush(pending_writes, pending_chunks)
+
+        elapsed = time.perf_counter() - self.started
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Indexed {self.indexed} documents ({self.chunks} chunks) in {elapsed:.1f}s: "
+                f"{self.indexed / elapsed:.1f} docs/s, {self.chunks / elapsed:.1f} chunks/s; "
+                f"skipped {self.skipped}, failed {self.failed}"
+            )
+        )
+        self.stdout.write(f"Index stats: {get_index_stats()}")
+
+    def flush(self, pending_writes, pending_chunks):
+        index_prepared_documents(pending_writes)
+        self.indexed += len(pending_writes)
+        self.chunks += pending_chunks
+        elapsed = time.perf_counter() - self.started
+        self.stdout.write(
+            f"{self.indexed} documents, {self.chunks} chunks "
+            f"({self.indexed / elapsed:.1f} docs/s, {self.chunks / elapsed:.1f} chunks/s)"
+        )
@@ -0,0 +1,98 @@
+from django.core.management.base import BaseCommand, CommandError
+import time
+import faiss
+from chat import rag_service
+from chat.index_service import (
+    INDEX_FACTORIES, build_index, export_vectors, measure_recall, storage_stats,
+    writer_lock
+)
+
+class Command(BaseCommand):
+    help = (
+        'Rebuild the FAISS index into another index type and report its '
+        'recall@k, recall loss and compression ratio'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--type',
+            type=str,
+            choices=sorted(INDEX_FACTORIES),
+            help='Target index type (defaults to settings.RAG_INDEX_TYPE)'
+        )
+        parser.add_argument(
+            '--k',
+            type=int,
+            default=10,
+            help='k used when measuring recall@k'
+        )
+        parser.add_argument(
+            '--queries',
+            type=int,
+            default=100,
+            help='Number of stored vectors used as recall queries'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Measure recall without replacing the index on disk'
+        )
+        parser.add_argument(
+            '--compare',
+            action='store_true',
+            help='Evaluate every index type and leave the index unchanged'
+        )
+
+    def handle(self, *args, **options):
+        # Block ingestion so no vectors are added between export and publish
+        with writer_lock():
+            self.rebuild(options)
+
+    def rebuild(self, options):
+        index = rag_service.load_index()
+        if index.ntotal == 0:
+            raise CommandError("The FAISS index is empty, nothing to rebuild")
+
+        current = storage_stats(index)
+        self.stdout.write(
+            f"Exporting {index.ntotal} vectors "
+            f"(current index: {current['bytes'] / 1e6:.2f} MB, "
+            f"{current['bytes_per_vector']:.1f} bytes/vector)..."
+        )
+        ids, vectors = export_vectors(index)
+
+        if options['compare']:
+            for index_type in INDEX_FACTORIES:
+                self.evaluate(index_type, ids, vectors, options)
+            return
+
+        new_index = self.evaluate(options['type'], ids, vectors, options)
+
+        if options['dry_run']:
+            self.stdout.write("Dry run: index on disk left unchanged")
+            return
+
+        rag_service.save_index(new_index)
+        self.stdout.write(self.style.SUCCESS("Index rebuilt and saved"))
+
+    def evaluate(self, index_type, ids, vectors, options):
+        """Build one index type and print its build time, size and recall"""
+        start = time.perf_counter()
+        try:
+            new_index = build_index(vectors, index_type, ids=ids)
+        except ValueError as e:
+            raise CommandError(str(e))
+        build_seconds = time.perf_counter() - start
+
+        storage = storage_stats(new_index)
+        recall = measure_recall(new_index, vectors, options['k'], options['queries'], ids=ids)
+        self.stdout.write(
+            f"{type(faiss.downcast_index(new_index.index)).__name__}: "
+            f"built in {build_seconds:.2f}s, "
+            f"{storage['bytes'] / 1e6:.2f} MB ({storage['bytes_per_vector']:.1f} bytes/vector, "
+            f"{storage['compression']:.1f}x compression)\n"
+            f"  recall@{recall['k']}: {recall['recall']:.4f} "
+            f"(loss {1 - recall['recall']:.4f}) over {recall['queries']} queries, "
+            f"exact {recall['exact_ms']:.3f} ms/query, new {recall['approx_ms']:.3f} ms/query"
+        )
+        return new_index
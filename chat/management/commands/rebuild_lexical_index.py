@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from chat import rag_service
+
+class Command(BaseCommand):
+    help = (
+        'Rebuild the BM25 keyword index used by hybrid search from the stored '
+        'chunks (needed once for chunks indexed before it existed)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Chunks read and tokenized per batch'
+        )
+
+    def handle(self, *args, **options):
+        count = rag_service.rebuild_lexical_index(options['batch_size'])
+        stats = rag_service.load_index().lexical.stats()
+        self.stdout.write(
+            self.style.SUCCESS(f"BM25 index rebuilt: {count} chunks, {stats['parts']} postings files loaded")
+        )
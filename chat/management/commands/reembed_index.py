@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from chat import rag_service
+from chat.embedding_service import get_provider
+from chat.reembed_service import REEMBED_BATCH_SIZE, reembed_index
+
+class Command(BaseCommand):
+    help = (
+        'Re-embed every stored chunk with the configured embedding provider into '
+        'a new index and switch over to it atomically. The current index keeps '
+        'serving (and indexing) meanwhile.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=REEMBED_BATCH_SIZE,
+            help='Chunk texts per embedding call'
+        )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Re-embed even when the index already matches the configured embedding'
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f"Index embedding: {rag_service.index_embedding()}\n"
+            f"Configured embedding: {get_provider().describe()}"
+        )
+        generation = reembed_index(options['batch_size'], force=options['force'])
+        if generation is None:
+            self.stdout.write("Nothing to re-embed (or a re-embedding is already running)")
+            return
+        self.stdout.write(self.style.SUCCESS(f"Index re-embedded (generation {generation})"))
@@ -0,0 +1,196 @@
+# chat/metrics_service.py
+import time
+import asyncio
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Iterable, List, Optional
+from django.conf import settings
+
+# Upper bounds of the histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+TOKEN_BUCKETS = (50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000)
+
+
+def trace(*args, **kwargs):
+    """print() for the request/ingestion trace lines, silenced with RAG_TRACE = False"""
+    if getattr(settings, "RAG_TRACE", True):
+        print(*args, **kwargs)
+
+
+def _format_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(label_value: str) -> str:
+    return str(label_value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Histogram:
+    """
+    Prometheus-style histogram with one label: cumulative bucket counts,
+    sum and count per label value. Process-local and thread-safe, like the
+    query caches: each worker process exposes its own numbers.
+    """
+
+    def __init__(self, name: str, help_text: str, label: str, buckets: Iterable[float]):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._series = {}  # label value -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, label_value: str, value: float):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {label_value: list(values) for label_value, values in self._series.items()}
+        for label_value, values in sorted(series.items()):
+            label = f'{self.label}="{_escape(label_value)}"'
+            for bound, count in zip(self.buckets, values):
+                lines.append(f'{self.name}_bucket{{{label},le="{_format_value(bound)}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {values[-1]}')
+            lines.append(f"{self.name}_sum{{{label}}} {_format_value(float(values[-2]))}")
+            lines.append(f"{self.name}_count{{{label}}} {values[-1]}")
+        return lines
+
+
+class Counter:
+    """Prometheus-style counter with one label (process-local, thread-safe)"""
+
+    def __init__(self, name: str, help_text: str, label: str):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_value: str, amount: float = 1):
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = dict(self._values)
+        for label_value, value in sorted(values.items()):
+            lines.append(f'{self.name}{{{self.label}="{_escape(label_value)}"}} {_format_value(value)}')
+        return lines
+
+
+def render_gauge(name: str, help_text: str, value) -> List[str]:
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {_format_value(value)}"]
+
+
+STAGE_SECONDS = Histogram(
+    "rag_stage_seconds", "Time spent in each stage of a request, in seconds", "stage", LATENCY_BUCKETS
+)
+REQUEST_SECONDS = Histogram(
+    "rag_request_seconds", "End-to-end request time per endpoint, in seconds", "endpoint", LATENCY_BUCKETS
+)
+LLM_TOKENS = Histogram("rag_llm_tokens", "Tokens per LLM call", "kind", TOKEN_BUCKETS)
+EVENTS = Counter("rag_events_total", "Notable events (cache hits, tool calls, errors)", "event")
+
+METRICS = (REQUEST_SECONDS, STAGE_SECONDS, LLM_TOKENS, EVENTS)
+
+# Spans of the request being handled (shared with the threads sync_to_async runs it in)
+_request_spans = contextvars.ContextVar("rag_request_spans", default=None)
+
+
+@contextmanager
+def span(stage: str):
+    """Time a block as one occurrence of a request stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(stage, elapsed)
+        spans = _request_spans.get()
+        if spans is not None:
+            spans.append((stage, elapsed))
+
+
+@contextmanager
+def track_request(endpoint: str):
+    """
+    Time a whole request and trace one line with its stages, e.g.
+    "agent 812.3 ms | history_load 1.2 ms, llm_call 790.0 ms x2"
+    """
+    spans = []
+    token = _request_spans.set(spans)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        _request_spans.reset(token)
+        REQUEST_SECONDS.observe(endpoint, elapsed)
+        totals = {}
+        for stage, seconds in spans:
+            total, count = totals.get(stage, (0.0, 0))
+            totals[stage] = (total + seconds, count + 1)
+        stages = ", ".join(
+            f"{stage} {total * 1000:.1f} ms" + (f" x{count}" if count > 1 else "")
+            for stage, (total, count) in totals.items()
+        )
+        trace(f"📈 {endpoint} {elapsed * 1000:.1f} ms | {stages}")
+
+
+def tracked(endpoint: str):
+    """
+    Decorator running a (sync or async) view method under track_request.
+    Streamed replies are timed until the response starts; their LLM time
+    still lands in the stage histograms.
+    """
+    def decorator(method):
+        if asyncio.iscoroutinefunction(method):
+            @functools.wraps(method)
+            async def async_wrapper(*args, **kwargs):
+                with track_request(endpoint):
+                    return await method(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            with track_request(endpoint):
+                return method(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count_event(event: str, amount: int = 1):
+    EVENTS.inc(event, amount)
+
+
+def observe_tokens(kind: str, count: Optional[int]):
+    if count:
+        LLM_TOKENS.observe(kind, count)
+
+
+def observe_llm_usage(message):
+    """Prompt and completion tokens reported by the model on an AIMessage, when it reports them"""
+    usage = getattr(message, "usage_metadata", None) or {}
+    observe_tokens("prompt", usage.get("input_tokens"))
+    observe_tokens("completion", usage.get("output_tokens"))
+
+
+def render_metrics(extra_lines: Iterable[str] = ()) -> str:
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    lines.extend(extra_lines)
+    return "\n".join(lines) + "\n"
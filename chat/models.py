@@ -2,6 +2,9 @@ from django.db import models
 class ChatSession(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     title = models.CharField(max_length=255, blank=True, null=True)
+    # Rolling summary of the messages older than the history window (RAG_HISTORY_SUMMARY)
+    summary = models.TextField(blank=True, default="")
+    summary_until = models.DateTimeField(blank=True, null=True)  # created_at of the last summarized message
 
     def __str__(self):
         return self.title or f"Session {self.id}"
@@ -19,10 +22,17 @@ class Message(models.Model):
     role = models.CharField(max_length=10, choices=ROLE_CHOICES)
     content = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        # Serves "latest N messages of a session" without scanning the session
+        indexes = [models.Index(fields=["session", "created_at"])]
+
     def __str__(self):
         return f"{self.role} | {self.content[:30]}"
 class Document(models.Model):
     title = models.CharField(max_length=255)
+    # sha256 of the source file, so bulk ingestion can skip what is already indexed
+    content_hash = models.CharField(max_length=64, blank=True, default="", db_index=True)
     uploaded_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
@@ -35,8 +45,72 @@ class DocumentChunk(models.Model):
         related_name="chunks"
     )
     text = models.TextField()
-    vector_id = models.IntegerField()  # position in FAISS index
+    position = models.PositiveIntegerField(default=0)  # Order of the chunk in its document
+    content_hash = models.CharField(max_length=64, blank=True, default="", db_index=True)  # See ChunkEmbedding
+    vector_id = models.IntegerField(db_index=True)  # id in the FAISS index, shared by chunks with the same content
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.document.title[:20]}... ({self.id})"
+
+
+class ChunkEmbedding(models.Model):
+    """
+    The one indexed vector of each distinct chunk content. Chunks with the
+    same content hash reuse it instead of being embedded and added again;
+    it is removed from the index once no chunk uses it any more.
+    """
+    content_hash = models.CharField(max_length=64, unique=True)  # sha256 of the whitespace-normalized text
+    vector_id = models.IntegerField(unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.content_hash[:12]} -> {self.vector_id}"
+
+
+class IngestionJob(models.Model):
+    """An uploaded file waiting for or going through background indexing"""
+    STATUS_CHOICES = (
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    )
+
+    file_name = models.CharField(max_length=255)  # As uploaded
+    file_path = models.CharField(max_length=500)  # Copy in RAG_UPLOAD_DIR, removed when the job ends
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    document = models.ForeignKey(
+        Document,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="ingestion_jobs"
+    )
+    total_chunks = models.PositiveIntegerField(blank=True, null=True)  # Known once extraction finishes
+    processed_chunks = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, default="")
+    stats = models.JSONField(blank=True, default=dict)  # Per-stage throughput of the pipeline
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+    worker = models.CharField(max_length=255, blank=True, default="")  # "host:pid" of the process running it
+
+    def __str__(self):
+        return f"{self.file_name} ({self.status})"
+
+
+class CachedResponse(models.Model):
+    """An LLM reply, reusable for the same question over the same retrieved chunks"""
+    key = models.CharField(max_length=64, unique=True)  # sha256 of context_key + normalized question
+    context_key = models.CharField(max_length=64, db_index=True)  # sha256 of template, chunk ids, history
+    question = models.TextField()  # Normalized
+    question_embedding = models.BinaryField(blank=True, null=True)  # For RAG_RESPONSE_CACHE_SIMILARITY
+    chunk_ids = models.TextField(blank=True, default="")  # ",3,17," so deletions can find their entries
+    response = models.TextField()
+    hits = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
-        return f"{self.document.title[:20]}... ({self.id})"
\ No newline at end of file
+        return f"{self.question[:30]} ({self.hits} hits)"
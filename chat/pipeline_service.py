@@ -0,0 +1,278 @@
+# chat/pipeline_service.py
+import os
+import time
+import queue
+import zipfile
+import itertools
+import threading
+from collections import deque
+from typing import Callable, Iterable, Iterator, List, Optional
+from xml.etree import ElementTree
+from django.db import connection
+
+from .rag_service import BULK_BATCH_SIZE, CHUNK_OVERLAP, CHUNK_SIZE, get_text_splitter
+
+try:
+    from pypdf import PdfReader  # In requirements.txt; without it only PDF uploads fail
+except ImportError:
+    PdfReader = None
+
+TEXT_BLOCK_SIZE = 64 * 1024  # Characters read from a .txt file at a time
+PARAGRAPH_BREAK = "\n\n"  # First separator of the text splitter
+QUEUE_SIZE = 2  # Batches waiting between two stages
+
+
+class ExtractionError(Exception):
+    """The file can't be turned into text"""
+
+
+# -------------------------------------------------------------------
+# 1. Extraction: file -> text pieces (blocks, pages or paragraphs)
+# -------------------------------------------------------------------
+
+def extract_txt(path: str) -> Iterator[str]:
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        while True:
+            block = f.read(TEXT_BLOCK_SIZE)
+            if not block:
+                return
+            yield block
+
+
+def extract_pdf(path: str) -> Iterator[str]:
+    if PdfReader is None:
+        raise ExtractionError("PDF files need the pypdf package (pip install pypdf)")
+    # A file object (not a path) so pypdf reads pages on demand instead of
+    # loading the whole file into memory
+    with open(path, "rb") as f:
+        try:
+            reader = PdfReader(f)
+            for page in reader.pages:
+                yield (page.extract_text() or "") + "\n\n"
+        except ExtractionError:
+            raise
+        except Exception as e:
+            raise ExtractionError(f"Unreadable PDF: {e}") from e
+
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+def extract_docx(path: str) -> Iterator[str]:
+    """Paragraphs of word/document.xml, parsed incrementally (no python-docx needed)"""
+    try:
+        with zipfile.ZipFile(path) as archive, archive.open("word/document.xml") as xml:
+            parts = []
+            open_elements = []
+            for event, element in ElementTree.iterparse(xml, events=("start", "end")):
+                if event == "start":
+                    open_elements.append(element)
+                    continue
+                open_elements.pop()
+                if element.tag == _W + "t":
+                    parts.append(element.text or "")
+                elif element.tag == _W + "tab":
+                    parts.append("\t")
+                elif element.tag in (_W + "br", _W + "cr"):
+                    parts.append("\n")
+                elif element.tag == _W + "p":
+                    yield "".join(parts) + "\n\n"
+                    parts = []
+                if open_elements:
+                    # Done with it: the tree only ever holds the elements still open
+                    open_elements[-1].remove(element)
+    except (zipfile.BadZipFile, KeyError, ElementTree.ParseError) as e:
+        raise ExtractionError(f"Unreadable DOCX: {e}") from e
+
+
+EXTRACTORS = {
+    ".txt": extract_txt,
+    ".docx": extract_docx,
+}
+if PdfReader is not None:
+    EXTRACTORS[".pdf"] = extract_pdf
+
+
+def extract_text(path: str) -> Iterator[str]:
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in EXTRACTORS:
+        raise ExtractionError(f"Unsupported file type: {extension}")
+    return EXTRACTORS[extension](path)
+
+
+# -------------------------------------------------------------------
+# 2. Chunking: text pieces -> chunks -> batches
+# -------------------------------------------------------------------
+
+def _paragraphs(pieces: Iterable[str]) -> Iterator[str]:
+    """
+    The text of a stream cut where the splitter cuts first: before every
+    PARAGRAPH_BREAK (kept at the start of the paragraph it opens), matched
+    left to right as re.split does
+    """
+    buffer, begin, pos = "", 0, 0
+    for piece in pieces:
+        buffer, pos, begin = buffer[begin:] + piece, pos - begin, 0
+        while True:
+            start = buffer.find(PARAGRAPH_BREAK, pos)
+            if start == -1:
+                # A break may still start on the last character
+                pos = max(pos, len(buffer) - len(PARAGRAPH_BREAK) + 1)
+                break
+            if start > begin:
+                yield buffer[begin:start]
+            begin, pos = start, start + len(PARAGRAPH_BREAK)
+    if begin < len(buffer):
+        yield buffer[begin:]
+
+
+def iter_chunks(pieces: Iterable[str]) -> Iterator[str]:
+    """
+    Split a stream of text into exactly the chunks rag_service.split_text
+    makes of the whole text, so both ingestion paths share chunk hashes.
+    Same algorithm, run a paragraph at a time: paragraphs shorter than
+    CHUNK_SIZE are merged greedily with CHUNK_OVERLAP (as the splitter's
+    _merge_splits does), longer ones are split on their own by the
+    splitter. Memory holds one paragraph and one chunk; a text without any
+    blank line is held whole, since that decides how the splitter cuts it.
+    """
+    splitter = get_text_splitter()
+    current = deque()  # Paragraphs of the chunk being built
+    total = 0
+
+    def chunk():
+        text = "".join(current).strip()
+        return [text] if text else []
+
+    paragraphs = _paragraphs(pieces)
+    first = next(paragraphs, None)
+    if first is None:
+        return
+    second = next(paragraphs, None)
+    if second is None:
+        # One paragraph (without a blank line the splitter cuts at the next separator)
+        yield from splitter.split_text(first)
+        return
+
+    for paragraph in itertools.chain([first, second], paragraphs):
+        if len(paragraph) >= CHUNK_SIZE:
+            yield from chunk()
+            current.clear()
+            total = 0
+            yield from splitter.split_text(paragraph)
+            continue
+        if total + len(paragraph) > CHUNK_SIZE:
+            yield from chunk()
+            # Keep the tail that fits in the overlap
+            while total > CHUNK_OVERLAP or (total + len(paragraph) > CHUNK_SIZE and total > 0):
+                total -= len(current.popleft())
+        current.append(paragraph)
+        total += len(paragraph)
+    yield from chunk()
+
+
+def iter_batches(items: Iterable, size: int = BULK_BATCH_SIZE) -> Iterator[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# -------------------------------------------------------------------
+# 3. Stages: threads connected by bounded queues
+# -------------------------------------------------------------------
+
+_DONE = object()
+
+
+class PipelineStage:
+    """
+    Runs one pipeline stage in its own thread: pulls items from upstream,
+    applies fn (or just pulls, for a source stage) and hands the results
+    downstream through a bounded queue. A full queue blocks the stage
+    (backpressure), so a slow consumer caps how far producers run ahead.
+    Iterating the stage yields its results and re-raises its errors.
+    """
+
+    def __init__(self, name: str, upstream: Iterable, fn: Optional[Callable] = None,
+                 size: Callable = len, maxsize: int = QUEUE_SIZE):
+        self.name = name
+        self.upstream = upstream
+        self.fn = fn
+        self.size = size  # Units per item for the throughput figures
+        self.items = 0
+        self.units = 0
+        self.busy_seconds = 0.0  # Producing (pulling a source or running fn)
+        self.blocked_seconds = 0.0  # Waiting for room downstream
+        self.consumer_wait_seconds = 0.0  # Time the consumer waited on this stage
+        self.finished = False  # All items produced
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._stopped = threading.Event()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name=f"pipeline-{name}", daemon=True)
+
+    def _put(self, item) -> bool:
+        start = time.perf_counter()
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                self.blocked_seconds += time.perf_counter() - start
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self):
+        iterator = iter(self.upstream)
+        try:
+            while not self._stopped.is_set():
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    self.finished = True
+                    break
+                if self.fn is not None:
+                    start = time.perf_counter()  # Upstream has its own stats
+                    item = self.fn(item)
+                self.busy_seconds += time.perf_counter() - start
+                self.items += 1
+                self.units += self.size(item)
+                if not self._put(item):
+                    break
+        except BaseException as e:
+            self._error = e
+        finally:
+            if hasattr(iterator, "close"):
+                iterator.close()  # Stops an upstream stage we gave up on
+            connection.close()  # fn may have used this thread's connection
+            self._put(_DONE)
+
+    def __iter__(self):
+        self._thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                item = self._queue.get()
+                self.consumer_wait_seconds += time.perf_counter() - start
+                if item is _DONE:
+                    break
+                yield item
+            if self._error is not None:
+                raise self._error
+        finally:
+            # Consumer finished or gave up: let the thread exit
+            self._stopped.set()
+
+    def stats(self) -> dict:
+        return {
+            "items": self.items,
+            "units": self.units,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "blocked_seconds": round(self.blocked_seconds, 3),
+            "units_per_second": round(self.units / self.busy_seconds, 1) if self.busy_seconds else None,
+        }
@@ -1,194 +1,782 @@
-import os
-import faiss
+import json
+import hashlib
 import numpy as np
-from typing import List, Optional
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.db import transaction
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from .models import Document, DocumentChunk
+from .models import ChunkEmbedding, Document, DocumentChunk
+from .cache_service import LRUCache
+from .context_service import edge_overlap
+from .embedding_service import EmbeddingError, EmbeddingProvider, create_provider, embedding_matches, get_provider
+from .lexical_service import Postings, reciprocal_rank_fusion
+from .metrics_service import count_event, span, trace
+from .response_cache_service import get_response_cache_stats, invalidate_chunks
+from .index_service import (
+    SegmentedIndex, add_tombstones, append_segment, bump_generation, current_generation, current_meta,
+    export_vectors, maybe_compact_in_background, next_vector_id, publish_index, publish_postings, read_meta,
+    writer_lock
+)
 
-# Configuration - using smaller dimension for local embeddings
-EMBED_DIM = 384  # Smaller for local embeddings
-INDEX_PATH = os.path.join(settings.BASE_DIR, "faiss_index.bin")
+# Configuration
+BULK_BATCH_SIZE = 500  # Rows per INSERT statement (SQLite variable limit friendly)
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+# Hits fetched per requested result, so collapsing duplicates still leaves k
+SEARCH_OVERFETCH = 2
+# Candidates fetched per requested result for the MMR reranking (RAG_MMR)
+MMR_OVERFETCH = 4
+# Indexes written before vectors were stamped hold local hasher vectors
+LEGACY_EMBEDDING = {"provider": "local", "model": "hash-v1", "dim": 384}
 
 # Global variables - initialize as None
 _index = None
-_embeddings = None
+# Index embedding stamp -> provider reproducing it (None when none can)
+_index_providers: Dict[str, Optional[EmbeddingProvider]] = {}
+# Process-local vector_id -> (document_id, text, position) store for the
+# current index generation, see RAG_CHUNK_CACHE
+_chunk_store = LRUCache(getattr(settings, "RAG_CHUNK_CACHE_SIZE", 10000))
+_chunk_store_generation = None
+# Query text -> embedding, and (query, k) -> hits for the current index generation
+_embedding_cache = LRUCache(
+    getattr(settings, "RAG_QUERY_CACHE_SIZE", 1024),
+    getattr(settings, "RAG_QUERY_CACHE_TTL", None)
+)
+_result_cache = LRUCache(
+    getattr(settings, "RAG_QUERY_CACHE_SIZE", 1024),
+    getattr(settings, "RAG_QUERY_CACHE_TTL", None)
+)
+_result_cache_generation = None
 
-def get_embeddings():
-    """Get or create embeddings instance - with fallback"""
-    global _embeddings
-    if _embeddings is None:
+class RetrievedChunk(NamedTuple):
+    """A search hit resolved to its chunk"""
+    vector_id: int
+    document_id: int
+    text: str
+    distance: float  # inf for hits found by BM25 only
+    score: float = 0.0  # Fused rank score, higher is better
+    position: int = 0  # Order in the document (of the first chunk of a merged span)
+    vector_ids: Tuple[int, ...] = ()  # Every chunk of a merged span, when several
+    lexical_score: float = 0.0  # BM25 score relative to the best hit, 0 when not a keyword hit
+
+def retrieved_ids(chunks: List[RetrievedChunk]) -> List[int]:
+    """Vector ids of every chunk behind search results (merged spans included)"""
+    return [vector_id for chunk in chunks for vector_id in (chunk.vector_ids or (chunk.vector_id,))]
+
+def index_embedding(meta: Optional[dict] = None) -> Optional[dict]:
+    """Stamp of the embedding that produced the published vectors (None for a new, empty index)"""
+    meta = current_meta() if meta is None else meta
+    if meta.get("embedding"):
+        return meta["embedding"]
+    return LEGACY_EMBEDDING if next_vector_id(meta) else None
+
+def index_provider(meta: Optional[dict] = None) -> Optional[EmbeddingProvider]:
+    """
+    Provider matching the published vectors: the configured one or, while a
+    re-embedding is pending, the one stamped on the index, so a changed
+    configuration keeps serving until reembed_index switches over. None when
+    the stamped vectors can't be reproduced any more (e.g. the local hasher
+    changed): search then falls back to BM25 and writes fail until the
+    index is re-embedded.
+    """
+    stamp = index_embedding(meta)
+    provider = get_provider()
+    if stamp is None or embedding_matches(stamp, provider):
+        return provider
+    key = json.dumps(stamp, sort_keys=True)
+    if key not in _index_providers:
         try:
-            from langchain_openai import OpenAIEmbeddings
-            _embeddings = OpenAIEmbeddings(model="text-embedding-3-small")
-        except Exception as e:
-            print(f"OpenAI embeddings failed: {e}. Using local fallback.")
-            _embeddings = None
-    return _embeddings
+            stamped = create_provider(stamp.get("provider"), stamp.get("model"), stamp.get("dim"))
+        except ValueError:
+            stamped = None
+        if stamped is not None and not embedding_matches(stamp, stamped):
+            stamped = None
+        _index_providers[key] = stamped
+        _embedding_mismatch(stamp, provider, stamped)
+    return _index_providers[key]
+
+def _embedding_mismatch(stamp: dict, configured: EmbeddingProvider, stamped: Optional[EmbeddingProvider]):
+    """
+    Report (once per process) an index built by another embedding, and
+    start re-embedding it when RAG_REEMBED_ON_MISMATCH opts in (it sends
+    every chunk through the configured provider, possibly a paid API)
+    """
+    count_event("embedding_mismatch")
+    serving = f"serving with {stamped.key}" if stamped else "vector search disabled, BM25 only"
+    trace(f"⚠️ Index vectors come from {stamp}, configured embedding is {configured.describe()}: "
+          f"{serving} until the index is re-embedded")
+    if getattr(settings, "RAG_REEMBED_ON_MISMATCH", False):
+        from .reembed_service import reembed_in_background  # It imports this module
+        reembed_in_background()
+    else:
+        trace("   Run `python manage.py reembed_index` to re-embed it")
+
+def _active_provider(meta: Optional[dict] = None) -> EmbeddingProvider:
+    provider = index_provider(meta)
+    if provider is None:
+        raise EmbeddingError(
+            "The index vectors come from an embedding that can no longer be reproduced; "
+            "re-embed it with `python manage.py reembed_index`"
+        )
+    return provider
+
+def embedding_dim() -> int:
+    """Dimension of the published vectors (of the configured provider for a new index)"""
+    stamp = index_embedding()
+    return int(stamp["dim"]) if stamp else get_provider().dim
 
 def load_index():
-    """Load FAISS index from disk or create new one"""
+    """
+    Load the shared FAISS index (memory-mapped base plus published segments)
+    or create a new one. Cheap to call on every request: it only loads what
+    another process published since the last call, and checks that its
+    vectors match the configured embedding.
+    """
     global _index
-    if _index is None:
-        if os.path.exists(INDEX_PATH):
-            print("📁 Loading FAISS index from disk...")
-            _index = faiss.read_index(INDEX_PATH)
-        else:
-            print("🆕 Creating new FAISS index...")
-            _index = faiss.IndexFlatL2(EMBED_DIM)
-    return _index
+    dim = embedding_dim()
+    if _index is None or _index.d != dim:
+        _index = SegmentedIndex(dim)
+    index = _index.refresh()
+    index_provider()  # Warns and starts re-embedding on a mismatch
+    return index
 
-def save_index():
-    """Save FAISS index to disk"""
-    index = load_index()
-    if index is not None:
-        faiss.write_index(index, INDEX_PATH)
-        print("💾 FAISS index saved to disk")
+def save_index(index):
+    """Publish a full index as the new base snapshot for every worker"""
+    with writer_lock():
+        generation = publish_index(index)
+    trace(f"💾 FAISS index saved to disk (generation {generation})")
+
+def embed_texts(texts: List[str], provider: Optional[EmbeddingProvider] = None) -> np.ndarray:
+    """
+    Batched embedding (see embedding_service): returns a (len(texts), dim)
+    float32 matrix, made by the provider matching the published index
+    unless one is given.
+    """
+    return (provider or _active_provider()).embed(texts)
 
 def simple_text_embedding(text: str) -> List[float]:
-    """Improved local embedding using multiple text features"""
-    import string
-    import hashlib
-    import re
-    
-    text = text.lower().strip()
-    
-    # Create a more sophisticated embedding
-    embedding = [0.0] * EMBED_DIM
+    """Embed a single text (thin wrapper over embed_texts)"""
+    return embed_texts([text])[0].tolist()
+
+def get_text_splitter(**kwargs) -> RecursiveCharacterTextSplitter:
+    return RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
+        length_function=len,
+        **kwargs
+    )
+
+def split_text(text: str) -> List[str]:
+    """Split document text into overlapping chunks"""
+    return get_text_splitter().split_text(text)
+
+def chunk_hash(text: str) -> str:
+    """Identity of a chunk's content: differences in whitespace don't count"""
+    return hashlib.sha256(" ".join(text.split()).encode("utf-8")).hexdigest()
+
+def _known_vectors(hashes: Iterable[str]) -> Dict[str, int]:
+    """content_hash -> vector_id for the contents already in the index"""
+    hashes = list(set(hashes))
+    known = {}
+    for start in range(0, len(hashes), BULK_BATCH_SIZE):
+        known.update(
+            ChunkEmbedding.objects.filter(content_hash__in=hashes[start:start + BULK_BATCH_SIZE])
+            .values_list("content_hash", "vector_id")
+        )
+    return known
+
+class ChunkEmbeddings(dict):
+    """content_hash -> vector, remembering the embedding (stamp) that produced the vectors"""
+
+    def __init__(self, vectors=(), embedding: Optional[dict] = None):
+        super().__init__(vectors)
+        self.embedding = embedding
+
+def embed_chunks(chunks: List[str], skip_known: bool = True) -> ChunkEmbeddings:
+    """
+    Embeddings of chunks by content hash, one per distinct content. With
+    skip_known, contents that are already indexed are not embedded again.
+    """
+    texts = {}
+    for text in chunks:
+        texts.setdefault(chunk_hash(text), text)
+    if skip_known:
+        for content_hash in _known_vectors(texts):
+            del texts[content_hash]
+    provider = _active_provider()
+    return ChunkEmbeddings(zip(texts, provider.embed(list(texts.values()))), provider.describe())
+
+def _usable_embeddings(chunk_embeddings, provider: EmbeddingProvider) -> dict:
+    """Embeddings made upstream, unless the index switched embedding since (then all are redone)"""
+    if chunk_embeddings and getattr(chunk_embeddings, "embedding", None) == provider.describe():
+        return chunk_embeddings
+    return {}
+
+def _assign_vectors(chunks: List[str], chunk_embeddings: Dict[str, np.ndarray], provider: EmbeddingProvider):
+    """
+    Vector ids for chunks: contents already indexed keep their vector, new
+    contents get consecutive ids from next_vector_id and a ChunkEmbedding
+    row. Returns (hashes, vector_ids, first_id, vectors, texts), vectors and
+    texts being the new contents to append starting at first_id. Must run
+    under writer_lock() in the writing transaction.
+    """
+    hashes = [chunk_hash(text) for text in chunks]
+    known = _known_vectors(hashes)
+    first_id = next_vector_id(read_meta())
+    new = {}  # content_hash -> text, in id order
+    for text, content_hash in zip(chunks, hashes):
+        if content_hash not in known:
+            known[content_hash] = first_id + len(new)
+            new[content_hash] = text
     
-    # 1. Word frequency features (first 20 dimensions)
-    words = re.findall(r'\b\w+\b', text)
-    word_freq = {}
-    for word in words[:50]:  # First 50 words only
-        if len(word) > 2:  # Ignore very short words
-            word_freq[word] = word_freq.get(word, 0) + 1
+    # Embedded upstream before another writer indexed the same content
+    missing = [content_hash for content_hash in new if content_hash not in chunk_embeddings]
+    if missing:
+        chunk_embeddings = {**chunk_embeddings, **dict(zip(missing, provider.embed([new[h] for h in missing])))}
     
-    # Distribute word frequencies across dimensions
-    for i, (word, freq) in enumerate(list(word_freq.items())[:20]):
-        if i < 20:
-            embedding[i] = min(freq / 10.0, 1.0)
+    ChunkEmbedding.objects.bulk_create(
+        [ChunkEmbedding(content_hash=content_hash, vector_id=known[content_hash]) for content_hash in new],
+        batch_size=BULK_BATCH_SIZE
+    )
+    vectors = np.array([chunk_embeddings[content_hash] for content_hash in new], dtype='float32')
+    vector_ids = [known[content_hash] for content_hash in hashes]
+    return hashes, vector_ids, first_id, vectors.reshape(len(new), provider.dim), list(new.values())
+
+def _write_chunks(document: Document, chunks: List[str], replace: bool = False,
+                  chunk_embeddings: Optional[Dict[str, np.ndarray]] = None, first_position: int = 0):
+    """
+    Store chunk rows and vectors for a document: one bulk_create and one
+    appended index segment, in a single transaction. Only contents not yet
+    in the index are embedded and added; identical chunks share a vector.
+    With replace=True the document's previous chunks are deleted first
+    (their vectors are tombstoned when the transaction commits, unless
+    still in use). Chunks are numbered from first_position.
+    """
+    if chunk_embeddings is None:
+        # One embedding batch for the whole document
+        chunk_embeddings = embed_chunks(chunks)
     
-    # 2. Character distribution (next 26 dimensions)
-    for char in string.ascii_lowercase:
-        idx = 20 + (ord(char) - ord('a'))
-        if idx < EMBED_DIM:
-            embedding[idx] = text.count(char) / max(len(text), 1)
+    # One writer at a time across threads and worker processes
+    with writer_lock():
+        provider = _active_provider(read_meta())
+        chunk_embeddings = _usable_embeddings(chunk_embeddings, provider)
+        with transaction.atomic():
+            if document.pk is None:
+                document.save()
+            elif replace:
+                delete_chunks(document.chunks.all())
+            hashes, vector_ids, first_id, vectors, new_texts = _assign_vectors(chunks, chunk_embeddings, provider)
+            DocumentChunk.objects.bulk_create(
+                [
+                    DocumentChunk(
+                        document=document, text=chunk_text, position=position,
+                        content_hash=content_hash, vector_id=vector_id
+                    )
+                    for position, (chunk_text, content_hash, vector_id)
+                    in enumerate(zip(chunks, hashes, vector_ids), start=first_position)
+                ],
+                batch_size=BULK_BATCH_SIZE
+            )
+            # Appended last so a failed insert never leaves orphan vectors,
+            # and before commit so a failed write rolls the rows back.
+            # Only new contents are written (one new segment, with their
+            # BM25 postings).
+            if len(vectors):
+                append_segment(first_id, vectors, new_texts, embedding=provider.describe())
     
-    # 3. Text length and structure features
-    if len(text) > 0:
-        embedding[46] = min(len(text) / 1000.0, 1.0)  # Normalized length
-        embedding[47] = len(words) / 100.0  # Word count
-        embedding[48] = len(set(words)) / max(len(words), 1)  # Vocabulary diversity
+    maybe_compact_in_background(embedding_dim())
+
+def index_document(title: str, text: str) -> Document:
+    """
+    Index a document with the configured embedding provider.
+    All chunk vectors go into FAISS with one matrix add and all chunk rows
+    are written with bulk_create inside a single transaction.
+    """
+    chunks = split_text(text)
+    document = Document(title=title)
+    _write_chunks(document, chunks)
     
-    # 4. Semantic keywords (positions 49-100)
-    keywords = {
-        'django': 49, 'python': 50, 'framework': 51, 'web': 52, 
-        'development': 53, 'database': 54, 'admin': 55, 'interface': 56,
-        'component': 57, 'reusable': 58, 'pluggability': 59, 'rapid': 60
-    }
+    trace(f"✅ Indexed {len(chunks)} chunks for document: {title}")
+    return document
+
+def index_document_batches(title: str, batches: Iterable[List[str]], on_batch=None) -> Document:
+    """
+    Index a document whose chunks arrive in batches. Each batch is written
+    (and searchable) as soon as it arrives, so memory holds one batch at a
+    time; on_batch(chunks_done, document) is called after each one. A batch
+    is a list of chunk texts, or a (texts, embed_chunks(texts)) pair when it
+    was embedded upstream.
+    """
+    document = Document(title=title)
+    chunks_done = 0
+    for batch in batches:
+        chunks, chunk_embeddings = batch if isinstance(batch, tuple) else (batch, None)
+        if not chunks:
+            continue
+        _write_chunks(document, chunks, chunk_embeddings=chunk_embeddings, first_position=chunks_done)
+        chunks_done += len(chunks)
+        if on_batch is not None:
+            on_batch(chunks_done, document)
+    if document.pk is None:
+        document.save()  # Empty file: keep the document so the upload is accounted for
     
-    for keyword, position in keywords.items():
-        if position < EMBED_DIM:
-            embedding[position] = text.count(keyword) / 10.0
+    trace(f"✅ Indexed {chunks_done} chunks for document: {title}")
+    return document
+
+def index_prepared_documents(prepared: List[tuple]) -> List[Document]:
+    """
+    Write several already chunked and embedded documents at once, given as
+    (title, content_hash, chunks, chunk_embeddings) tuples: one bulk_create
+    and one appended index segment for all of them, in a single transaction.
+    """
+    all_chunks = [chunk_text for _, _, chunks, _ in prepared for chunk_text in chunks]
     
-    # 5. Hash-based deterministic component (remainder)
-    text_hash = hashlib.md5(text.encode()).hexdigest()
-    for i in range(100, EMBED_DIM):
-        if i < EMBED_DIM:
-            # Use different parts of hash for different dimensions
-            hash_part = int(text_hash[(i-100)*2 % 32:(i-100)*2 % 32 + 2], 16)
-            embedding[i] = (hash_part / 255.0) * 0.5  # Scale down
+    with writer_lock():
+        provider = _active_provider(read_meta())
+        all_embeddings = {}
+        for _, _, _, chunk_embeddings in prepared:
+            all_embeddings.update(_usable_embeddings(chunk_embeddings, provider))
+        with transaction.atomic():
+            hashes, vector_ids, first_id, vectors, new_texts = _assign_vectors(all_chunks, all_embeddings, provider)
+            documents, rows = [], []
+            for title, content_hash, chunks, _ in prepared:
+                document = Document.objects.create(title=title, content_hash=content_hash)
+                documents.append(document)
+                for position, chunk_text in enumerate(chunks):
+                    i = len(rows)
+                    rows.append(DocumentChunk(
+                        document=document, text=chunk_text, position=position,
+                        content_hash=hashes[i], vector_id=vector_ids[i]
+                    ))
+            DocumentChunk.objects.bulk_create(rows, batch_size=BULK_BATCH_SIZE)
+            if len(vectors):
+                append_segment(first_id, vectors, new_texts, embedding=provider.describe())
     
-    # Normalize the embedding
-    norm = (sum(x*x for x in embedding) ** 0.5) or 1
-    embedding = [x / norm for x in embedding]
+    maybe_compact_in_background(embedding_dim())
+    return documents
+
+def reindex_document(document: Document, text: str) -> Document:
+    """Replace a document's content: old vectors are removed, new ones added"""
+    chunks = split_text(text)
+    _write_chunks(document, chunks, replace=True)
     
-    return embedding
+    trace(f"🔁 Re-indexed {len(chunks)} chunks for document: {document.title}")
+    return document
 
-def index_document(title: str, text: str) -> Document:
+def delete_document(document: Document):
+    """Delete a document, its chunks and (on commit) their vectors"""
+    title = document.title
+    document.delete()  # see signals.py for the vector cleanup
+    trace(f"🗑️ Deleted document: {title}")
+
+def delete_chunks(queryset):
+    """Delete chunk rows and tombstone their vectors once the transaction commits"""
+    vector_ids = list(queryset.values_list("vector_id", flat=True))
+    queryset.delete()
+    transaction.on_commit(lambda: delete_vectors(vector_ids))
+
+def delete_vectors(vector_ids: List[int]):
     """
-    Index a document using LOCAL embeddings only (no API calls)
+    Remove vectors no chunk uses any more from search (chunks with the same
+    content share a vector). They are tombstoned immediately (every worker
+    skips them on its next request) and physically removed by the next
+    compaction.
     """
-    # Create Document record
-    document = Document.objects.create(title=title)
-    
-    # Split text into chunks
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=200,
-        length_function=len
-    )
-    chunks = text_splitter.split_text(text)
-    
-    # Use local embeddings (no API calls)
-    chunk_embeddings = [simple_text_embedding(chunk) for chunk in chunks]
+    if not vector_ids:
+        return
+    vector_ids = list(set(vector_ids))
     
-    # Add to FAISS index and create DocumentChunk records
-    index = load_index()
+    # Under the writer lock so no writer reuses a vector while it is dropped
+    with writer_lock():
+        in_use = set()
+        for start in range(0, len(vector_ids), BULK_BATCH_SIZE):
+            in_use.update(
+                DocumentChunk.objects.filter(vector_id__in=vector_ids[start:start + BULK_BATCH_SIZE])
+                .values_list("vector_id", flat=True)
+            )
+        unused = [vector_id for vector_id in vector_ids if vector_id not in in_use]
+        for start in range(0, len(unused), BULK_BATCH_SIZE):
+            ChunkEmbedding.objects.filter(vector_id__in=unused[start:start + BULK_BATCH_SIZE]).delete()
+        if unused:
+            add_tombstones(unused)
+        else:
+            # Vectors still shared by other chunks now resolve to another
+            # document: a new generation makes every worker drop its chunk store
+            bump_generation()
+    if not unused:
+        return
+    # Answers built on these chunks are stale
+    invalidate_chunks(unused)
+    maybe_compact_in_background(embedding_dim())
+
+def rebuild_lexical_index(batch_size: int = 5000) -> int:
+    """
+    Build the BM25 postings of every indexed chunk from the chunk rows, e.g.
+    for chunks indexed before hybrid search existed. Returns the number of
+    distinct chunks indexed.
+    """
+    with writer_lock():
+        parts, ids, texts = [], [], []
+        last_id = None
+        # One text per vector (chunks with the same content share it)
+        rows = DocumentChunk.objects.order_by("vector_id", "id").values_list("vector_id", "text")
+        for vector_id, text in rows.iterator(chunk_size=batch_size):
+            if vector_id == last_id:
+                continue
+            last_id = vector_id
+            ids.append(vector_id)
+            texts.append(text)
+            if len(ids) >= batch_size:
+                parts.append(Postings.from_texts(ids, texts))
+                ids, texts = [], []
+        if ids:
+            parts.append(Postings.from_texts(ids, texts))
+        postings = Postings.merge(parts)
+        generation = publish_postings(postings)
+    trace(f"🔤 Built BM25 postings for {len(postings)} chunks (generation {generation})")
+    return len(postings)
+
+def find_orphan_vectors() -> List[int]:
+    """Ids stored in the index that no DocumentChunk row points to"""
+    ids, _ = export_vectors(load_index())
+    live = set(DocumentChunk.objects.values_list("vector_id", flat=True))
+    return [int(vector_id) for vector_id in ids if int(vector_id) not in live]
+
+def _chunk_cache_enabled() -> bool:
+    return getattr(settings, "RAG_CHUNK_CACHE", True)
+
+def fetch_chunks(vector_ids: List[int]) -> Dict[int, tuple]:
+    """
+    Resolve vector ids to (document_id, text, position) with at most one query.
+    Ids served by the process-local chunk store never touch the database.
+    """
+    global _chunk_store_generation
+    use_store = _chunk_cache_enabled()
+    if use_store:
+        # Entries are only valid for the index generation they were read in
+        generation = current_generation()
+        if _chunk_store_generation != generation:
+            _chunk_store.clear()
+            _chunk_store_generation = generation
+    found = {}
+    missing = []
+    for vector_id in vector_ids:
+        chunk = _chunk_store.get(vector_id) if use_store else None
+        if chunk is not None:
+            found[vector_id] = chunk
+        else:
+            missing.append(vector_id)
     
-    for i, (chunk_text, embedding) in enumerate(zip(chunks, chunk_embeddings)):
-        # Add to FAISS
-        vector_id = index.ntotal
-        embedding_array = np.array([embedding], dtype='float32')
-        index.add(embedding_array)
-        
-        # Create database record
-        DocumentChunk.objects.create(
-            document=document,
-            text=chunk_text,
-            vector_id=vector_id
+    if missing:
+        # A shared vector resolves to its oldest chunk
+        rows = DocumentChunk.objects.filter(vector_id__in=missing).order_by("-id").values_list(
+            "vector_id", "document_id", "text", "position"
         )
-    
-    # Save index
-    save_index()
-    
-    print(f"✅ Indexed {len(chunks)} chunks for document: {title}")
-    return document
+        for vector_id, document_id, text, position in rows:
+            found[vector_id] = (document_id, text, position)
+        if use_store:
+            for vector_id in missing:
+                if vector_id in found:
+                    _chunk_store.set(vector_id, found[vector_id])
+    return found
 
-def search_docs(query: str, k: int = 4) -> List[str]:
+def normalize_query(query: str) -> str:
+    """
+    The form of a query that is embedded and cached, so queries differing
+    only in case or spacing share their embedding and search results
+    """
+    return " ".join(query.lower().split())
+
+def embed_query(query: str, provider: Optional[EmbeddingProvider] = None) -> np.ndarray:
+    """Embed a search query (normalized) as a (1, dim) matrix, reusing cached embeddings"""
+    provider = provider or _active_provider()
+    query = normalize_query(query)
+    key = (provider.key, query)
+    query_array = _embedding_cache.get(key)
+    if query_array is None:
+        with span("query_embedding"):
+            query_array = provider.embed([query])
+        query_array.setflags(write=False)
+        _embedding_cache.set(key, query_array)
+    return query_array
+
+def _hybrid_enabled() -> bool:
+    return getattr(settings, "RAG_HYBRID_SEARCH", True)
+
+def _fuse_hits(vector_hits: List[tuple], lexical_hits: List[tuple]) -> tuple:
+    """
+    Merge FAISS (vector_id, distance) and BM25 (vector_id, score) hits by
+    reciprocal-rank fusion into (vector_id, distance, fused score, lexical
+    score), best first; the lexical score is the BM25 score relative to the
+    best one. Keyword hits below RAG_LEXICAL_MIN_SCORE of the best are left
+    out: a chunk matching only a common term (the "err" of every "ERR-..."
+    code) is no evidence, but rank fusion would weigh it like a rare exact
+    match and let it outrank one.
+    """
+    lexical = {}
+    if lexical_hits and lexical_hits[0][1] > 0:
+        best = lexical_hits[0][1]
+        min_score = best * getattr(settings, "RAG_LEXICAL_MIN_SCORE", 0.2)
+        lexical = {vector_id: score / best for vector_id, score in lexical_hits if score >= min_score}
+    distances = dict(vector_hits)
+    fused = reciprocal_rank_fusion([
+        (getattr(settings, "RAG_VECTOR_WEIGHT", 1.0), [vector_id for vector_id, _ in vector_hits]),
+        (getattr(settings, "RAG_LEXICAL_WEIGHT", 1.0), list(lexical)),
+    ])
+    return tuple(
+        (vector_id, distances.get(vector_id, float("inf")), score, lexical.get(vector_id, 0.0))
+        for vector_id, score in fused
+    )
+
+def _mmr_enabled() -> bool:
+    return getattr(settings, "RAG_MMR", True)
+
+def mmr_order(relevance: np.ndarray, vectors: np.ndarray, k: int, lambda_mult: float) -> List[int]:
+    """
+    Maximal marginal relevance: greedily pick the candidate maximizing
+    lambda_mult * relevance - (1 - lambda_mult) * (max cosine similarity to
+    the candidates already picked). Returns the first k picks (row numbers).
+    """
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    unit = vectors / np.maximum(norms, 1e-12)
+    similarity = unit @ unit.T
+    redundancy = np.full(len(relevance), -np.inf)
+    available = np.ones(len(relevance), dtype=bool)
+    order = []
+    for _ in range(min(k, len(relevance))):
+        marginal = lambda_mult * relevance - (1 - lambda_mult) * np.maximum(redundancy, 0.0)
+        marginal[~available] = -np.inf
+        pick = int(np.argmax(marginal))
+        order.append(pick)
+        available[pick] = False
+        redundancy = np.maximum(redundancy, similarity[pick])
+    return order
+
+def rerank_chunks(index, candidates: List[RetrievedChunk], k: int,
+                  query_vector: Optional[np.ndarray] = None) -> List[RetrievedChunk]:
     """
-    Search for relevant document chunks with LOCAL embeddings
+    Reorder candidates by MMR over their stored vectors, so near-duplicate
+    passages (such as overlapping neighbour chunks) do not crowd out other
+    information. Relevance comes from the evidence of each list, not from
+    the fused rank: the larger of the cosine similarity to query_vector and
+    the relative BM25 score, each scaled so the best candidate has 1, plus
+    a tenth of the smaller one so evidence from both lists breaks ties. A
+    sole strong keyword hit (an exact code) is thus as relevant as the best
+    vector hit and is not dropped for diversity.
     """
+    ids = [chunk.vector_id for chunk in candidates]
+    try:
+        vectors = index.reconstruct(ids)
+    except RuntimeError:
+        # Index type without stored vectors: embed the candidate texts
+        try:
+            vectors = embed_texts([chunk.text for chunk in candidates])
+        except EmbeddingError:
+            return candidates[:k]
+    similarity = np.zeros(len(candidates), dtype='float32')
+    if query_vector is not None:
+        unit = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        query_unit = query_vector.reshape(-1) / max(float(np.linalg.norm(query_vector)), 1e-12)
+        similarity = np.maximum(unit @ query_unit, 0.0)
+        similarity /= max(float(similarity.max()), 1e-12)
+    lexical = np.array([chunk.lexical_score for chunk in candidates], dtype='float32')
+    relevance = np.maximum(similarity, lexical) + 0.1 * np.minimum(similarity, lexical)
+    lambda_mult = getattr(settings, "RAG_MMR_LAMBDA", 0.7)
+    return [candidates[i] for i in mmr_order(relevance, vectors, k, lambda_mult)]
+
+def _join_span(chunks: List[RetrievedChunk]) -> RetrievedChunk:
+    """One result for chunks that follow each other in a document, without repeating their overlap"""
+    chunks = sorted(chunks, key=lambda chunk: chunk.position)
+    text = chunks[0].text
+    for chunk in chunks[1:]:
+        overlap = edge_overlap(text, chunk.text)
+        text += chunk.text[overlap:] if overlap else "\n" + chunk.text
+    best = max(chunks, key=lambda chunk: chunk.score)
+    return best._replace(
+        text=text,
+        distance=min(chunk.distance for chunk in chunks),
+        lexical_score=max(chunk.lexical_score for chunk in chunks),
+        position=chunks[0].position,
+        vector_ids=tuple(chunk.vector_id for chunk in chunks),
+    )
+
+def merge_adjacent(chunks: List[RetrievedChunk]) -> List[RetrievedChunk]:
+    """
+    Join results that follow each other in the same document into one span
+    each, ranked where the best of their chunks was
+    """
+    runs = {}  # rank of the first chunk of a run -> chunks of the run
+    by_document = {}
+    for rank, chunk in enumerate(chunks):
+        by_document.setdefault(chunk.document_id, []).append((rank, chunk))
+    for ranked in by_document.values():
+        ranked.sort(key=lambda item: item[1].position)
+        run = [ranked[0]]
+        for item in ranked[1:]:
+            if item[1].position == run[-1][1].position + 1:
+                run.append(item)
+            else:
+                runs[min(rank for rank, _ in run)] = [chunk for _, chunk in run]
+                run = [item]
+        runs[min(rank for rank, _ in run)] = [chunk for _, chunk in run]
+    return [run[0] if len(run) == 1 else _join_span(run) for _, run in sorted(runs.items())]
+
+def find_hits(query: str, k: int = 4) -> tuple:
+    """
+    (index, hits) of the FAISS and BM25 searches for a query, as
+    (vector_id, distance, fused score, lexical score) tuples, without
+    touching the database
+    """
+    global _result_cache_generation
     # Always load index first
     index = load_index()
     
     if index.ntotal == 0:
-        print("❌ FAISS index is empty")
-        return []
-    
-    print(f"🔍 Searching with index: {index.ntotal} vectors")
-    
-    # Generate query embedding locally
-    query_embedding = simple_text_embedding(query)
-    query_array = np.array([query_embedding], dtype='float32')
+        trace("❌ FAISS index is empty")
+        return index, []
     
-    # Search in FAISS
-    distances, indices = index.search(query_array, k)
+    # Cached hits are only valid for the index generation they came from
+    if _result_cache_generation != index.generation:
+        _result_cache.clear()
+        _result_cache_generation = index.generation
     
-    print(f"   FAISS Results - Indices: {indices[0]}")
-    print(f"   FAISS Results - Distances: {distances[0]}")
-    
-    # Get chunk texts from database
-    results = []
-    for vector_id in indices[0]:
-        if vector_id != -1:  # -1 means no result
-            try:
-                chunk = DocumentChunk.objects.get(vector_id=vector_id)
-                results.append(chunk.text)
-                print(f"✅ Found chunk for vector_id {vector_id}")
-            except DocumentChunk.DoesNotExist:
-                print(f"❌ No chunk found for vector_id {vector_id}")
-                continue
+    fetch_k = k * (MMR_OVERFETCH if _mmr_enabled() else SEARCH_OVERFETCH)
+    cache_key = (normalize_query(query), fetch_k)
+    hits = _result_cache.get(cache_key)
+    if hits is not None:
+        count_event("search_cache_hit")
+        trace(f"⚡ Search cache hit ({len(hits)} hits)")
+    else:
+        trace(f"🔍 Searching with index: {index.ntotal} vectors")
+        
+        vector_hits = []
+        # None while vectors of an embedding that is gone await re-embedding
+        provider = index_provider()
+        if provider is not None:
+            # Embed the query
+            query_array = embed_query(query, provider)
+            
+            # Search in FAISS
+            with span("faiss_search"):
+                distances, indices = index.search(query_array, fetch_k)
+            
+            trace(f"   FAISS Results - Indices: {indices[0]}")
+            trace(f"   FAISS Results - Distances: {distances[0]}")
+            
+            # -1 means no result
+            vector_hits = [
+                (int(vector_id), float(distance))
+                for vector_id, distance in zip(indices[0], distances[0])
+                if vector_id != -1
+            ]
+        lexical_hits = []
+        if _hybrid_enabled():
+            with span("bm25_search"):
+                lexical_hits = index.search_lexical(query, fetch_k)
+            trace(f"   BM25 Results - Ids: {[vector_id for vector_id, _ in lexical_hits]}")
+        hits = _fuse_hits(vector_hits, lexical_hits)
+        _result_cache.set(cache_key, hits)
+    return index, hits
+
+def select_chunks(index, query: str, hits: List[tuple], chunks: Dict[int, tuple], k: int) -> List[RetrievedChunk]:
+    """The k results of find_hits hits resolved to chunks (by fetch_chunks): deduplicated, reranked and merged"""
+    if not hits:
+        return []
+    candidates = []
+    seen = set()
+    duplicates = 0
+    for vector_id, distance, score, lexical_score in hits:
+        if vector_id not in chunks:
+            trace(f"❌ No chunk found for vector_id {vector_id}")
+            continue
+        document_id, text, position = chunks[vector_id]
+        # Same content under another vector (indexed before vectors were shared)
+        content_hash = chunk_hash(text)
+        if content_hash in seen:
+            duplicates += 1
+            continue
+        seen.add(content_hash)
+        candidates.append(RetrievedChunk(
+            vector_id, document_id, text, distance, score, position, lexical_score=lexical_score
+        ))
     
-    print(f"📊 Final search results: {len(results)} chunks")
+    if duplicates:
+        trace(f"   Collapsed {duplicates} duplicate hits")
+    if _mmr_enabled() and len(candidates) > 1:
+        with span("rerank"):
+            # Cached since the search (None without vector search)
+            provider = index_provider()
+            query_vector = embed_query(query, provider) if provider is not None else None
+            candidates = rerank_chunks(index, candidates, len(candidates), query_vector)
+    if getattr(settings, "RAG_MERGE_ADJACENT", True):
+        results = merge_adjacent(candidates[:k])
+        merged = sum(len(chunk.vector_ids) for chunk in results if chunk.vector_ids)
+        if merged:
+            trace(f"   Merged {merged} adjacent chunks into spans")
+    else:
+        results = candidates[:k]
+    trace(f"📊 Final search results: {len(results)} chunks")
     return results
 
+def search_chunks(query: str, k: int = 4) -> List[RetrievedChunk]:
+    """
+    Search for relevant document chunks by embedding similarity, fused with
+    BM25 keyword matches (exact codes, names, error strings) when
+    RAG_HYBRID_SEARCH is on. With RAG_MMR, more candidates are fetched and
+    reranked for diversity; with RAG_MERGE_ADJACENT, neighbouring chunks of
+    a document come back as one span.
+    """
+    index, hits = find_hits(query, k)
+    # Resolve all hits at once
+    with span("chunk_fetch"):
+        chunks = fetch_chunks([vector_id for vector_id, _, _, _ in hits])
+    return select_chunks(index, query, hits, chunks, k)
+
+# From async code, FAISS, BM25 and the reranking run in a thread pool
+# (concurrent searches use separate threads), while the chunk fetch stays
+# on the thread Django keeps for sync code and its database connection
+_afind_hits = sync_to_async(find_hits, thread_sensitive=False)
+_afetch_chunks = sync_to_async(fetch_chunks)
+_aselect_chunks = sync_to_async(select_chunks, thread_sensitive=False)
+
+async def asearch_chunks(query: str, k: int = 4) -> List[RetrievedChunk]:
+    """Async version of search_chunks"""
+    index, hits = await _afind_hits(query, k)
+    with span("chunk_fetch"):
+        chunks = await _afetch_chunks([vector_id for vector_id, _, _, _ in hits])
+    return await _aselect_chunks(index, query, hits, chunks, k)
+
+def search_docs(query: str, k: int = 4) -> List[str]:
+    """
+    Search for relevant document chunks and return their texts
+    """
+    return [chunk.text for chunk in search_chunks(query, k)]
+
 def get_index_stats():
     """Get statistics about the FAISS index"""
     index = load_index()
+    stamp = index_embedding()
     return {
         "total_vectors": index.ntotal,
         "vector_dimension": index.d,
+        "generation": current_generation(),
+        "segments": len(read_meta().get("segments", [])),
+        "deleted_vectors": len(read_meta().get("tombstones", [])),
         "documents_count": Document.objects.count(),
-        "chunks_count": DocumentChunk.objects.count()
+        "chunks_count": DocumentChunk.objects.count(),
+        "distinct_chunks": ChunkEmbedding.objects.count(),
+        "embedding": stamp,
+        "embedding_current": stamp is None or embedding_matches(stamp, get_provider()),
+        "lexical": index.lexical.stats(),
+        "cache": get_cache_stats()
+    }
+
+def get_cache_stats():
+    """Hit/miss counters of the query embedding, search result and chunk caches, and the response cache size"""
+    return {
+        "query_embeddings": _embedding_cache.stats(),
+        "chunks": _chunk_store.stats(),
+        "search_results": _result_cache.stats(),
+        "responses": get_response_cache_stats(),
     }
\ No newline at end of file
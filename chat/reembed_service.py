@@ -0,0 +1,192 @@
+# chat/reembed_service.py
+import os
+import time
+import threading
+from contextlib import contextmanager
+from typing import Optional
+import numpy as np
+from django.db import connection
+
+from .embedding_service import EmbeddingProvider, embedding_matches, get_provider
+from .index_service import (
+    build_index, get_index_type, index_dir, index_path, index_type_of, new_index, open_index,
+    publish_index, read_meta, remove_vectors, writer_lock
+)
+from .metrics_service import trace
+from .models import DocumentChunk
+from . import rag_service
+
+# Re-embedding swaps the vectors of the whole index without downtime:
+#
+# 1. Every distinct chunk text is embedded with the configured provider, under
+#    the same vector ids, and built into a new in-memory index of the type of
+#    the published one (trained on the new vectors when the type needs it).
+#    The published index keeps serving, and keeps taking new documents
+#    (embedded with the provider it is stamped with).
+# 2. Chunks written meanwhile (always higher vector ids) are caught up, once
+#    without and once with the writer lock held, and vectors deleted
+#    meanwhile are dropped.
+# 3. The new index is published with the new embedding stamp. Chunk rows
+#    and BM25 postings stay valid as they are keyed by vector id.
+
+REEMBED_BATCH_SIZE = 512  # Chunk texts per embedding call
+
+_process_lock = threading.Lock()
+_reembed_thread = None
+
+try:
+    import fcntl
+except ImportError:  # Windows: only in-process locking is available
+    fcntl = None
+
+
+@contextmanager
+def _builder_lock():
+    """
+    Non-blocking lock held by the one process (and thread) building a
+    re-embedded index. Yields whether it was acquired.
+    """
+    if not _process_lock.acquire(blocking=False):
+        yield False
+        return
+    try:
+        if fcntl is None:
+            yield True
+            return
+        os.makedirs(index_dir(), exist_ok=True)
+        with open(os.path.join(index_dir(), "faiss_index.reembed.lock"), "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    finally:
+        _process_lock.release()
+
+
+def _embed_chunks_after(provider: EmbeddingProvider, after: int, batch_size: int):
+    """
+    (ids, vectors) of every distinct chunk with a vector id above after,
+    sorted by id
+    """
+    ids, texts = [], []
+    id_parts, vector_parts = [], []
+    last_id = after
+    done = 0
+    rows = DocumentChunk.objects.filter(vector_id__gt=after).order_by("vector_id", "id").values_list(
+        "vector_id", "text"
+    )
+
+    def flush():
+        nonlocal done
+        id_parts.append(np.array(ids, dtype='int64'))
+        vector_parts.append(provider.embed(texts))
+        done += len(ids)
+        ids.clear()
+        texts.clear()
+
+    # One text per vector (chunks with the same content share it)
+    for vector_id, text in rows.iterator(chunk_size=batch_size):
+        if vector_id == last_id:
+            continue
+        last_id = vector_id
+        ids.append(vector_id)
+        texts.append(text)
+        if len(ids) >= batch_size:
+            flush()
+            if done % (batch_size * 20) == 0:
+                trace(f"   Re-embedded {done} chunks...")
+    if ids:
+        flush()
+    if not id_parts:
+        return np.zeros(0, dtype='int64'), np.zeros((0, provider.dim), dtype='float32')
+    return np.concatenate(id_parts), np.vstack(vector_parts)
+
+
+def _published_index_type() -> str:
+    """Type of the published base index, so re-embedding keeps what rebuild_index chose"""
+    if os.path.exists(index_path()):
+        index_type = index_type_of(open_index())
+        if index_type is not None:
+            return index_type
+    return get_index_type()
+
+
+def _build(ids: np.ndarray, vectors: np.ndarray, index_type: str, dim: int):
+    """Index of index_type over the re-embedded vectors (flat when that type can't take them)"""
+    if not len(ids):
+        return new_index(dim)
+    try:
+        return build_index(vectors, index_type, ids=ids)
+    except (ValueError, RuntimeError) as e:
+        # e.g. RAG_PQ_M no longer divides the new dimension
+        trace(f"⚠️ Can't build a '{index_type}' index of the re-embedded vectors ({e}), building a flat one")
+        return build_index(vectors, "flat", ids=ids)
+
+
+def _last_id(ids: np.ndarray, after: int) -> int:
+    return int(ids[-1]) if len(ids) else after
+
+
+def reembed_index(batch_size: int = REEMBED_BATCH_SIZE, force: bool = False) -> Optional[int]:
+    """
+    Rebuild the vector index from the stored chunk texts with the
+    configured embedding provider while the published index keeps serving,
+    then switch over atomically. With force, re-embed even when the stamp
+    already matches. Returns the new generation, or None when there was
+    nothing to do or another process is already re-embedding.
+    """
+    provider = get_provider()
+    stamp = rag_service.index_embedding(read_meta())
+    if not force and (stamp is None or embedding_matches(stamp, provider)):
+        return None
+
+    with _builder_lock() as acquired:
+        if not acquired:
+            trace("⏭️ Re-embedding already running in another process")
+            return None
+        index_type = _published_index_type()
+        trace(f"🧬 Re-embedding the index with {provider.key} into a '{index_type}' index (was {stamp})...")
+        start = time.perf_counter()
+        ids, vectors = _embed_chunks_after(provider, -1, batch_size)
+        # Most chunks written meanwhile are caught up before training, without blocking writers
+        more_ids, more_vectors = _embed_chunks_after(provider, _last_id(ids, -1), batch_size)
+        ids, vectors = np.concatenate([ids, more_ids]), np.vstack([vectors, more_vectors])
+        index = _build(ids, vectors, index_type, provider.dim)
+
+        with writer_lock():
+            more_ids, more_vectors = _embed_chunks_after(provider, _last_id(ids, -1), batch_size)
+            if len(more_ids):
+                index.add_with_ids(more_vectors, more_ids)
+                ids = np.concatenate([ids, more_ids])
+            # Drop the vectors whose chunks were deleted meanwhile
+            live = np.array(sorted(set(DocumentChunk.objects.values_list("vector_id", flat=True))), dtype='int64')
+            dead = ids[~np.isin(ids, live)]
+            index = remove_vectors(index, dead)
+            generation = publish_index(index, drop_ids=dead.tolist(), embedding=provider.describe())
+
+    trace(f"✅ Re-embedded {index.ntotal} vectors in {time.perf_counter() - start:.1f}s "
+          f"(generation {generation})")
+    return generation
+
+
+def reembed_in_background():
+    """Start re-embedding the index in a background thread, unless one is already running"""
+    global _reembed_thread
+    if _reembed_thread is not None and _reembed_thread.is_alive():
+        return
+
+    def run():
+        try:
+            reembed_index()
+        except Exception as e:
+            trace(f"❌ Background re-embedding failed: {e}")
+        finally:
+            connection.close()  # The thread's own database connection
+
+    _reembed_thread = threading.Thread(target=run, name="reembedding", daemon=True)
+    _reembed_thread.start()
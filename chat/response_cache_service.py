@@ -0,0 +1,151 @@
+# chat/response_cache_service.py
+import re
+import json
+import hashlib
+from datetime import timedelta
+from typing import Iterable, List, Optional
+import numpy as np
+from django.conf import settings
+from django.db.models import Count, F, Q, Sum
+from django.utils import timezone
+
+from .metrics_service import count_event, trace
+from .models import CachedResponse
+
+# Chunk ids per OR-ed LIKE filter when invalidating
+INVALIDATE_BATCH = 100
+
+_SPACE_RE = re.compile(r"\s+")
+
+
+def cache_enabled() -> bool:
+    return getattr(settings, "RAG_RESPONSE_CACHE", True)
+
+
+def normalize_question(question: str) -> str:
+    """Case, whitespace and trailing punctuation don't change the answer"""
+    return _SPACE_RE.sub(" ", question.lower()).strip().rstrip("?!.").strip()
+
+
+def _sha256(*parts: str) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _context_key(template: str, chunk_ids: Iterable[int], extra: str) -> str:
+    """Everything the answer depends on besides the question"""
+    return _sha256(template, json.dumps(sorted(int(i) for i in chunk_ids)), extra)
+
+
+def _embed(question: str) -> bytes:
+    from .rag_service import embed_query  # rag_service imports this module
+    return embed_query(question)[0].astype("float32").tobytes()
+
+
+def _fresh(queryset):
+    ttl = getattr(settings, "RAG_RESPONSE_CACHE_TTL", None)
+    if ttl:
+        queryset = queryset.filter(created_at__gte=timezone.now() - timedelta(seconds=ttl))
+    return queryset
+
+
+def lookup(template: str, question: str, chunk_ids: Iterable[int], extra: str = "") -> Optional[str]:
+    """
+    Cached response for this prompt template, question and retrieved chunk
+    set, or None. With RAG_RESPONSE_CACHE_SIMILARITY set, a differently
+    worded question over the same chunks also matches when the cosine
+    similarity of the question embeddings reaches it.
+    """
+    if not cache_enabled():
+        return None
+    context_key = _context_key(template, chunk_ids, extra)
+    normalized = normalize_question(question)
+    candidates = _fresh(CachedResponse.objects.filter(context_key=context_key))
+
+    entry = candidates.filter(key=_sha256(context_key, normalized)).only("id", "response").first()
+    threshold = getattr(settings, "RAG_RESPONSE_CACHE_SIMILARITY", None)
+    if entry is None and threshold:
+        query = np.frombuffer(_embed(normalized), dtype="float32")
+        best_score = threshold
+        for candidate in candidates.exclude(question_embedding=None).only("id", "response", "question_embedding"):
+            score = float(np.dot(np.frombuffer(candidate.question_embedding, dtype="float32"), query))
+            if score >= best_score:
+                entry, best_score = candidate, score
+    if entry is None:
+        return None
+
+    CachedResponse.objects.filter(id=entry.id).update(hits=F("hits") + 1, last_used_at=timezone.now())
+    count_event("response_cache_hit")
+    trace(f"⚡ Response cache hit (entry {entry.id})")
+    return entry.response
+
+
+def store(template: str, question: str, chunk_ids: Iterable[int], response: str, extra: str = "",
+          keyed_on_chunks: bool = True):
+    """
+    Cache a response, then evict expired and least recently used entries.
+    With keyed_on_chunks=False the entry is looked up without chunk ids
+    (extra must then identify the context); chunk_ids still let
+    invalidate_chunks drop it.
+    """
+    if not cache_enabled() or not response:
+        return
+    chunk_ids = sorted(int(i) for i in chunk_ids)
+    context_key = _context_key(template, chunk_ids if keyed_on_chunks else (), extra)
+    normalized = normalize_question(question)
+    embedding = _embed(normalized) if getattr(settings, "RAG_RESPONSE_CACHE_SIMILARITY", None) else None
+    CachedResponse.objects.update_or_create(
+        key=_sha256(context_key, normalized),
+        defaults={
+            "context_key": context_key,
+            "question": normalized,
+            "question_embedding": embedding,
+            # Delimited on both sides so invalidate_chunks can match ",<id>,"
+            "chunk_ids": "," + ",".join(map(str, chunk_ids)) + ",",
+            "response": str(response),  # Plain str: parsers may return str subclasses
+        },
+    )
+    evict()
+
+
+def evict():
+    """Drop expired entries and keep at most RAG_RESPONSE_CACHE_MAX_ENTRIES, least recently used first"""
+    ttl = getattr(settings, "RAG_RESPONSE_CACHE_TTL", None)
+    if ttl:
+        CachedResponse.objects.filter(created_at__lt=timezone.now() - timedelta(seconds=ttl)).delete()
+    max_entries = getattr(settings, "RAG_RESPONSE_CACHE_MAX_ENTRIES", 10000)
+    stale = list(
+        CachedResponse.objects.order_by("-last_used_at").values_list("id", flat=True)[max_entries:]
+    )
+    if stale:
+        CachedResponse.objects.filter(id__in=stale).delete()
+
+
+def invalidate_chunks(vector_ids: List[int]) -> int:
+    """
+    Delete responses built on any of these chunks. Vector ids are never
+    reused, so such entries could not be hit again anyway; this frees them
+    right away instead of waiting for eviction.
+    """
+    deleted = 0
+    vector_ids = list(vector_ids)
+    for start in range(0, len(vector_ids), INVALIDATE_BATCH):
+        condition = Q()
+        for vector_id in vector_ids[start:start + INVALIDATE_BATCH]:
+            condition |= Q(chunk_ids__contains=f",{int(vector_id)},")
+        deleted += CachedResponse.objects.filter(condition).delete()[0]
+    if deleted:
+        trace(f"🗑️ Invalidated {deleted} cached responses")
+    return deleted
+
+
+def clear():
+    CachedResponse.objects.all().delete()
+
+
+def get_response_cache_stats() -> dict:
+    stats = CachedResponse.objects.aggregate(entries=Count("id"), hits=Sum("hits"))
+    return {"entries": stats["entries"], "hits": stats["hits"] or 0}
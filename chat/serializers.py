@@ -1,5 +1,5 @@
 from rest_framework import serializers
-from .models import ChatSession, Message
+from .models import ChatSession, IngestionJob, Message
 
 
 class MessageSerializer(serializers.ModelSerializer):
@@ -14,3 +14,20 @@ class ChatSessionSerializer(serializers.ModelSerializer):
     class Meta:
         model = ChatSession
         fields = ['id', 'title', 'created_at', 'messages']
+
+
+class IngestionJobSerializer(serializers.ModelSerializer):
+    progress = serializers.SerializerMethodField()
+
+    class Meta:
+        model = IngestionJob
+        fields = [
+            'id', 'file_name', 'status', 'document', 'total_chunks', 'processed_chunks',
+            'progress', 'error', 'stats', 'created_at', 'started_at', 'finished_at'
+        ]
+
+    def get_progress(self, job):
+        """Share of chunks indexed, None until the total is known"""
+        if not job.total_chunks:
+            return 1.0 if job.status == 'done' else None
+        return job.processed_chunks / job.total_chunks
@@ -0,0 +1,17 @@
+from django.db import transaction
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+from .models import Document
+
+
+@receiver(pre_delete, sender=Document)
+def remove_document_vectors(sender, instance, **kwargs):
+    """
+    Deleting a Document (admin, shell, queryset) cascades to its chunks;
+    tombstone their vectors once the delete is committed so they stop
+    showing up in search results.
+    """
+    from .rag_service import delete_vectors
+
+    vector_ids = list(instance.chunks.values_list("vector_id", flat=True))
+    transaction.on_commit(lambda: delete_vectors(vector_ids))
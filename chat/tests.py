@@ -1,3 +1,712 @@
-from django.test import TestCase
+import io
+import os
+import json
+import random
+import shutil
+import tempfile
+import threading
+import zipfile
+from datetime import timedelta
+from typing import Any, List
+from unittest import mock
 
-# Create your tests here.
+# agent_service builds its OpenAI client at import; the tests never call it
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+
+import httpx
+import numpy as np
+from asgiref.sync import async_to_sync
+from django.core.management import call_command
+from django.db import connection
+from django.db.backends.utils import CursorWrapper
+from django.test import AsyncClient, SimpleTestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import Field
+
+from . import agent_service, history_service, index_service, lexical_service, pipeline_service, rag_service
+from .cache_service import LRUCache
+from .embedding_service import EmbeddingError, OpenAICompatibleEmbedding
+from .models import CachedResponse, ChatSession, ChunkEmbedding, Document, DocumentChunk, Message
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Local stand-in for the OpenAI chat model: answers with the scripted
+    AIMessages in order, streaming them word by word, and records the
+    messages and tool_choice of every call.
+    """
+    responses: List[AIMessage]
+    calls: List[Any] = Field(default_factory=list)
+    tool_choices: List[Any] = Field(default_factory=list)
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def bind_tools(self, tools, tool_choice=None, **kwargs):
+        self.tool_choices.append(tool_choice)
+        return self
+
+    def _next(self, messages) -> AIMessage:
+        self.calls.append(list(messages))
+        return self.responses.pop(0)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        return ChatResult(generations=[ChatGeneration(message=self._next(messages))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        message = self._next(messages)
+        for word in message.content.split(" ") if message.content else []:
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word + " "))
+        for i, tool_call in enumerate(message.tool_calls):
+            yield ChatGenerationChunk(message=AIMessageChunk(content="", tool_call_chunks=[{
+                "name": tool_call["name"], "args": json.dumps(tool_call["args"]), "id": tool_call["id"], "index": i,
+            }]))
+
+
+def search_call(query: str, call_id: str = "call-1") -> dict:
+    return {"name": "search_documents", "args": {"query": query}, "id": call_id}
+
+
+def tool_turn(*queries: str) -> AIMessage:
+    return AIMessage(content="", tool_calls=[search_call(query, f"call-{i}") for i, query in enumerate(queries)])
+
+
+@override_settings(RAG_TRACE=False, RAG_HISTORY_SUMMARY=False)
+class RagTestCase(TransactionTestCase):
+    """
+    Tests with the FAISS index in a temporary directory and the local
+    embedding (TransactionTestCase: searches may run in other threads)
+    """
+
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.index_dir, ignore_errors=True)
+        settings_override = override_settings(RAG_INDEX_DIR=self.index_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.reset_rag_state()
+        self.addCleanup(self.reset_rag_state)
+
+    def reset_rag_state(self):
+        rag_service._index = None
+        rag_service._chunk_store.clear()
+        rag_service._chunk_store_generation = None
+        rag_service._embedding_cache.clear()
+        rag_service._result_cache.clear()
+        rag_service._result_cache_generation = None
+        rag_service._index_providers.clear()
+
+
+class AgentTestCase(RagTestCase):
+    """Agent tests against FakeChatModel"""
+
+    def setUp(self):
+        super().setUp()
+        self.document = rag_service.index_document(
+            "gears.txt", "The W-100 gearbox uses helical gears and needs oil every 500 hours."
+        )
+
+    def use_llm(self, *responses: AIMessage) -> FakeChatModel:
+        llm = FakeChatModel(responses=list(responses))
+        patcher = mock.patch.object(agent_service, "llm", llm)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return llm
+
+
+class AgentLoopTests(AgentTestCase):
+
+    def test_answers_from_tool_results(self):
+        llm = self.use_llm(tool_turn("W-100 gearbox oil"), AIMessage(content="Every 500 hours."))
+
+        reply = agent_service.run_agent("How often does the W-100 need oil?", [])
+
+        self.assertEqual(reply, "Every 500 hours.")
+        self.assertEqual(llm.tool_choices, ["auto", "auto"])
+        tool_messages = [m for m in llm.calls[1] if isinstance(m, ToolMessage)]
+        self.assertEqual(len(tool_messages), 1)
+        self.assertIn("500 hours", tool_messages[0].content)
+        self.assertEqual(set(tool_messages[0].artifact), set(self.document.chunks.values_list("vector_id", flat=True)))
+
+    def test_last_iteration_cannot_call_tools(self):
+        llm = self.use_llm(
+            tool_turn("gearbox"), tool_turn("helical gears"), AIMessage(content="Helical gears, oiled every 500 hours.")
+        )
+
+        reply = agent_service.run_agent("Tell me about the gearbox", [])
+
+        self.assertEqual(reply, "Helical gears, oiled every 500 hours.")
+        self.assertEqual(len(llm.calls), agent_service.MAX_ITERATIONS)
+        self.assertEqual(llm.tool_choices, ["auto"] * (agent_service.MAX_ITERATIONS - 1) + ["none"])
+
+    def test_tool_calls_of_a_turn_run_in_parallel(self):
+        queries = ["gearbox", "oil", "helical gears"]
+        # Every search waits for the others: this only passes when they run concurrently
+        barrier = threading.Barrier(len(queries), timeout=5)
+        budgets = []
+
+        def search(query, k, budget):
+            barrier.wait()
+            budgets.append(budget)
+            return f"result for {query}", [queries.index(query)]
+
+        with mock.patch.object(agent_service, "search_documents_tool", side_effect=search):
+            tool_messages = agent_service._run_tools(tool_turn(*queries).tool_calls, 900)
+
+        self.assertEqual([m.content for m in tool_messages], [f"result for {q}" for q in queries])
+        self.assertEqual([m.tool_call_id for m in tool_messages], ["call-0", "call-1", "call-2"])
+        self.assertEqual(budgets, [300, 300, 300])
+
+    def test_tool_errors_are_reported_to_the_model(self):
+        tool_message = agent_service._invoke_tool({"name": "unknown_tool", "args": {}, "id": "call-9"})
+        self.assertEqual(tool_message.tool_call_id, "call-9")
+        self.assertIn("Unknown tool", tool_message.content)
+
+    def test_all_versions_share_the_loop(self):
+        question = "How often does the W-100 need oil?"
+        turns = [tool_turn("gearbox"), tool_turn("oil"), AIMessage(content="Every 500 hours.")]
+
+        async def astream(*args):
+            return [token async for token in agent_service.astream_agent(*args)]
+
+        agents = [
+            agent_service.run_agent,
+            lambda *args: list(agent_service.stream_agent(*args)),
+            async_to_sync(agent_service.arun_agent),
+            async_to_sync(astream),
+        ]
+        replies = []
+        for agent in agents:
+            llm = self.use_llm(*turns)
+            # A new conversation each time, so no answer comes from the cache
+            reply = agent(question, [(f"Question {len(replies)}", "Answer")])
+            replies.append("".join(reply).strip())
+            self.assertEqual(llm.tool_choices, ["auto", "auto", "none"])
+            self.assertEqual(len([m for m in llm.calls[-1] if isinstance(m, ToolMessage)]), 2)
+
+        self.assertEqual(replies, ["Every 500 hours."] * 4)
+        self.assertEqual(CachedResponse.objects.count(), 4)
+
+    def test_streams_the_final_answer(self):
+        self.use_llm(tool_turn("gearbox oil"), AIMessage(content="Every 500 hours."))
+
+        tokens = list(agent_service.stream_agent("How often does the W-100 need oil?", []))
+
+        self.assertEqual("".join(tokens).strip(), "Every 500 hours.")
+        self.assertGreater(len(tokens), 1)
+
+
+class AgentCacheTests(AgentTestCase):
+
+    def test_repeated_question_is_answered_from_the_cache(self):
+        question = "How often does the W-100 need oil?"
+        self.use_llm(tool_turn("W-100 gearbox oil"), AIMessage(content="Every 500 hours."))
+        agent_service.run_agent(question, [])
+        self.assertEqual(CachedResponse.objects.count(), 1)
+
+        # Same question over the same index: no LLM call at all
+        llm = self.use_llm()
+        reply = agent_service.run_agent(question.lower(), [])
+        tokens = list(agent_service.stream_agent(question, []))
+
+        self.assertEqual(reply, "Every 500 hours.")
+        self.assertEqual(tokens, ["Every 500 hours."])
+        self.assertEqual(llm.calls, [])
+
+    def test_index_changes_miss_the_cache(self):
+        question = "How often does the W-100 need oil?"
+        self.use_llm(tool_turn("W-100 gearbox oil"), AIMessage(content="Every 500 hours."))
+        agent_service.run_agent(question, [])
+
+        rag_service.index_document("w200.txt", "The W-200 gearbox needs oil every 800 hours.")
+        llm = self.use_llm(tool_turn("W-100 gearbox oil"), AIMessage(content="Still every 500 hours."))
+
+        self.assertEqual(agent_service.run_agent(question, []), "Still every 500 hours.")
+        self.assertEqual(len(llm.calls), 2)
+
+    def test_changed_chunks_invalidate_the_cached_answer(self):
+        self.use_llm(tool_turn("W-100 gearbox oil"), AIMessage(content="Every 500 hours."))
+        agent_service.run_agent("How often does the W-100 need oil?", [])
+
+        rag_service.reindex_document(self.document, "The W-100 gearbox needs oil every 250 hours.")
+
+        self.assertEqual(CachedResponse.objects.count(), 0)
+
+    def test_answers_without_search_are_not_cached(self):
+        self.use_llm(AIMessage(content="Hello!"))
+        agent_service.run_agent("Hi", [])
+        self.assertEqual(CachedResponse.objects.count(), 0)
+
+
+class AsyncAgentTests(AgentTestCase):
+
+    async def test_database_is_only_used_from_the_sync_thread(self):
+        # Queries from a thread pool would open connections nobody closes
+        threads = set()
+        execute = CursorWrapper.execute
+
+        def recording_execute(cursor, *args, **kwargs):
+            threads.add(threading.current_thread())
+            return execute(cursor, *args, **kwargs)
+
+        self.use_llm(tool_turn("gearbox", "oil"), AIMessage(content="Every 500 hours."))
+        with mock.patch.object(CursorWrapper, "execute", recording_execute):
+            reply = await agent_service.arun_agent("How often does the W-100 need oil?", [])
+
+        self.assertEqual(reply, "Every 500 hours.")
+        self.assertEqual(threads, {threading.main_thread()})
+
+
+@override_settings(ALLOWED_HOSTS=["testserver"])
+class AgentEndpointTests(AgentTestCase):
+
+    def test_agent_endpoint(self):
+        self.use_llm(tool_turn("gearbox oil"), AIMessage(content="Every 500 hours."))
+
+        response = self.client.post("/api/agent/", {"message": "How often does the W-100 need oil?"})
+
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body["assistant_message"]["content"], "Every 500 hours.")
+        self.assertEqual(
+            list(Message.objects.filter(session_id=body["session_id"]).values_list("role", flat=True)),
+            ["user", "assistant"],
+        )
+
+    def test_agent_endpoint_streams_server_sent_events(self):
+        self.use_llm(tool_turn("gearbox oil"), AIMessage(content="Every 500 hours."))
+
+        response = self.client.post("/api/agent/", {"message": "How often?", "stream": "true"})
+
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        frames = b"".join(response.streaming_content).decode().strip().split("\n\n")
+        events = [frame.split("\n")[0].removeprefix("event: ") for frame in frames]
+        self.assertEqual(events[0], "start")
+        self.assertEqual(events[-1], "done")
+        self.assertIn("token", events)
+        done = json.loads(frames[-1].split("\n")[1].removeprefix("data: "))
+        self.assertEqual(done["assistant_message"]["content"].strip(), "Every 500 hours.")
+
+    async def test_async_agent_endpoint(self):
+        self.use_llm(tool_turn("gearbox oil"), AIMessage(content="Every 500 hours."))
+
+        response = await AsyncClient().post("/api/async/agent/", {"message": "How often does the W-100 need oil?"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["assistant_message"]["content"], "Every 500 hours.")
+
+
+class ChunkStoreTests(RagTestCase):
+
+    def test_shared_vector_follows_the_remaining_document(self):
+        text = "Torque specs for the W-100 gearbox: 45 Nm."
+        first = rag_service.index_document("first.txt", text)
+        second = rag_service.index_document("second.txt", text)
+        vector_id = first.chunks.get().vector_id
+        self.assertEqual(rag_service.fetch_chunks([vector_id])[vector_id][0], first.id)
+
+        rag_service.delete_document(first)
+
+        self.assertEqual(rag_service.fetch_chunks([vector_id])[vector_id][0], second.id)
+
+    @override_settings(RAG_CHUNK_CACHE=True)
+    def test_store_is_bounded(self):
+        rag_service.index_document("parts.txt", "\n\n".join(f"Part {i}: " + "x" * 990 for i in range(5)))
+        vector_ids = list(DocumentChunk.objects.values_list("vector_id", flat=True))
+        with mock.patch.object(rag_service, "_chunk_store", LRUCache(2)):
+            self.assertEqual(len(rag_service.fetch_chunks(vector_ids)), len(vector_ids))
+            self.assertEqual(len(rag_service._chunk_store), 2)
+
+
+class LexicalIndexTests(SimpleTestCase):
+
+    def test_compound_tokens_are_indexed_whole_and_in_parts(self):
+        self.assertEqual(
+            lexical_service.tokenize("The ERR-3005 fix is in v2.1"),
+            ["err-3005", "err", "3005", "fix", "v2.1", "v2", "1"],
+        )
+
+    def test_rare_terms_outweigh_common_ones(self):
+        texts = {1: "pump seal leak", 2: "pump seal", 3: "pump filter", 4: "pump motor", 5: "valve seal"}
+        index = lexical_service.LexicalIndex([lexical_service.Postings.from_texts(texts, texts.values())])
+
+        hits = index.search("pump leak", k=5)
+
+        self.assertEqual(hits[0][0], 1)
+        self.assertEqual({vector_id for vector_id, _ in hits}, {1, 2, 3, 4})
+        self.assertGreater(hits[0][1], 2 * hits[1][1])
+
+    def test_parts_search_like_their_merge_without_dropped_ids(self):
+        first = lexical_service.Postings.from_texts([1, 2], ["gear oil", "gear box"])
+        second = lexical_service.Postings.from_texts([3, 4], ["oil filter", "gear oil change"])
+        parts = lexical_service.LexicalIndex([first, second])
+        merged = lexical_service.LexicalIndex([lexical_service.Postings.merge([first, second], drop_ids=[4])])
+
+        self.assertEqual(
+            [vector_id for vector_id, _ in parts.search("gear oil", k=4, exclude=np.array([4]))],
+            [vector_id for vector_id, _ in merged.search("gear oil", k=4)],
+        )
+        self.assertNotIn(4, [vector_id for vector_id, _ in merged.search("change", k=4)])
+
+
+class SegmentedIndexTests(RagTestCase):
+
+    manuals = {
+        "pumps.txt": "Alpha pumps need new seals every year.",
+        "valves.txt": "Bravo valves are tested every month.",
+        "fans.txt": "Charlie fans run at 1200 rpm.",
+    }
+
+    def index_manuals(self):
+        return {title: rag_service.index_document(title, text) for title, text in self.manuals.items()}
+
+    def vector_ids(self, document):
+        return set(document.chunks.values_list("vector_id", flat=True))
+
+    def test_each_document_is_an_appended_segment(self):
+        self.index_manuals()
+        meta = index_service.read_meta()
+        self.assertEqual(len(meta["segments"]), 3)
+        self.assertEqual(rag_service.load_index().ntotal, 3)
+
+    def test_deleted_documents_are_hidden_from_both_searches(self):
+        documents = self.index_manuals()
+        deleted = self.vector_ids(documents["pumps.txt"])
+
+        rag_service.delete_document(documents["pumps.txt"])
+
+        index = rag_service.load_index()
+        self.assertEqual(index.ntotal, 2)
+        _, labels = index.search(rag_service.embed_query("alpha pumps seals"), 3)
+        self.assertFalse(deleted & set(labels[0].tolist()))
+        self.assertEqual(index.search_lexical("alpha pumps seals", 3), [])
+        self.assertNotIn("pumps", " ".join(hit.text for hit in rag_service.search_chunks("alpha pumps seals")))
+
+    def test_compaction_keeps_the_results_and_drops_deleted_vectors(self):
+        documents = self.index_manuals()
+        rag_service.delete_document(documents["fans.txt"])
+        queries = ["alpha pumps seals", "bravo valves", "1200 rpm"]
+        before = [rag_service.search_chunks(query) for query in queries]
+
+        index_service.compact(rag_service.embedding_dim())
+
+        meta = index_service.read_meta()
+        self.assertEqual((meta["segments"], meta["tombstones"]), ([], []))
+        index = rag_service.load_index()
+        self.assertEqual((index.base.ntotal, index.delta.ntotal), (2, 0))
+        self.assertEqual([rag_service.search_chunks(query) for query in queries], before)
+
+    def test_compaction_during_a_load_does_not_load_segments_twice(self):
+        rag_service.index_document("a.txt", "Alpha pumps need new seals every year.")
+        index_service.compact(rag_service.embedding_dim())
+        rag_service.index_document("b.txt", "Bravo valves are tested every month.")
+        reader = index_service.SegmentedIndex(rag_service.embedding_dim())
+        open_index = index_service.open_index
+
+        def compact_first(*args, **kwargs):
+            # Publishes after the reader read the metadata; the segment file lingers
+            if not compacted:
+                compacted.append(None)
+                compacted[0] = index_service.compact(reader.d)
+            return open_index(*args, **kwargs)
+
+        compacted = []
+        with mock.patch.object(index_service, "open_index", side_effect=compact_first), \
+                mock.patch.object(index_service, "_remove_files"):
+            reader.refresh()
+
+        self.assertEqual(reader.ntotal, 2)
+        self.assertEqual(reader.delta.ntotal, 0)
+        self.assertEqual(reader.generation, compacted[0])
+
+
+class BenchmarkCommandTests(RagTestCase):
+
+    def test_benchmark_leaves_no_rows_and_commits_as_it_goes(self):
+        existing = rag_service.index_document("real.txt", "Real content that must survive the benchmark.")
+        output = io.StringIO()
+        in_transaction = []
+        index_document = rag_service.index_document
+
+        def record_transaction(*args):
+            in_transaction.append(connection.in_atomic_block)
+            return index_document(*args)
+
+        with mock.patch.object(rag_service, "index_document", side_effect=record_transaction):
+            call_command(
+                "benchmark_rag", docs=3, words=200, queries=3, index_types=["flat"], stdout=output
+            )
+
+        self.assertEqual(json.loads(output.getvalue())["ingestion"]["documents"], 3)
+        # Each write commits on its own, nothing holds the database for the whole run
+        self.assertEqual(in_transaction, [False, False, False])
+        self.assertEqual(list(Document.objects.values_list("id", flat=True)), [existing.id])
+        self.assertEqual(ChunkEmbedding.objects.count(), 1)
+
+
+class HybridSearchTests(RagTestCase):
+
+    def index_error_codes(self):
+        """Six manuals of twelve paragraphs, each explaining one "ERR-<manual><nnn>" code"""
+        rng = random.Random(3)
+        words = ("the unit reports a fault when pressure drops below the threshold check wiring "
+                 "reset controller replace filter inspect seal calibrate").split()
+        for manual, topic in enumerate(["pump", "valve", "sensor", "motor", "boiler", "fan"], start=1):
+            paragraphs = [
+                f"ERR-{manual}{n:03d}: {topic} error. " + " ".join(rng.choice(words) for _ in range(140)) + "."
+                for n in range(1, 13)
+            ]
+            rag_service.index_document(f"{topic}.txt", "\n\n".join(paragraphs))
+
+    @override_settings(RAG_MMR=False, RAG_MERGE_ADJACENT=False)
+    def test_exact_code_is_found_among_chunks_sharing_its_prefix(self):
+        self.index_error_codes()
+
+        hits = rag_service.search_chunks("What does error ERR-3005 mean?", k=4)
+
+        self.assertIn("ERR-3005:", [hit.text[:9] for hit in hits])
+        # Chunks sharing only the "err" prefix are not keyword hits
+        self.assertEqual([hit.text[:9] for hit in hits if hit.lexical_score], ["ERR-3005:"])
+
+    def test_exact_code_ranks_first_after_reranking(self):
+        self.index_error_codes()
+
+        hits = rag_service.search_chunks("What does error ERR-3005 mean?", k=4)
+
+        self.assertTrue(hits[0].text.startswith("ERR-3005:"))
+
+
+class RerankingTests(SimpleTestCase):
+
+    def chunk(self, vector_id, document_id, position, text, score=1.0):
+        return rag_service.RetrievedChunk(vector_id, document_id, text, 0.0, score, position)
+
+    def test_mmr_skips_near_duplicates(self):
+        vectors = np.array([[1, 0, 0], [0.99, 0.1, 0], [0, 1, 0]], dtype='float32')
+        relevance = np.array([1.0, 0.95, 0.6], dtype='float32')
+
+        self.assertEqual(rag_service.mmr_order(relevance, vectors, 2, 0.7), [0, 2])
+        self.assertEqual(rag_service.mmr_order(relevance, vectors, 2, 1.0), [0, 1])
+
+    def test_overlapping_neighbours_are_merged_into_one_span(self):
+        text = " ".join(f"Step {i}: tighten bolt {i} to {i * 5} Nm." for i in range(120))
+        parts = rag_service.split_text(text)
+        self.assertGreater(len(parts), 2)
+        results = [
+            self.chunk(11, 1, 1, parts[1], score=0.9),
+            self.chunk(20, 2, 0, "Another manual."),
+            self.chunk(10, 1, 0, parts[0], score=0.5),
+        ]
+
+        merged = rag_service.merge_adjacent(results)
+
+        self.assertEqual([chunk.vector_ids for chunk in merged], [(10, 11), ()])
+        span = merged[0]
+        self.assertEqual((span.vector_id, span.position), (11, 0))
+        # The overlap the splitter repeats appears once
+        self.assertIn(span.text, text)
+        self.assertTrue(span.text.startswith(parts[0]) and span.text.endswith(parts[1]))
+
+
+class QueryEmbeddingCacheTests(SimpleTestCase):
+
+    def test_queries_differing_in_case_share_the_embedding_of_the_normalized_text(self):
+        provider = mock.Mock(key="fake", embed=mock.Mock(side_effect=lambda texts: np.ones((len(texts), 4), "float32")))
+        self.addCleanup(rag_service._embedding_cache.clear)
+        rag_service._embedding_cache.clear()
+
+        first = rag_service.embed_query("What is  Django?", provider)
+        second = rag_service.embed_query("what is django?", provider)
+
+        provider.embed.assert_called_once_with(["what is django?"])
+        self.assertIs(first, second)
+
+
+def random_document(rng: random.Random) -> str:
+    """Words, runs of spaces and newlines and paragraphs of very different lengths"""
+    words = ["gear", "oil", "W-100", "ERR-3005", "torque", "x" * 40]
+    breaks = [" ", " ", " ", "  ", "\n", "\n\n", "\n\n\n", " \n\n "]
+    tokens = []
+    for _ in range(rng.randint(0, 4000)):
+        tokens.append(rng.choice(words))
+        tokens.append(rng.choice(breaks) if rng.random() < 0.1 else " ")
+    text = "".join(tokens)
+    if rng.random() < 0.2:
+        text = text.replace("\n\n", "\n")  # Without blank lines
+    return text
+
+
+def random_pieces(rng: random.Random, text: str) -> List[str]:
+    cuts = sorted(rng.sample(range(len(text) + 1), min(len(text) + 1, rng.randint(0, 50))))
+    return [text[start:end] for start, end in zip([0] + cuts, cuts + [len(text)])]
+
+
+class PipelineChunkingTests(SimpleTestCase):
+
+    def test_streamed_chunks_are_those_of_split_text(self):
+        rng = random.Random(7)
+        for n in range(100):
+            text = random_document(rng)
+            with self.subTest(document=n):
+                self.assertEqual(list(pipeline_service.iter_chunks(random_pieces(rng, text))), rag_service.split_text(text))
+
+    def test_docx_paragraphs_are_extracted_and_released(self):
+        w = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+        paragraphs = "".join(f"<w:p><w:r><w:t>Paragraph {i}</w:t><w:tab/><w:t>end</w:t></w:r></w:p>" for i in range(50))
+        table = "<w:tbl><w:tr><w:tc><w:p><w:r><w:t>Cell</w:t></w:r></w:p></w:tc></w:tr></w:tbl>"
+        path = os.path.join(tempfile.mkdtemp(), "report.docx")
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        with zipfile.ZipFile(path, "w") as archive:
+            archive.writestr("word/document.xml", f'<w:document xmlns:w="{w}"><w:body>{paragraphs}{table}</w:body></w:document>')
+
+        parsers = []
+        iterparse = pipeline_service.ElementTree.iterparse
+        with mock.patch.object(pipeline_service.ElementTree, "iterparse",
+                               side_effect=lambda *args, **kwargs: parsers.append(iterparse(*args, **kwargs)) or parsers[-1]):
+            pieces = list(pipeline_service.extract_docx(path))
+
+        self.assertEqual(pieces[:2], ["Paragraph 0\tend\n\n", "Paragraph 1\tend\n\n"])
+        self.assertEqual(pieces[-1], "Cell\n\n")
+        self.assertEqual(len(pieces), 51)
+        # Nothing but the document element is left in the parsed tree
+        self.assertEqual(len(list(parsers[0].root.iter())), 1)
+
+
+class FakeEmbeddingServer:
+    """
+    Local stand-in for an OpenAI-compatible /embeddings endpoint, served
+    through httpx.MockTransport. Each text is embedded as the one-hot vector
+    of its first character's position in "abcd"; failures lists the status
+    codes (or exceptions) to answer with before succeeding.
+    """
+    DIM = 4
+
+    def __init__(self, failures=(), retry_after=None):
+        self.failures = list(failures)
+        self.retry_after = retry_after
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        payload = json.loads(request.content)
+        with self._lock:
+            self.requests.append(payload)
+            failure = self.failures.pop(0) if self.failures else None
+        if isinstance(failure, Exception):
+            raise failure
+        if failure is not None:
+            headers = {"Retry-After": str(self.retry_after)} if self.retry_after is not None else {}
+            return httpx.Response(failure, headers=headers, json={"error": {"message": "fake failure"}})
+        data = []
+        for index, text in enumerate(payload["input"]):
+            vector = [0.0] * self.DIM
+            vector["abcd".index(text[0])] = 2.0
+            data.append({"index": index, "embedding": vector})
+        # Out of order on purpose: clients must sort by index
+        return httpx.Response(200, json={"data": data[::-1], "model": payload["model"]})
+
+    def provider(self, **options) -> OpenAICompatibleEmbedding:
+        options = {"batch_size": 2, "concurrency": 2, "max_retries": 2, **options}
+        return OpenAICompatibleEmbedding(
+            model="fake-embedding", dim=self.DIM, base_url="http://embeddings.test/v1",
+            transport=httpx.MockTransport(self), **options
+        )
+
+
+@override_settings(RAG_TRACE=False)
+class OpenAICompatibleEmbeddingTests(SimpleTestCase):
+
+    def setUp(self):
+        # Backoff sleeps are recorded instead of waited
+        patcher = mock.patch("chat.embedding_service.time.sleep")
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_texts_are_sent_in_batches_and_returned_in_order(self):
+        server = FakeEmbeddingServer()
+        texts = ["a1", "b2", "c3", "d4", "a5"]
+
+        vectors = server.provider().embed(texts)
+
+        self.assertEqual([len(request["input"]) for request in server.requests], [2, 2, 1])
+        self.assertTrue(all(request["model"] == "fake-embedding" for request in server.requests))
+        self.assertEqual(vectors.shape, (5, FakeEmbeddingServer.DIM))
+        self.assertEqual(vectors.dtype, np.float32)
+        np.testing.assert_allclose(vectors, np.eye(FakeEmbeddingServer.DIM, dtype='float32')[[0, 1, 2, 3, 0]])
+
+    def test_throttled_and_failed_requests_are_retried(self):
+        for failure in (429, 503, httpx.ConnectError("connection refused")):
+            with self.subTest(failure=failure):
+                server = FakeEmbeddingServer(failures=[failure])
+                vectors = server.provider().embed(["a", "b"])
+                self.assertEqual(len(server.requests), 2)
+                np.testing.assert_allclose(vectors, np.eye(FakeEmbeddingServer.DIM, dtype='float32')[[0, 1]])
+
+    def test_retries_go_through_the_rate_limiters(self):
+        server = FakeEmbeddingServer(failures=[429, 429])
+        provider = server.provider()
+        with mock.patch.object(provider.requests, "acquire") as request_limit, \
+                mock.patch.object(provider.tokens, "acquire") as token_limit:
+            provider.embed(["a"])
+        self.assertEqual(len(server.requests), 3)
+        self.assertEqual(request_limit.call_count, 3)
+        self.assertEqual(token_limit.call_count, 3)
+
+    def test_retry_after_is_honoured(self):
+        server = FakeEmbeddingServer(failures=[429], retry_after=7)
+        server.provider().embed(["a"])
+        self.assertGreaterEqual(self.sleep.call_args[0][0], 7)
+
+    def test_gives_up_after_max_retries(self):
+        server = FakeEmbeddingServer(failures=[503] * 5)
+        with self.assertRaisesRegex(EmbeddingError, "after 3 attempts"):
+            server.provider(max_retries=2).embed(["a"])
+        self.assertEqual(len(server.requests), 3)
+
+    def test_client_errors_are_not_retried(self):
+        server = FakeEmbeddingServer(failures=[400])
+        with self.assertRaisesRegex(EmbeddingError, r"\(400\)"):
+            server.provider().embed(["a"])
+        self.assertEqual(len(server.requests), 1)
+
+    def test_wrong_dimension_is_an_error(self):
+        server = FakeEmbeddingServer()
+        provider = OpenAICompatibleEmbedding(
+            model="fake-embedding", dim=8, base_url="http://embeddings.test/v1",
+            transport=httpx.MockTransport(server),
+        )
+        with self.assertRaisesRegex(EmbeddingError, "dimension 8"):
+            provider.embed(["a"])
+
+
+@override_settings(RAG_TRACE=False, RAG_HISTORY_SUMMARY=True, RAG_HISTORY_SUMMARY_BATCH=1)
+class HistorySummaryTests(TransactionTestCase):
+
+    def add_messages(self, session, *roles):
+        start = timezone.now() - timedelta(hours=1)
+        for i, role in enumerate(roles):
+            message = Message.objects.create(session=session, role=role, content=f"{role} {i}")
+            Message.objects.filter(id=message.id).update(created_at=start + timedelta(seconds=i))
+
+    def test_a_lone_pending_question_waits_for_its_answer(self):
+        session = ChatSession.objects.create()
+        # Only the oldest message is outside the window: a question whose answer is not
+        self.add_messages(session, "user", *["user", "assistant"] * 5, "user")
+        llm = FakeChatModel(responses=[])
+
+        self.assertFalse(history_service.update_summary(session.id, llm=llm))
+        self.assertEqual(llm.calls, [])
+
+    def test_pending_exchanges_are_folded_into_the_summary(self):
+        session = ChatSession.objects.create()
+        self.add_messages(session, *["user", "assistant"] * 7)
+        llm = FakeChatModel(responses=[AIMessage(content="They talked.")])
+
+        self.assertTrue(history_service.update_summary(session.id, llm=llm))
+        session.refresh_from_db()
+        self.assertEqual(session.summary, "They talked.")
+        self.assertIn("User: user 0\nAssistant: assistant 1", llm.calls[0][1].content)
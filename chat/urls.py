@@ -4,4 +4,10 @@ from . import views
 urlpatterns = [
     path('chat/', views.ChatView.as_view(), name='chat'),
     path('agent/', views.AgentView.as_view(), name='agent'),
+    path('documents/upload/', views.DocumentUploadView.as_view(), name='document-upload'),
+    path('jobs/<int:job_id>/', views.IngestionJobView.as_view(), name='ingestion-job'),
+    path('metrics/', views.MetricsView.as_view(), name='metrics'),
+    # Async versions for ASGI servers (uvicorn backend.asgi:application)
+    path('async/chat/', views.AsyncChatView.as_view(), name='async-chat'),
+    path('async/agent/', views.AsyncAgentView.as_view(), name='async-agent'),
 ]
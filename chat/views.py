@@ -1,11 +1,95 @@
+import json
+from asgiref.sync import sync_to_async
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-from .ai_service import generate_ai_reply
-from .models import ChatSession, Message
-from .serializers import MessageSerializer
-from .agent_service import run_agent
+from .ai_service import agenerate_ai_reply, astream_ai_reply, generate_ai_reply, stream_ai_reply
+from .models import ChatSession, IngestionJob, Message
+from .serializers import IngestionJobSerializer, MessageSerializer
+from .ingest_service import SUPPORTED_EXTENSIONS, enqueue_upload, is_supported, recover_jobs_once
+from .agent_service import arun_agent, astream_agent, run_agent, stream_agent
+from .history_service import aload_recent_history, load_recent_history, update_summary_in_background
+from .metrics_service import render_gauge, render_metrics, span, trace, tracked
+from .rag_service import get_index_stats
 from django.core.files.storage import default_storage
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+
+
+def wants_stream(data) -> bool:
+    """True when the client asked for a Server-Sent Events response"""
+    return str(data.get("stream", "")).lower() in ("1", "true", "yes")
+
+
+def sse_event(event: str, data: dict) -> str:
+    """Format one Server-Sent Events frame"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream_reply(session, user_msg_obj, tokens):
+    """
+    Stream an assistant reply as Server-Sent Events:
+    start (session + user message), token* and done (saved assistant message).
+    The assembled reply is saved when the token stream ends, including when
+    the client disconnects half-way.
+    """
+    def events():
+        yield sse_event("start", {
+            "session_id": session.id,
+            "user_message": MessageSerializer(user_msg_obj).data,
+        })
+        parts = []
+        try:
+            for token in tokens:
+                parts.append(token)
+                yield sse_event("token", {"token": token})
+        except Exception as e:
+            trace(f"[stream_reply] Error while streaming: {str(e)}")
+            yield sse_event("error", {"error": f"Streaming failed: {str(e)}"})
+        finally:
+            with span("message_persist"):
+                assistant_msg_obj = Message.objects.create(
+                    session=session,
+                    role="assistant",
+                    content="".join(parts)
+                )
+            trace(f"[stream_reply] Saved assistant message (ID: {assistant_msg_obj.id})")
+        yield sse_event("done", {
+            "session_id": session.id,
+            "assistant_message": MessageSerializer(assistant_msg_obj).data,
+        })
+
+    return sse_response(events())
+
+
+def sse_response(events):
+    """Wrap an (async) iterator of SSE frames in a streaming response"""
+    response = StreamingHttpResponse(events, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"  # Don't let nginx buffer the stream
+    return response
+
+
+def attach_uploaded_file(user_message: str, uploaded_file, view_name: str) -> str:
+    """
+    Queue a supported upload for background indexing and note it in the
+    message (the content itself is searchable once the job is done)
+    """
+    try:
+        if is_supported(uploaded_file.name):
+            job = enqueue_upload(uploaded_file)
+            user_message += f"\n\n[Attached file: {uploaded_file.name} - indexing in the background (job {job.id})]"
+        else:
+            user_message += f"\n\n[Attached file: {uploaded_file.name} - unsupported file type, not indexed]"
+        
+        trace(f"[{view_name}] Processed file: {uploaded_file.name}")
+    except Exception as e:
+        trace(f"[{view_name}] Error processing file: {str(e)}")
+        user_message += f"\n\n[Error processing file: {uploaded_file.name}]"
+    return user_message
+
 
 class AgentView(APIView):
     """
@@ -13,30 +97,15 @@ class AgentView(APIView):
     Uses the LangChain agent with RAG tool to respond to messages.
     """
     
+    @tracked("agent")
     def post(self, request):
         user_message = request.data.get("message", "").strip()
         session_id = request.data.get("session_id")
         uploaded_file = request.FILES.get('file')
         
         # Handle file upload if present
-        file_content = ""
         if uploaded_file:
-            try:
-                # Read text files
-                if uploaded_file.name.endswith('.txt'):
-                    file_content = uploaded_file.read().decode('utf-8')
-                    user_message += f"\n\nFile content ({uploaded_file.name}):\n{file_content}"
-                elif uploaded_file.name.endswith(('.pdf', '.docx', '.doc')):
-                    # You'll need to install libraries for PDF/DOCX processing
-                    # For now, just acknowledge the file
-                    user_message += f"\n\n[Attached file: {uploaded_file.name} - content processing not yet implemented]"
-                else:
-                    user_message += f"\n\n[Attached file: {uploaded_file.name}]"
-                
-                print(f"[AgentView] Processed file: {uploaded_file.name}")
-            except Exception as e:
-                print(f"[AgentView] Error processing file: {str(e)}")
-                user_message += f"\n\n[Error processing file: {uploaded_file.name}]"
+            user_message = attach_uploaded_file(user_message, uploaded_file, "AgentView")
         
         if not user_message:
             return Response(
@@ -53,67 +122,59 @@ class AgentView(APIView):
                 except ValueError:
                     # If it's not a valid integer, create a new session
                     session = ChatSession.objects.create(title=user_message[:50])
-                    print(f"[AgentView] Invalid session_id '{session_id}', created new session: {session.id}")
+                    trace(f"[AgentView] Invalid session_id '{session_id}', created new session: {session.id}")
                 else:
                     # Try to get existing session
                     session = ChatSession.objects.get(id=session_id_int)
-                    print(f"[AgentView] Using existing session: {session_id_int}")
+                    trace(f"[AgentView] Using existing session: {session_id_int}")
             except ChatSession.DoesNotExist:
                 # Session doesn't exist, create a new one
                 session = ChatSession.objects.create(title=user_message[:50])
-                print(f"[AgentView] Session {session_id_int} not found, created new: {session.id}")
+                trace(f"[AgentView] Session {session_id_int} not found, created new: {session.id}")
         else:
             # No session_id provided, create new session
             session = ChatSession.objects.create(title=user_message[:50])
-            print(f"[AgentView] Created new session: {session.id}")
+            trace(f"[AgentView] Created new session: {session.id}")
         
         # 2. Save user message
-        user_msg_obj = Message.objects.create(
-            session=session,
-            role="user",
-            content=user_message
-        )
-        print(f"[AgentView] Saved user message (ID: {user_msg_obj.id})")
-        
-        # 3. Build chat history from previous messages (exclude current message)
-        all_messages = Message.objects.filter(
-            session=session
-        ).order_by('created_at')
-        
-        # Get all messages except the last one (the user message we just created)
-        previous_messages = list(all_messages)[:-1] if all_messages.count() > 1 else []
+        with span("message_persist"):
+            user_msg_obj = Message.objects.create(
+                session=session,
+                role="user",
+                content=user_message
+            )
+        trace(f"[AgentView] Saved user message (ID: {user_msg_obj.id})")
         
-        chat_history = []
-        temp_user_msg = None
+        # 3. Load the recent exchanges (exclude current message) and fold older ones into the summary
+        with span("history_load"):
+            chat_history, pending = load_recent_history(session, exclude_id=user_msg_obj.id)
+        update_summary_in_background(session.id, pending)
         
-        for msg in previous_messages:
-            if msg.role == "user":
-                temp_user_msg = msg.content
-            elif msg.role == "assistant" and temp_user_msg:
-                chat_history.append((temp_user_msg, msg.content))
-                temp_user_msg = None
+        trace(f"[AgentView] Built chat history with {len(chat_history)} exchanges")
         
-        print(f"[AgentView] Built chat history with {len(chat_history)} exchanges")
+        # 4. Run the agent (streamed when requested)
+        if wants_stream(request.data):
+            return stream_reply(session, user_msg_obj, stream_agent(user_message, chat_history, session.summary))
         
-        # 4. Run the agent
         try:
-            print(f"[AgentView] Calling run_agent...")
-            agent_response = run_agent(user_message, chat_history)
-            print(f"[AgentView] Agent response received")
+            trace(f"[AgentView] Calling run_agent...")
+            agent_response = run_agent(user_message, chat_history, session.summary)
+            trace(f"[AgentView] Agent response received")
         except Exception as e:
-            print(f"[AgentView] Error running agent: {str(e)}")
+            trace(f"[AgentView] Error running agent: {str(e)}")
             return Response(
                 {"error": f"Agent execution failed: {str(e)}"}, 
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
         
         # 5. Save assistant message
-        assistant_msg_obj = Message.objects.create(
-            session=session,
-            role="assistant",
-            content=agent_response
-        )
-        print(f"[AgentView] Saved assistant message (ID: {assistant_msg_obj.id})")
+        with span("message_persist"):
+            assistant_msg_obj = Message.objects.create(
+                session=session,
+                role="assistant",
+                content=agent_response
+            )
+        trace(f"[AgentView] Saved assistant message (ID: {assistant_msg_obj.id})")
         
         # 6. Serialize and return
         user_serialized = MessageSerializer(user_msg_obj).data
@@ -124,6 +185,8 @@ class AgentView(APIView):
             "user_message": user_serialized,
             "assistant_message": assistant_serialized
         }, status=status.HTTP_200_OK)
+
+
 class ChatView(APIView):
     """
     Simple chat endpoint.
@@ -131,6 +194,7 @@ class ChatView(APIView):
     Later, Member 2 will plug LangChain here.
     """
 
+    @tracked("chat")
     def post(self, request):
         user_message = request.data.get("message")
         session_id = request.data.get("session_id")
@@ -154,19 +218,24 @@ class ChatView(APIView):
             session = ChatSession.objects.create()
 
         # Save user message
-        Message.objects.create(
-            session=session,
-            role='user',
-            content=user_message
-        )
+        with span("message_persist"):
+            user_msg_obj = Message.objects.create(
+                session=session,
+                role='user',
+                content=user_message
+            )
+
+        if wants_stream(request.data):
+            return stream_reply(session, user_msg_obj, stream_ai_reply(user_message))
 
         assistant_reply = generate_ai_reply(user_message)
 
-        Message.objects.create(
-            session=session,
-            role='assistant',
-            content=assistant_reply
-        )
+        with span("message_persist"):
+            Message.objects.create(
+                session=session,
+                role='assistant',
+                content=assistant_reply
+            )
 
         return Response(
             {
@@ -175,3 +244,255 @@ class ChatView(APIView):
             },
             status=status.HTTP_200_OK
         )
+
+
+class DocumentUploadView(APIView):
+    """
+    POST /api/documents/upload/
+    Saves the uploaded file and queues it for indexing; responds at once
+    with the job to poll at /api/jobs/<id>/.
+    """
+
+    def post(self, request):
+        uploaded_file = request.FILES.get('file')
+        if not uploaded_file:
+            return Response(
+                {"error": "Field 'file' is required."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not is_supported(uploaded_file.name):
+            return Response(
+                {"error": f"Unsupported file type. Supported: {', '.join(sorted(SUPPORTED_EXTENSIONS))}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        recover_jobs_once()
+        job = enqueue_upload(uploaded_file)
+        return Response(IngestionJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+
+class IngestionJobView(APIView):
+    """
+    GET /api/jobs/<id>/
+    Status and chunk progress of an ingestion job.
+    """
+
+    def get(self, request, job_id):
+        recover_jobs_once()  # Jobs a restart interrupted are requeued or failed, never left pending
+        try:
+            job = IngestionJob.objects.get(id=job_id)
+        except IngestionJob.DoesNotExist:
+            return Response({"error": "Job not found"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(IngestionJobSerializer(job).data, status=status.HTTP_200_OK)
+
+
+class MetricsView(View):
+    """
+    GET /api/metrics/
+    Request and stage latency histograms, token counts and index/cache
+    gauges in the Prometheus text format. Numbers are per worker process.
+    """
+
+    def get(self, request):
+        stats = get_index_stats()
+        cache = stats["cache"]
+        gauges = [
+            ("rag_index_vectors", "Vectors in the FAISS index", stats["total_vectors"]),
+            ("rag_index_segments", "Index segments waiting for compaction", stats["segments"]),
+            ("rag_index_deleted_vectors", "Deleted vectors waiting for compaction", stats["deleted_vectors"]),
+            ("rag_documents", "Indexed documents", stats["documents_count"]),
+            ("rag_chunks", "Indexed chunks", stats["chunks_count"]),
+            ("rag_query_embedding_cache_hit_rate", "Hit rate of the query embedding cache",
+             cache["query_embeddings"]["hit_rate"]),
+            ("rag_search_cache_hit_rate", "Hit rate of the search result cache", cache["search_results"]["hit_rate"]),
+            ("rag_response_cache_entries", "Cached LLM responses", cache["responses"]["entries"]),
+        ]
+        lines = [line for name, help_text, value in gauges for line in render_gauge(name, help_text, value)]
+        return HttpResponse(render_metrics(lines), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# -------------------------------------------------------------------
+# Async views (served without blocking a thread when run under ASGI)
+# -------------------------------------------------------------------
+
+def request_data(request):
+    """Form fields, or the parsed body for JSON requests (DRF's request.data for plain views)"""
+    if request.content_type == "application/json":
+        try:
+            return json.loads(request.body or b"{}")
+        except ValueError:
+            return {}
+    return request.POST
+
+
+def astream_reply(session, user_msg_obj, tokens):
+    """
+    Async version of stream_reply: consumes an async token iterator and
+    saves the assistant message with the async ORM
+    """
+    async def events():
+        yield sse_event("start", {
+            "session_id": session.id,
+            "user_message": MessageSerializer(user_msg_obj).data,
+        })
+        parts = []
+        try:
+            async for token in tokens:
+                parts.append(token)
+                yield sse_event("token", {"token": token})
+        except Exception as e:
+            trace(f"[astream_reply] Error while streaming: {str(e)}")
+            yield sse_event("error", {"error": f"Streaming failed: {str(e)}"})
+        finally:
+            with span("message_persist"):
+                assistant_msg_obj = await Message.objects.acreate(
+                    session=session,
+                    role="assistant",
+                    content="".join(parts)
+                )
+            trace(f"[astream_reply] Saved assistant message (ID: {assistant_msg_obj.id})")
+        yield sse_event("done", {
+            "session_id": session.id,
+            "assistant_message": MessageSerializer(assistant_msg_obj).data,
+        })
+
+    return sse_response(events())
+
+
+@method_decorator(csrf_exempt, name="dispatch")
+class AsyncAgentView(View):
+    """
+    POST /api/async/agent/
+    Async version of AgentView: same request and response format, but the
+    LLM round-trip is awaited and FAISS search runs in a thread pool, so a
+    single ASGI worker can hold many conversations in flight.
+    """
+    
+    @tracked("async_agent")
+    async def post(self, request):
+        data = request_data(request)
+        user_message = (data.get("message") or "").strip()
+        session_id = data.get("session_id")
+        uploaded_file = request.FILES.get('file')
+        
+        if uploaded_file:
+            user_message = await sync_to_async(attach_uploaded_file)(
+                user_message, uploaded_file, "AsyncAgentView"
+            )
+        
+        if not user_message:
+            return JsonResponse({"error": "Message is required"}, status=status.HTTP_400_BAD_REQUEST)
+        
+        # 1. Get or create session
+        session = None
+        if session_id not in [None, '', 'null', 'undefined']:
+            try:
+                session = await ChatSession.objects.aget(id=int(session_id))
+                trace(f"[AsyncAgentView] Using existing session: {session.id}")
+            except (ValueError, ChatSession.DoesNotExist):
+                trace(f"[AsyncAgentView] Session '{session_id}' not found")
+        if session is None:
+            session = await ChatSession.objects.acreate(title=user_message[:50])
+            trace(f"[AsyncAgentView] Created new session: {session.id}")
+        
+        # 2. Save user message
+        with span("message_persist"):
+            user_msg_obj = await Message.objects.acreate(
+                session=session,
+                role="user",
+                content=user_message
+            )
+        
+        # 3. Build chat history from previous messages (exclude current message)
+        with span("history_load"):
+            chat_history, pending = await aload_recent_history(session, exclude_id=user_msg_obj.id)
+        update_summary_in_background(session.id, pending)
+        trace(f"[AsyncAgentView] Built chat history with {len(chat_history)} exchanges")
+        
+        # 4. Run the agent (streamed when requested)
+        if wants_stream(data):
+            return astream_reply(session, user_msg_obj, astream_agent(user_message, chat_history, session.summary))
+        
+        try:
+            agent_response = await arun_agent(user_message, chat_history, session.summary)
+        except Exception as e:
+            trace(f"[AsyncAgentView] Error running agent: {str(e)}")
+            return JsonResponse(
+                {"error": f"Agent execution failed: {str(e)}"},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+        
+        # 5. Save assistant message
+        with span("message_persist"):
+            assistant_msg_obj = await Message.objects.acreate(
+                session=session,
+                role="assistant",
+                content=agent_response
+            )
+        
+        # 6. Serialize and return
+        return JsonResponse({
+            "session_id": session.id,
+            "user_message": MessageSerializer(user_msg_obj).data,
+            "assistant_message": MessageSerializer(assistant_msg_obj).data
+        }, status=status.HTTP_200_OK)
+
+
+@method_decorator(csrf_exempt, name="dispatch")
+class AsyncChatView(View):
+    """
+    POST /api/async/chat/
+    Async version of ChatView
+    """
+
+    @tracked("async_chat")
+    async def post(self, request):
+        data = request_data(request)
+        user_message = data.get("message")
+        session_id = data.get("session_id")
+
+        if not user_message:
+            return JsonResponse(
+                {"error": "Field 'message' is required."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # Get or create chat session
+        if session_id:
+            try:
+                session = await ChatSession.objects.aget(id=session_id)
+            except (ValueError, ChatSession.DoesNotExist):
+                return JsonResponse(
+                    {"error": "Invalid session_id"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+        else:
+            session = await ChatSession.objects.acreate()
+
+        # Save user message
+        with span("message_persist"):
+            user_msg_obj = await Message.objects.acreate(
+                session=session,
+                role='user',
+                content=user_message
+            )
+
+        if wants_stream(data):
+            return astream_reply(session, user_msg_obj, astream_ai_reply(user_message))
+
+        assistant_reply = await agenerate_ai_reply(user_message)
+
+        with span("message_persist"):
+            await Message.objects.acreate(
+                session=session,
+                role='assistant',
+                content=assistant_reply
+            )
+
+        return JsonResponse(
+            {
+                "session_id": session.id,
+                "reply": assistant_reply,
+            },
+            status=status.HTTP_200_OK
+        )
@@ -57,6 +57,7 @@ async function sendMessage() {
   try {
     const formData = new FormData();
     formData.append('message', message);
+    formData.append('stream', '1');
     
     // Only append session_id if it's not null/empty
     if (sessionId) {
@@ -72,13 +73,17 @@ async function sendMessage() {
       body: formData
     });
     
-    const data = await response.json();
-    
-    if (response.ok) {
-      sessionId = data.session_id;
-      addMessage(data.assistant_message.content, 'assistant');
+    const contentType = response.headers.get('Content-Type') || '';
+    if (response.ok && contentType.startsWith('text/event-stream')) {
+      await readReplyStream(response);
     } else {
-      addMessage(`Error: ${data.error}`, 'assistant');
+      const data = await response.json();
+      if (response.ok) {
+        sessionId = data.session_id;
+        addMessage(data.assistant_message.content, 'assistant');
+      } else {
+        addMessage(`Error: ${data.error}`, 'assistant');
+      }
     }
   } catch (err) {
     addMessage(`Error: ${err.message}`, 'assistant');
@@ -90,12 +95,60 @@ async function sendMessage() {
   document.getElementById('fileNameDisplay').style.display = 'none';
 }
 
+// Render a Server-Sent Events reply token by token
+async function readReplyStream(response) {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  const msgDiv = addMessage('', 'assistant');
+  let buffer = '';
+
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    // Events are separated by a blank line
+    let boundary;
+    while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+      const frame = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+      handleStreamEvent(frame, msgDiv);
+    }
+  }
+}
+
+function handleStreamEvent(frame, msgDiv) {
+  let event = 'message';
+  let data = '';
+  for (const line of frame.split('\n')) {
+    if (line.startsWith('event:')) event = line.slice(6).trim();
+    else if (line.startsWith('data:')) data += line.slice(5).trim();
+  }
+  if (!data) return;
+  const payload = JSON.parse(data);
+
+  if (event === 'start') {
+    sessionId = payload.session_id;
+  } else if (event === 'token') {
+    msgDiv.textContent += payload.token;
+    scrollToBottom();
+  } else if (event === 'error') {
+    msgDiv.textContent += `\nError: ${payload.error}`;
+  }
+}
+
 function addMessage(text, role) {
   const messagesDiv = document.getElementById('messages');
   const msgDiv = document.createElement('div');
   msgDiv.className = 'message ' + role;
   msgDiv.textContent = text;
   messagesDiv.appendChild(msgDiv);
+  scrollToBottom();
+  return msgDiv;
+}
+
+function scrollToBottom() {
+  const messagesDiv = document.getElementById('messages');
   messagesDiv.scrollTop = messagesDiv.scrollHeight;
 }
 